@@ -1,5 +1,6 @@
 import numpy as np
 
+from instrument import timed
 from logistic import predict_prob
 
 
@@ -9,23 +10,27 @@ def entropy(p):
     (the closer the probability is to 1/2, the higher the entropy)
 
     :param p: numpy array of probabilities
-    :return: numpy array of entropies
+    :return: numpy array of entropies (of the same data type as p)
     """
     q = 1 - p
-    return p * np.log(p) + q * np.log(q)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = -(p * np.log(p) + q * np.log(q))
+    # 0 log 0 is taken to be 0, so certain predictions have zero entropy
+    return np.nan_to_num(h, copy=False)
 
 
-def score_by_uncertainty(data, classifiers):
+@timed('active.score_by_uncertainty', items='data')
+def score_by_uncertainty(data, classifiers, dtype=None):
     """
     Score datapoints by how uncertain a classifier is
     :param data: array of vectors
     :param classifiers: one or more probabilistic classifiers for a binary
     decisions
+    :param dtype: (optional) numpy data type of probabilities and scores
     :return: entropy of each datapoint
     """
     # Get the classifier's prediction probabilities
-    prob = predict_prob(classifiers, data)
-    print(prob.shape)
+    prob = predict_prob(classifiers, data, dtype)
     # Convert this to uncertainty
     return entropy(prob)
 
@@ -41,19 +46,21 @@ def score_by_uncertainty(data, classifiers):
 # this suggests that this data point uses features that we are marginally sure about.
 
 
-def score_by_relative_uncertainty(data, over, under):
+@timed('active.score_by_relative_uncertainty', items='data')
+def score_by_relative_uncertainty(data, over, under, dtype=None):
     """
     Score datapoints by the difference in uncertainty between two classifiers
 
     :param data: array of vectors
     :param over: one or more probabilistic classifiers for a binary decisions
     :param under: one or more probabilistic classifiers for a binary decisions
+    :param dtype: (optional) numpy data type of probabilities and scores
 
     :return: "under" entropy minus "over" entropy
     """
     # Get the classifiers' prediction probabilities
-    over_prob = predict_prob(over, data)
-    under_prob = predict_prob(under, data)
+    over_prob = predict_prob(over, data, dtype)
+    under_prob = predict_prob(under, data, dtype)
     # Find the difference in uncertainty
     return entropy(under_prob) - entropy(over_prob)
 
@@ -63,6 +70,7 @@ def score_by_relative_uncertainty(data, over, under):
 # This is so that we choose some examples from each classifier
 
 
+@timed('active.top_N', items='scores')
 def top_N(scores, N=None, weights=None, R=2, normalise=False):
     """
     Find the most highly scored datapoints
@@ -93,20 +101,25 @@ def top_N(scores, N=None, weights=None, R=2, normalise=False):
         # Create a copy, so that this function does not have side effects
         scores = scores.copy()
         scores -= scores.min(0)
-        scores /= scores.max(0)
-    # Initialise indices
+        # (columns with the same score for every datapoint are left as zeros)
+        ranges = scores.max(0)
+        ranges[ranges == 0] = 1
+        scores /= ranges
+    # Initialise indices, and each classifier's sum of scores for them
     top = []
+    chosen = np.zeros(scores.shape[1])
     # Iteratively find the highest scoring datapoint
-    for _ in range(N):
+    for _ in range(min(N, len(scores))):
         # Reweight, then find the range voting winner
         # Downweight each classifier, according to the sum of its scores for
         # the datapoints already chosen
-        cur_weights = weights / (1 + R * scores[top].sum(0))
+        cur_weights = weights / (1 + R * chosen)
         # Find the total reweighted score
-        weighted_scores = (scores * cur_weights).sum(1)
+        weighted_scores = scores @ cur_weights
         # Ignore datapoints that have already been chosen
-        weighted_scores[top] = 0
+        weighted_scores[top] = -np.inf
         # Record the highest
         top.append(weighted_scores.argmax())
+        chosen += scores[top[-1]]
 
     return np.array(top)
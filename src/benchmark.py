@@ -0,0 +1,455 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from features import (bag_of_words, bag_of_ngrams, bag_of_character_ngrams,
+                      bag_of_variable_character_ngrams, combine, normalise,
+                      document_frequency, feature_list_and_dict, vectorise,
+                      vectorise_sparse)
+from logistic import train, predict, predict_prob
+from bundle import save_bundle, load_bundle
+from active import entropy, top_N
+from evaluate import evaluate_all
+from instrument import max_rss
+from check_float32 import compare_predictions, failures
+
+# Benchmarks for the whole pipeline, on synthetic data (so they run offline)
+# Messages are made of Somali-like words, drawn from a Zipf distribution,
+# and each code has a few indicative words, which are added to the messages
+# that have that code, so that the classifiers have something to learn.
+# Each stage is timed on its own, and optionally run a second time under
+# tracemalloc to find its peak memory use. Results are saved as JSON, so that
+# runs on different commits can be compared.
+# To measure text normalisation, a copy of the messages is made with spelling
+# variation (case, punctuation, repeated letters and Somali variants) added.
+
+CONSONANTS = ['b', 't', 'j', 'x', 'kh', 'd', 'r', 's', 'sh', 'dh', 'c', 'g',
+              'f', 'q', 'k', 'l', 'm', 'n', 'w', 'h', 'y']
+VOWELS = ['a', 'e', 'i', 'o', 'u', 'aa', 'ee', 'ii', 'oo', 'uu']
+
+# Modules whose import time is measured, and slow dependencies to look for
+IMPORT_MODULES = ['features', 'preprocess', 'bundle', 'logistic', 'active',
+                  'evaluate', 'predict_multiple', 'select_multiple',
+                  'select_random', 'service']
+HEAVY_MODULES = ['numpy', 'scipy', 'pandas', 'sklearn']
+
+DEFAULT_CONFIG = {
+    'n_messages': 5000,
+    'vocab_size': 2000,
+    'zipf': 1.1,
+    'mean_length': 12,
+    'n_codes': 10,
+    'label_density': 0.1,
+    'code_words': 20,
+    'test_fraction': 0.2,
+    'top_n': 100,
+    'n_resamples': 1000,
+    'noise': 0.3,
+    'seed': 0,
+}
+
+# Ways of writing a word differently, for add_noise
+PUNCTUATION = [',', '.', '!!', '?', '...']
+
+
+def make_vocabulary(vocab_size, rng):
+    """
+    Generate distinct Somali-like words, from random syllables
+
+    :param vocab_size: number of words
+    :param rng: numpy random Generator
+
+    :return: list of words
+    """
+    words = set()
+    while len(words) < vocab_size:
+        n_syllables = rng.integers(1, 4)
+        words.add(''.join(CONSONANTS[rng.integers(len(CONSONANTS))]
+                          + VOWELS[rng.integers(len(VOWELS))]
+                          for _ in range(n_syllables)))
+    # Sort before shuffling, so that the result does not depend on set order
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+def generate_corpus(n_messages=5000, vocab_size=2000, zipf=1.1, mean_length=12,
+                    n_codes=10, label_density=0.1, code_words=20, seed=0,
+                    **kwargs):
+    """
+    Generate synthetic messages and codes
+
+    :param n_messages: number of messages
+    :param vocab_size: number of distinct words
+    :param zipf: exponent of the Zipf distribution of word frequencies
+    :param mean_length: mean number of words in a message
+    :param n_codes: number of codes
+    :param label_density: probability of each message having each code
+    :param code_words: number of indicative words for each code
+    :param seed: random seed
+    :param kwargs: other settings are ignored (so a whole config can be passed)
+
+    :return: list of messages, boolean matrix of codes [num_messages, num_codes]
+    """
+    rng = np.random.default_rng(seed)
+    vocab = np.array(make_vocabulary(vocab_size, rng), dtype=object)
+    prob = 1 / np.arange(1, vocab_size + 1) ** zipf
+    prob /= prob.sum()
+    codes = rng.random((n_messages, n_codes)) < label_density
+    # Indicative words are taken from the less frequent half of the vocabulary
+    indicative = rng.choice(np.arange(vocab_size // 2, vocab_size),
+                            size=(n_codes, code_words))
+    lengths = rng.poisson(mean_length - 1, n_messages) + 1
+    words = vocab[rng.choice(vocab_size, size=lengths.sum(), p=prob)]
+    ends = np.cumsum(lengths)
+    msgs = []
+    for i, end in enumerate(ends):
+        msg = list(words[end - lengths[i]:end])
+        for k in np.flatnonzero(codes[i]):
+            msg.insert(rng.integers(len(msg) + 1),
+                       vocab[indicative[k, rng.integers(code_words)]])
+        msgs.append(' '.join(msg))
+    return msgs, codes
+
+
+def add_noise(msgs, noise=0.3, seed=0):
+    """
+    Add spelling variation to messages, as found in SMS
+
+    :param msgs: list of messages
+    :param noise: probability of each word being changed
+    :param seed: random seed
+
+    :return: list of messages
+    """
+    rng = np.random.default_rng(seed)
+    res = []
+    for msg in msgs:
+        words = msg.split()
+        for i in np.flatnonzero(rng.random(len(words)) < noise):
+            word = words[i]
+            change = rng.integers(5)
+            if change == 0:
+                word = word.capitalize() if rng.random() < 0.5 else word.upper()
+            elif change == 1:
+                word += PUNCTUATION[rng.integers(len(PUNCTUATION))]
+            elif change == 2:
+                j = rng.integers(len(word))
+                word = word[:j] + word[j] * int(rng.integers(2, 4)) + word[j + 1:]
+            elif change == 3:
+                word = word.replace('x', 'h').replace('c', "'")
+            else:
+                # Long vowels written with one letter
+                word = word.replace('aa', 'a').replace('ii', 'i').replace('oo', 'o')
+            words[i] = word
+        res.append(' '.join(words))
+    return res
+
+
+def measure(function, memory=True):
+    """
+    Time a function, and optionally find its peak memory use
+    (the function is run a second time under tracemalloc, which slows it down)
+
+    :param function: function with no arguments
+    :param memory: whether to measure memory
+
+    :return: result of the function, seconds, peak bytes allocated (or None)
+    """
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def measure_imports(modules=IMPORT_MODULES, repeat=3, verbose=True):
+    """
+    Time importing each module in a fresh interpreter, and find which slow
+    dependencies the import loads
+
+    :param modules: names of modules (in this directory)
+    :param repeat: number of times to import each module (the fastest is kept)
+    :param verbose: whether to print each result as it is found
+
+    :return: list of dicts with the module name, seconds, and loaded dependencies
+    """
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'print(time.perf_counter() - start)\n'
+            'print(" ".join(m for m in {!r} if m in sys.modules))')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, '-c', code.format(module, HEAVY_MODULES)],
+                                 cwd=directory, capture_output=True, text=True,
+                                 check=True).stdout.split('\n')
+            times.append(float(out[0]))
+        results.append({'module': module, 'seconds': min(times), 'loads': out[1].split()})
+        if verbose:
+            print('import {:<30}{:>10.4f} s   {}'.format(module, min(times), ' '.join(results[-1]['loads'])))
+    return results
+
+
+def git_commit():
+    """
+    :return: hash of the current git commit, or None if it cannot be found
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(config=None, memory=True, verbose=True, imports=True):
+    """
+    Run all benchmarks
+
+    :param config: dict of settings, overriding DEFAULT_CONFIG
+    :param memory: whether to measure peak memory of each stage
+    :param verbose: whether to print each result as it is found
+    :param imports: whether to measure import times
+
+    :return: dict of results, which can be saved as JSON
+    """
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    results = []
+
+    def stage(name, function, items):
+        result, seconds, peak = measure(function, memory)
+        results.append({'stage': name, 'seconds': seconds, 'items': items,
+                        'per_second': items / seconds if seconds else None,
+                        'peak_bytes': peak})
+        if verbose:
+            print('{:<40}{:>10.4f} s{:>14.0f} /s{}'.format(
+                name, seconds, results[-1]['per_second'] or 0,
+                '' if peak is None else '{:>10.1f} MB'.format(peak / 2**20)))
+        return result
+
+    msgs, codes = stage('generate', lambda: generate_corpus(**config),
+                        config['n_messages'])
+    M = len(msgs)
+
+    # Feature extraction
+    extractors = [
+        ('bag_of_words', bag_of_words),
+        ('bag_of_ngrams(2)', lambda m: bag_of_ngrams(m, 2)),
+        ('bag_of_character_ngrams(3)', lambda m: bag_of_character_ngrams(m, 3)),
+        ('bag_of_variable_character_ngrams(2, 4)',
+         lambda m: bag_of_variable_character_ngrams(m, 2, 4)),
+    ]
+    for name, extractor in extractors:
+        stage(name, lambda: [extractor(m) for m in msgs], M)
+    extractor = combine([bag_of_words, bag_of_ngrams], [(), (2,)])
+    bags = stage('combine(words, ngrams(2))', lambda: [extractor(m) for m in msgs], M)
+
+    # Vectorisation (dense vectors only use single words, to bound their size)
+    word_bags = [bag_of_words(m) for m in msgs]
+    _, word_dict = feature_list_and_dict(document_frequency(word_bags))
+    stage('vectorise (dense, words)', lambda: vectorise(word_bags, word_dict), M)
+    feat_freq = stage('document_frequency', lambda: document_frequency(bags), M)
+    feat_list, feat_dict = feature_list_and_dict(feat_freq)
+    features = stage('vectorise_sparse', lambda: vectorise_sparse(bags, feat_dict, 'float64'), M)
+
+    # Training and prediction, on a held-out split
+    n_test = int(M * config['test_fraction'])
+    n_train = M - n_test
+    classifiers = stage('logistic.train', lambda: train(features[:n_train], codes[:n_train],
+                                                        penalty='l2'), n_train)
+    test = features[n_train:]
+    prob = stage('predict_prob (models)', lambda: predict_prob(classifiers, test), n_test)
+    with tempfile.TemporaryDirectory() as path:
+        save_bundle(path, classifiers, [str(k) for k in range(codes.shape[1])], feat_list)
+        bundle = load_bundle(path)
+        stage('predict_prob (bundle)', lambda: bundle.predict_prob(test), n_test)
+        pred = predict(bundle, test)
+
+    # Single precision: the same stages in float32 (and counts in uint16),
+    # checking that predictions stay consistent with float64
+    stage('vectorise (dense, words, float32)', lambda: vectorise(word_bags, word_dict, 'float32'), M)
+    stage('vectorise (dense, words, uint16)', lambda: vectorise(word_bags, word_dict, 'uint16'), M)
+    features32 = stage('vectorise_sparse (float32)',
+                       lambda: vectorise_sparse(bags, feat_dict, 'float32'), M)
+    classifiers32 = stage('logistic.train (float32)',
+                          lambda: train(features32[:n_train], codes[:n_train], penalty='l2'), n_train)
+    test32 = features32[n_train:]
+    stage('predict_prob (models, float32)', lambda: predict_prob(classifiers32, test32), n_test)
+    with tempfile.TemporaryDirectory() as path:
+        save_bundle(path, classifiers32, [str(k) for k in range(codes.shape[1])], feat_list,
+                    dtype='float32')
+        bundle32 = load_bundle(path)
+        stage('predict_prob (bundle, float32)', lambda: bundle32.predict_prob(test32), n_test)
+    # The timed stages use sklearn's default tolerance, at which the two types
+    # stop at different points, so compare retrained models that both converge
+    float32 = compare_predictions(features, features32, codes, n_train)
+    float32['failures'] = failures(float32)
+    if verbose:
+        print('float32: {} probabilities, max difference {:.2e}, {:.4%} of predictions agree '
+              '(tol {}, max_iter {})'.format(float32['prob_dtype'], float32['max_prob_difference'],
+                                             float32['prediction_agreement'], float32['tol'],
+                                             float32['max_iter']))
+        for failure in float32['failures']:
+            print('Failed:', failure)
+
+    # Normalisation: extraction, and the rest of the pipeline up to training,
+    # with and without normalising messages with spelling variation
+    noisy = add_noise(msgs, config['noise'], config['seed'])
+
+    def pipeline(extractor):
+        noisy_bags = [extractor(m) for m in noisy]
+        noisy_list, noisy_dict = feature_list_and_dict(document_frequency(noisy_bags))
+        noisy_features = vectorise_sparse(noisy_bags, noisy_dict, 'float64')
+        train(noisy_features[:n_train], codes[:n_train], penalty='l2')
+        return len(noisy_list)
+
+    stage('bag_of_words (noisy)', lambda: [bag_of_words(m) for m in noisy], M)
+    # A new extractor for each run, so that its cache starts empty
+    stage('normalise(bag_of_words) (noisy)',
+          lambda: [e(m) for e in [normalise(bag_of_words)] for m in noisy], M)
+    normaliser = normalise(bag_of_words)
+    for m in noisy:
+        normaliser(m)
+    raw_size = stage('pipeline (noisy)', lambda: pipeline(bag_of_words), M)
+    normalised_size = stage('pipeline (noisy, normalised)',
+                            lambda: pipeline(normalise(bag_of_words)), M)
+    cache = normaliser.cache_info()
+    normalisation = {'raw_words': raw_size, 'normalised_words': normalised_size,
+                     'clean_words': len(word_dict),
+                     'cache_hits': cache.hits, 'cache_misses': cache.misses}
+    if verbose:
+        print('vocabulary: {} noisy words, {} after normalising ({:.1f}%), {} without noise'.format(
+            raw_size, normalised_size, 100 * normalised_size / raw_size, len(word_dict)))
+        print('normalisation cache: {:.1f}% hits'.format(
+            100 * cache.hits / (cache.hits + cache.misses)))
+
+    # Active learning and evaluation
+    scores = entropy(prob)
+    stage('active.top_N', lambda: top_N(scores, config['top_n']), config['top_n'])
+    gold = codes[n_train:]
+    code_names = [str(k) for k in range(codes.shape[1])]
+    stage('evaluate_all', lambda: evaluate_all(pred, gold, code_names, verbose=False), n_test)
+    if config['n_resamples']:
+        stage('evaluate_all (bootstrap)',
+              lambda: evaluate_all(pred, gold, code_names, verbose=False,
+                                   n_resamples=config['n_resamples']),
+              config['n_resamples'])
+
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'config': config,
+        'num_features': len(feat_list),
+        'normalisation': normalisation,
+        'float32': float32,
+        'max_rss_bytes': max_rss(),
+        'stages': results,
+        'imports': measure_imports(verbose=verbose) if imports else [],
+    }
+
+
+def save_results(results, directory='../data/benchmarks'):
+    """
+    Save benchmark results as JSON, named by time and commit
+
+    :param results: dict returned by run
+    :param directory: directory to save to (created if necessary)
+
+    :return: path of the saved file
+    """
+    os.makedirs(directory, exist_ok=True)
+    filename = '{}_{}.json'.format(results['time'].replace(':', ''),
+                                   results['commit'] or 'unknown')
+    path = os.path.join(directory, filename)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+def compare(old, new):
+    """
+    Print the change in time and memory of each stage between two runs
+
+    :param old: dict of results (or path to a JSON file)
+    :param new: dict of results (or path to a JSON file)
+    """
+    def load(results):
+        if isinstance(results, str):
+            with open(results) as f:
+                return json.load(f)
+        return results
+
+    old, new = load(old), load(new)
+    # Settings added since the old run are not counted as differences
+    if any(old['config'][k] != v for k, v in new['config'].items() if k in old['config']):
+        print('Warning: the runs used different settings')
+    print('{:<40}{:>10}{:>10}{:>8}{:>10}{:>10}'.format(
+        'stage', old['commit'] or '?', new['commit'] or '?', 'ratio', 'old MB', 'new MB'))
+    old_stages = {r['stage']: r for r in old['stages']}
+    for r in new['stages']:
+        if r['stage'] not in old_stages:
+            continue
+        o = old_stages[r['stage']]
+        mb = ['' if x['peak_bytes'] is None else '{:.1f}'.format(x['peak_bytes'] / 2**20)
+              for x in (o, r)]
+        print('{:<40}{:>10.4f}{:>10.4f}{:>8.2f}{:>10}{:>10}'.format(
+            r['stage'], o['seconds'], r['seconds'],
+            r['seconds'] / o['seconds'] if o['seconds'] else float('nan'), *mb))
+    old_imports = {r['module']: r['seconds'] for r in old.get('imports', [])}
+    for r in new.get('imports', []):
+        if r['module'] in old_imports:
+            o = old_imports[r['module']]
+            print('{:<40}{:>10.4f}{:>10.4f}{:>8.2f}'.format(
+                'import ' + r['module'], o, r['seconds'], r['seconds'] / o if o else float('nan')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic data')
+    for name, default in DEFAULT_CONFIG.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not measure peak memory (faster)')
+    parser.add_argument('--output', default='../data/benchmarks',
+                        help='directory to save results to')
+    parser.add_argument('--no-imports', action='store_true',
+                        help='do not measure import times')
+    parser.add_argument('--imports-only', action='store_true',
+                        help='only measure import times')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='earlier results to compare against')
+    args = parser.parse_args()
+
+    if args.imports_only:
+        measure_imports()
+        return
+    config = {name: getattr(args, name) for name in DEFAULT_CONFIG}
+    results = run(config, memory=not args.no_memory, imports=not args.no_imports)
+    print('Saved to', save_results(results, args.output))
+    if args.compare:
+        compare(args.compare, results)
+    if results['float32']['failures']:
+        sys.exit('float32 predictions differ from float64: ' + '; '.join(results['float32']['failures']))
+
+
+if __name__ == "__main__":
+    # e.g. python benchmark.py --n-messages 20000 --compare ../data/benchmarks/<earlier run>.json
+    main()
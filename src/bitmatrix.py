@@ -0,0 +1,145 @@
+import numpy as np
+from scipy import sparse
+
+# Boolean matrices stored with one bit per cell, rather than one byte
+# Each row is packed into bytes with np.packbits (using little-endian bit
+# order, so that column k is bit k % 8 of byte k // 8). This is used for
+# matrices of codes, which can have many messages and hundreds of codes.
+
+# Number of rows to unpack at once, to keep temporary arrays small
+CHUNK_ROWS = 2**16
+
+# Number of bits set in each possible byte
+POPCOUNT = np.unpackbits(np.arange(256, dtype='uint8')[:, None], axis=1).sum(1)
+
+
+class BitMatrix:
+    """
+    Packed boolean matrix, of shape [num_rows, num_columns]
+    It supports the operations needed for matrices of codes:
+    - matrix[:, k] (column k, as a boolean array)
+    - matrix[i] (row i, as a boolean array), and iterating over rows
+    - matrix.sum(0) (number of True values in each column)
+    """
+    def __init__(self, matrix, num_columns=None):
+        """
+        :param matrix: boolean matrix (numpy array, scipy sparse matrix,
+        or BitMatrix), or a uint8 array of packed rows if num_columns is given
+        :param num_columns: number of columns, if matrix is already packed
+        """
+        if num_columns is not None:
+            self.bits = np.asarray(matrix, dtype='uint8')
+            self.shape = (self.bits.shape[0], num_columns)
+        elif isinstance(matrix, BitMatrix):
+            self.bits = matrix.bits
+            self.shape = matrix.shape
+        elif sparse.issparse(matrix):
+            self.bits, self.shape = pack_sparse(matrix)
+        else:
+            self.bits, self.shape = pack_dense(matrix)
+
+    ndim = 2
+    dtype = np.dtype('bool')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def column(self, k):
+        """
+        :param k: index of column
+        :return: boolean array, of shape [num_rows]
+        """
+        if not -self.shape[1] <= k < self.shape[1]:
+            raise IndexError('column index out of range')
+        k %= self.shape[1]
+        return (self.bits[:, k // 8] >> (k % 8)) & 1 == 1
+
+    def unpack(self, bits):
+        """
+        :param bits: packed rows
+        :return: boolean array of unpacked rows
+        """
+        return np.unpackbits(bits, axis=-1, count=self.shape[1],
+                             bitorder='little').astype('bool')
+
+    def __getitem__(self, key):
+        """
+        Index either rows (matrix[i], matrix[i:j]) or a column (matrix[:, k])
+        """
+        if isinstance(key, tuple):
+            rows, k = key
+            column = self.column(k)
+            if isinstance(rows, slice) and rows == slice(None):
+                return column
+            return column[rows]
+        return self.unpack(self.bits[key])
+
+    def __iter__(self):
+        for start in range(0, self.shape[0], CHUNK_ROWS):
+            yield from self.unpack(self.bits[start:start + CHUNK_ROWS])
+
+    def counts(self):
+        """
+        :return: number of True values in each column
+        """
+        counts = np.zeros(self.bits.shape[1] * 8, dtype='int64')
+        for b in range(8):
+            counts[b::8] = ((self.bits >> b) & 1).sum(0)
+        return counts[:self.shape[1]]
+
+    def sum(self, axis=None):
+        """
+        Count True values, as for a numpy array
+        :param axis: None (whole matrix), 0 (each column) or 1 (each row)
+        """
+        if axis is None:
+            return int(POPCOUNT[self.bits].sum())
+        if axis == 0:
+            return self.counts()
+        if axis == 1:
+            return POPCOUNT[self.bits].sum(1)
+        raise ValueError('axis must be None, 0 or 1')
+
+    def toarray(self):
+        """
+        :return: boolean numpy array
+        """
+        return self.unpack(self.bits)
+
+    def tocsr(self):
+        """
+        :return: boolean CSR matrix
+        """
+        return sparse.vstack([sparse.csr_matrix(self.unpack(self.bits[start:start + CHUNK_ROWS]))
+                              for start in range(0, max(self.shape[0], 1), CHUNK_ROWS)],
+                             format='csr')
+
+
+def pack_dense(matrix):
+    """
+    Pack a dense boolean matrix
+    :param matrix: array-like, of shape [num_rows, num_columns]
+    :return: packed rows, shape
+    """
+    matrix = np.asarray(matrix)
+    if matrix.ndim != 2:
+        raise ValueError('Matrix must be two-dimensional')
+    bits = np.empty((matrix.shape[0], (matrix.shape[1] + 7) // 8), dtype='uint8')
+    for start in range(0, matrix.shape[0], CHUNK_ROWS):
+        chunk = matrix[start:start + CHUNK_ROWS].astype('bool', copy=False)
+        bits[start:start + CHUNK_ROWS] = np.packbits(chunk, axis=1, bitorder='little')
+    return bits, matrix.shape
+
+
+def pack_sparse(matrix):
+    """
+    Pack a sparse boolean matrix, without converting it to a dense matrix
+    :param matrix: scipy sparse matrix, of shape [num_rows, num_columns]
+    :return: packed rows, shape
+    """
+    matrix = sparse.coo_matrix(matrix)
+    keep = matrix.data != 0
+    rows, cols = matrix.row[keep], matrix.col[keep]
+    bits = np.zeros((matrix.shape[0], (matrix.shape[1] + 7) // 8), dtype='uint8')
+    np.bitwise_or.at(bits, (rows, cols // 8), (1 << (cols % 8)).astype('uint8'))
+    return bits, matrix.shape
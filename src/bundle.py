@@ -0,0 +1,432 @@
+import json
+import os
+import pickle
+import zlib
+import numpy as np
+
+from features import Vectoriser
+from instrument import timed
+
+# A model bundle is a directory containing:
+# - meta.json: format version, code names, number of features, and (for
+#   bundles converted by load_model) the size and time of the source files
+# - coef.npy, intercept.npy: stacked coefficients [K, F] and intercepts [K]
+# - present.npy: which codes have a classifier
+# - vocab_data.npy, vocab_offsets.npy: the feature names, encoded as strings
+#   and concatenated into one UTF-8 table, in the order of feature indices
+# - vocab_table.npy: an open-addressing hash table from names to indices
+# - thresholds.npy (optional): probability threshold for each code
+# - extractor.pkl, weights.npy, weighting.pkl (optional): how to vectorise
+# Arrays are saved with numpy, so they can be memory mapped when loading,
+# and no Python objects need to be built for each feature.
+
+VERSION = 1
+
+# Optional files, removed when a bundle is saved without them
+# (so that a rebuilt bundle does not pick up a stale file from the old one)
+OPTIONAL_FILES = ['thresholds.npy', 'weights.npy', 'extractor.pkl', 'weighting.pkl']
+
+# Maximum number of features whose index is memoised by a Vocabulary
+MEMO_SIZE = 2**18
+
+# Separators used to encode features as strings
+# (a feature is a pair of a kind and either a string or a tuple of strings)
+STRING_SEP = '\x1f'
+TUPLE_SEP = '\x1e'
+
+
+def encode_feature(feat):
+    """
+    Convert a feature to a string
+
+    :param feat: pair (kind, value), where value is a string or tuple of
+    strings, e.g. ('word', 'biyo') or ('ngram', ('biyo', 'nadiif'))
+
+    :return: string
+    """
+    kind, value = feat
+    if isinstance(value, tuple):
+        return kind + TUPLE_SEP + TUPLE_SEP.join(value)
+    return kind + STRING_SEP + value
+
+
+def decode_feature(string):
+    """
+    Convert a string back to a feature (inverse of encode_feature)
+
+    :param string: encoded feature
+
+    :return: pair (kind, value)
+    """
+    i = min(j for j in (string.find(STRING_SEP), string.find(TUPLE_SEP))
+            if j >= 0)
+    kind, sep, rest = string[:i], string[i], string[i + 1:]
+    if sep == TUPLE_SEP:
+        return kind, tuple(rest.split(TUPLE_SEP))
+    return kind, rest
+
+
+def feature_hash(data):
+    """
+    Hash an encoded feature (stable across processes, unlike hash())
+
+    :param data: bytes
+
+    :return: non-negative integer
+    """
+    return zlib.crc32(data)
+
+
+def build_table(encoded):
+    """
+    Build an open-addressing hash table (with linear probing)
+
+    :param encoded: list of encoded features, as bytes
+
+    :return: int64 array, with each slot either -1 or a feature index
+    """
+    # Keep the table at most half full
+    size = 1
+    while size < 2 * len(encoded):
+        size *= 2
+    mask = size - 1
+    table = np.full(size, -1, dtype='int64')
+    for i, data in enumerate(encoded):
+        slot = feature_hash(data) & mask
+        while table[slot] != -1:
+            slot = (slot + 1) & mask
+        table[slot] = i
+    return table
+
+
+class Vocabulary:
+    """
+    Read-only mapping from features to indices, stored as a string table and
+    hash index. It can be used in place of a feature_dict.
+    Lookups of features in the vocabulary are memoised (up to MEMO_SIZE of
+    them), since the same features recur in many messages. Features not in the
+    vocabulary are not memoised, since there is no limit to how many can be
+    seen (e.g. by a long-running service).
+    """
+    def __init__(self, data, offsets, table):
+        """
+        :param data: uint8 array of concatenated encoded features
+        :param offsets: int64 array of start positions in data (length F + 1)
+        :param table: hash table from build_table
+        """
+        self.data = data
+        self.offsets = offsets
+        self.table = table
+        self.mask = len(table) - 1
+        self.memo = {}
+
+    def encoded(self, i):
+        """
+        :param i: feature index
+        :return: encoded feature name, as bytes
+        """
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def feature(self, i):
+        """
+        :param i: feature index
+        :return: feature
+        """
+        return decode_feature(self.encoded(i).decode('utf8'))
+
+    def lookup(self, feat):
+        """
+        :param feat: feature
+        :return: index of feature, or -1 if it is not in the vocabulary
+        """
+        index = self.memo.get(feat)
+        if index is not None:
+            return index
+        try:
+            data = encode_feature(feat).encode('utf8')
+        except (TypeError, ValueError):
+            return -1
+        slot = feature_hash(data) & self.mask
+        index = -1
+        while self.table[slot] != -1:
+            i = int(self.table[slot])
+            if self.encoded(i) == data:
+                index = i
+                break
+            slot = (slot + 1) & self.mask
+        if index >= 0:
+            if len(self.memo) >= MEMO_SIZE:
+                # Forget the oldest lookup
+                del self.memo[next(iter(self.memo))]
+            self.memo[feat] = index
+        return index
+
+    def get(self, feat, default=None):
+        i = self.lookup(feat)
+        return default if i < 0 else i
+
+    def __getitem__(self, feat):
+        i = self.lookup(feat)
+        if i < 0:
+            raise KeyError(feat)
+        return i
+
+    def __contains__(self, feat):
+        return self.lookup(feat) >= 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def feature_list(self):
+        """
+        :return: list of all features, in order of their indices
+        """
+        return [self.feature(i) for i in range(len(self))]
+
+    def __iter__(self):
+        return iter(self.feature_list())
+
+    def items(self):
+        return zip(self.feature_list(), range(len(self)))
+
+
+def vocabulary_arrays(feature_list):
+    """
+    Encode a list of features as a string table and hash index
+
+    :param feature_list: list of features, in order of their indices
+
+    :return: data, offsets, table (see Vocabulary)
+    """
+    encoded = [encode_feature(f).encode('utf8') for f in feature_list]
+    offsets = np.zeros(len(encoded) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([len(x) for x in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype='uint8')
+    return data, offsets, build_table(encoded)
+
+
+class ModelBundle:
+    """
+    Logistic regression classifiers for many codes, stored as arrays
+    """
+    def __init__(self, coef, intercept, code_names, present, vocabulary,
+                 thresholds=None, extractor=None, weights=None,
+                 weighting=None):
+        """
+        :param coef: coefficient matrix, of shape [num_codes, num_features]
+        :param intercept: intercept vector, of shape [num_codes]
+        :param code_names: list of names of codes
+        :param present: boolean array, False for codes with no classifier
+        :param vocabulary: Vocabulary (or dict) mapping features to indices
+        :param thresholds: (optional) probability threshold for each code
+        :param extractor: (optional) feature extractor used for training
+        :param weights: (optional) weights used by the Vectoriser
+        :param weighting: (optional) Weighting used by the Vectoriser
+        """
+        self.coef = coef
+        self.intercept = intercept
+        self.code_names = code_names
+        self.present = present
+        self.vocabulary = vocabulary
+        self.thresholds = thresholds
+        self.extractor = extractor
+        self.weights = weights
+        self.weighting = weighting
+
+    def decision_function(self, messages):
+        """
+        :param messages: feature vectors (as a dense or sparse matrix)
+        :return: log-odds for each message and code
+        """
+        return np.asarray(messages @ self.coef.T) + self.intercept
+
+    def predict_prob(self, messages):
+        """
+        :param messages: feature vectors (as a dense or sparse matrix)
+        :return: probability of each code for each message
+        (zero for codes without a classifier)
+        """
+        # scipy is only needed when scoring, so only import it then
+        # (expit does not overflow for large negative decision values)
+        from scipy.special import expit
+        prob = expit(self.decision_function(messages))
+        prob[:, ~self.present] = 0
+        return prob
+
+    def predict(self, messages):
+        """
+        :param messages: feature vectors (as a dense or sparse matrix)
+        :return: boolean array of predictions for each message and code
+        """
+        if self.thresholds is None:
+            pred = self.decision_function(messages) > 0
+        else:
+            pred = self.predict_prob(messages) >= self.thresholds
+        pred[:, ~self.present] = False
+        return pred
+
+    def vectoriser(self):
+        """
+        :return: Vectoriser using the bundle's vocabulary
+        """
+        if self.extractor is None:
+            raise ValueError('No feature extractor was saved with the bundle')
+        return Vectoriser(self.extractor, self.vocabulary, self.weights,
+                          self.weighting)
+
+
+def save_bundle(path, classifiers, code_names, feature_list, thresholds=None,
+                extractor=None, weights=None, weighting=None, dtype=None,
+                sources=None):
+    """
+    Save classifiers and their vocabulary as a model bundle
+
+    :param path: directory to save to (created if necessary)
+    :param classifiers: list of LogisticRegression models (or None)
+    :param code_names: list of names of codes
+    :param feature_list: list of features, in order of their indices
+    :param thresholds: (optional) probability threshold for each code
+    :param extractor: (optional) feature extractor
+    :param weights: (optional) weights used by the Vectoriser
+    :param weighting: (optional) Weighting used by the Vectoriser
+    :param dtype: numpy data type of coefficients (default: as trained)
+    :param sources: (optional) dict describing the files the bundle was built
+    from, stored in meta.json (see load_model)
+    """
+    K = len(classifiers)
+    F = len(feature_list)
+    if len(code_names) != K:
+        raise ValueError('Dimensions do not match')
+    trained = [c for c in classifiers if c is not None]
+    if dtype is None:
+        dtype = trained[0].coef_.dtype if trained else 'float64'
+    # Stack the coefficients
+    coef = np.zeros((K, F), dtype=dtype)
+    intercept = np.zeros(K, dtype=dtype)
+    present = np.zeros(K, dtype='bool')
+    for i, c in enumerate(classifiers):
+        if c is not None:
+            coef[i] = c.coef_.ravel()
+            intercept[i] = c.intercept_[0]
+            present[i] = True
+
+    os.makedirs(path, exist_ok=True)
+    # Remove the metadata first, so a partly overwritten bundle cannot be loaded
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    arrays = dict(zip(['vocab_data', 'vocab_offsets', 'vocab_table'],
+                      vocabulary_arrays(feature_list)))
+    arrays.update(coef=coef, intercept=intercept, present=present)
+    if thresholds is not None:
+        arrays['thresholds'] = np.asarray(thresholds, dtype='float64')
+    if weights is not None:
+        arrays['weights'] = weights
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+    for name, obj in [('extractor', extractor), ('weighting', weighting)]:
+        if obj is not None:
+            with open(os.path.join(path, name + '.pkl'), 'wb') as f:
+                pickle.dump(obj, f)
+    written = {name + '.npy' for name in arrays}
+    written.update(name + '.pkl' for name, obj in [('extractor', extractor), ('weighting', weighting)]
+                   if obj is not None)
+    for filename in OPTIONAL_FILES:
+        if filename not in written and os.path.exists(os.path.join(path, filename)):
+            os.remove(os.path.join(path, filename))
+    # Write the metadata last, so an incomplete bundle cannot be loaded
+    meta = {'version': VERSION, 'code_names': list(code_names), 'num_features': F}
+    if sources is not None:
+        meta['sources'] = sources
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+
+
+def load_bundle(path, mmap=True):
+    """
+    Load a model bundle
+
+    :param path: directory of the bundle
+    :param mmap: whether to memory map arrays, rather than reading them
+
+    :return: ModelBundle
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] > VERSION:
+        raise ValueError('Bundle version {} is not supported'
+                         .format(meta['version']))
+    mmap_mode = 'r' if mmap else None
+
+    def load(name):
+        filename = os.path.join(path, name + '.npy')
+        if os.path.exists(filename):
+            return np.load(filename, mmap_mode=mmap_mode)
+
+    def unpickle(name):
+        filename = os.path.join(path, name + '.pkl')
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+
+    vocabulary = Vocabulary(load('vocab_data'), load('vocab_offsets'),
+                            load('vocab_table'))
+    return ModelBundle(load('coef'), load('intercept'), meta['code_names'],
+                       np.asarray(load('present')), vocabulary,
+                       load('thresholds'), unpickle('extractor'),
+                       load('weights'), unpickle('weighting'))
+
+
+def file_signature(filename):
+    """
+    :param filename: path to file
+    :return: modification time (in nanoseconds) and size of the file
+    """
+    info = os.stat(filename)
+    return [info.st_mtime_ns, info.st_size]
+
+
+@timed('bundle.load_model')
+def load_model(dataset, classifier_suffix, code_suffix='codes',
+               feature_suffix='features', directory='../data'):
+    """
+    Load classifiers as a model bundle, converting them from pickled files
+    the first time (see postprocess.display for the file names used)
+    The bundle is converted again whenever any of the pickled files has
+    changed since (e.g. after retraining), or if it does not record them,
+    and any thresholds stored in the
+    old bundle are then removed, since they were chosen for the old model.
+
+    :param dataset: name of the dataset
+    :param classifier_suffix: suffix of the classifier file
+    :param code_suffix: suffix of the code file (default 'codes')
+    :param feature_suffix: suffix of the feature file (default 'features')
+    :param directory: directory of data files (default ../data)
+
+    :return: ModelBundle
+    """
+    path = os.path.join(directory,
+                        '{}_{}.bundle'.format(dataset, classifier_suffix))
+    filenames = ['{}_{}.pkl'.format(dataset, suffix)
+                 for suffix in [classifier_suffix, code_suffix, feature_suffix]]
+    sources = {filename: file_signature(os.path.join(directory, filename))
+               for filename in filenames}
+    meta_file = os.path.join(path, 'meta.json')
+    meta = None
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+    if meta is None or meta.get('sources') != sources:
+        loaded = []
+        for filename in filenames:
+            with open(os.path.join(directory, filename), 'rb') as f:
+                loaded.append(pickle.load(f))
+        classifiers, codes, feats = loaded
+        save_bundle(path, classifiers, [x for x, _ in codes],
+                    [x for x, _ in feats], sources=sources)
+    return load_bundle(path)
+
+
+if __name__ == "__main__":
+    # Convert pickled classifiers to a bundle
+    load_model('wash_s04', 'C1')
@@ -0,0 +1,118 @@
+import sys
+import numpy as np
+
+from features import (bag_of_words, bag_of_ngrams, combine, document_frequency,
+                      feature_list_and_dict, vectorise, vectorise_sparse)
+from logistic import train, predict_prob
+
+# Check that single precision gives the same predictions as double precision
+# Synthetic messages (from benchmark.py, with a fixed seed) are vectorised,
+# classifiers are trained, and probabilities are predicted, once in float64
+# and once in float32, and the predictions are compared.
+# With sklearn's default tolerance, the optimiser stops at slightly different
+# points for the two types, which alone moves probabilities by around 1e-2, so
+# both are trained with the same smaller tol and larger max_iter, and what is
+# left is the difference due to precision.
+# Run this after changing anything that dtypes are passed through, e.g.
+#     python check_float32.py
+# which exits with a non-zero status if a check fails.
+
+# Limits for the checks
+MIN_AGREEMENT = 0.999
+MAX_PROB_DIFFERENCE = 5e-3
+
+# Optimiser settings used for both types
+TOL = 1e-6
+MAX_ITER = 1000
+
+
+def compare_predictions(features, features32, codes, n_train, tol=TOL, max_iter=MAX_ITER):
+    """
+    Train and predict with float64 and float32 features, and compare the results
+
+    :param features: float64 feature vectors
+    :param features32: the same feature vectors, in float32
+    :param codes: boolean matrix of codes
+    :param n_train: number of messages to train on (the rest are predicted)
+    :param tol: tolerance for stopping the optimiser (see logistic.train)
+    :param max_iter: maximum number of iterations of the optimiser
+
+    :return: dict of the float32 probabilities' type, the largest difference
+    between probabilities, the proportion of predictions (at 0.5) that agree,
+    and the optimiser settings
+    """
+    probs = []
+    for feats in (features, features32):
+        classifiers = train(feats[:n_train], codes[:n_train], penalty='l2',
+                            tol=tol, max_iter=max_iter)
+        probs.append(predict_prob(classifiers, feats[n_train:]))
+    prob, prob32 = probs
+    return {'prob_dtype': str(prob32.dtype),
+            'max_prob_difference': float(np.abs(prob32 - prob).max()),
+            'prediction_agreement': float(((prob32 > 0.5) == (prob > 0.5)).mean()),
+            'tol': tol,
+            'max_iter': max_iter}
+
+
+def failures(comparison):
+    """
+    :param comparison: result of compare_predictions
+
+    :return: list of descriptions of failed checks (empty if all passed)
+    """
+    failed = []
+    if comparison['prob_dtype'] != 'float32':
+        failed.append('float32 probabilities have type {}'.format(comparison['prob_dtype']))
+    if comparison['prediction_agreement'] < MIN_AGREEMENT:
+        failed.append('only {:.4%} of predictions agree'.format(comparison['prediction_agreement']))
+    if comparison['max_prob_difference'] > MAX_PROB_DIFFERENCE:
+        failed.append('probabilities differ by up to {:.2e}'.format(comparison['max_prob_difference']))
+    return failed
+
+
+def check(n_messages=2000, test_fraction=0.2, seed=0):
+    """
+    Check float32 against float64 on synthetic messages, and check that
+    counts which do not fit in uint16 are rejected
+
+    :param n_messages: number of synthetic messages
+    :param test_fraction: proportion of messages to predict
+    :param seed: random seed
+
+    :return: result of compare_predictions
+    """
+    # benchmark imports many modules, so only import it when needed
+    from benchmark import generate_corpus
+    msgs, codes = generate_corpus(n_messages, seed=seed)
+    extractor = combine([bag_of_words, bag_of_ngrams], [(), (2,)])
+    bags = [extractor(m) for m in msgs]
+    _, feat_dict = feature_list_and_dict(document_frequency(bags))
+    comparison = compare_predictions(vectorise_sparse(bags, feat_dict, 'float64'),
+                                     vectorise_sparse(bags, feat_dict, 'float32'),
+                                     codes, n_messages - int(n_messages * test_fraction))
+    failed = failures(comparison)
+    assert not failed, '; '.join(failed)
+
+    # Integer counts must not silently wrap around
+    bag = bags[0].copy()
+    feat = next(iter(bag))
+    bag[feat] = np.iinfo('uint16').max + 1
+    try:
+        vectorise([bag], feat_dict, 'uint16')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('a count of {} was stored in uint16'.format(bag[feat]))
+    return comparison
+
+
+if __name__ == "__main__":
+    try:
+        result = check()
+    except AssertionError as e:
+        print('Failed:', e)
+        sys.exit(1)
+    print('float32: {} probabilities, max difference {:.2e}, {:.4%} of predictions agree '
+          '(tol {}, max_iter {})'.format(result['prob_dtype'], result['max_prob_difference'],
+                                         result['prediction_agreement'], result['tol'],
+                                         result['max_iter']))
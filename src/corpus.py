@@ -0,0 +1,244 @@
+import csv
+import hashlib
+import os
+import pickle
+from collections import Counter, namedtuple
+from multiprocessing import Pool
+
+from instrument import timed
+
+# Corpus statistics, calculated in parallel and cached per input file
+# Files are processed by separate workers, and large files can be split into
+# byte ranges, each processed by a separate worker.
+# Partial statistics are then merged pairwise (a tree reduction).
+
+Statistics = namedtuple('Statistics', ['doc_freq', 'term_freq', 'n_messages'])
+
+
+def empty_statistics():
+    """
+    :return: Statistics for an empty corpus
+    """
+    return Statistics(Counter(), Counter(), 0)
+
+
+def merge_statistics(a, b):
+    """
+    Combine the statistics of two disjoint parts of a corpus
+
+    :param a: Statistics
+    :param b: Statistics
+
+    :return: combined Statistics
+    """
+    doc_freq = a.doc_freq.copy()
+    doc_freq.update(b.doc_freq)
+    term_freq = a.term_freq.copy()
+    term_freq.update(b.term_freq)
+    return Statistics(doc_freq, term_freq, a.n_messages + b.n_messages)
+
+
+def _merge_pair(pair):
+    """
+    Merge a pair of Statistics (for use with Pool.map)
+    """
+    return merge_statistics(*pair)
+
+
+def tree_reduce(parts, pool=None):
+    """
+    Merge partial statistics pairwise, level by level
+
+    :param parts: list of Statistics
+    :param pool: (optional) multiprocessing Pool, to merge pairs in parallel
+
+    :return: combined Statistics
+    """
+    if not parts:
+        return empty_statistics()
+    while len(parts) > 1:
+        pairs = list(zip(parts[::2], parts[1::2]))
+        if pool is not None and len(pairs) > 1:
+            merged = pool.map(_merge_pair, pairs)
+        else:
+            merged = [merge_statistics(a, b) for a, b in pairs]
+        # An odd part out is carried to the next level
+        if len(parts) % 2:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+
+def count_bags(bags):
+    """
+    Find document frequencies, term frequencies, and the number of messages
+
+    :param bags: iterable of bags of features
+
+    :return: Statistics
+    """
+    stats = empty_statistics()
+    n = 0
+    for bag in bags:
+        stats.doc_freq.update(bag.keys())
+        stats.term_freq.update(bag)
+        n += 1
+    return stats._replace(n_messages=n)
+
+
+def byte_ranges(path, chunk_bytes):
+    """
+    Split a file into byte ranges of roughly equal size
+
+    :param path: path to file
+    :param chunk_bytes: approximate size of each range, or None for one range
+
+    :return: list of (start, end) pairs
+    """
+    size = os.path.getsize(path)
+    if not chunk_bytes or size <= chunk_bytes:
+        return [(0, size)]
+    starts = list(range(0, size, chunk_bytes))
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def read_range(path, start, end):
+    """
+    Read the lines of a file that begin within a byte range
+    (so that adjacent ranges never share or split a line)
+
+    :param path: path to file
+    :param start: first byte of range
+    :param end: byte after the end of range
+
+    :return: iterator yielding lines (as strings), excluding the heading line
+    (the file is read one line at a time, so the range can be a whole file)
+    """
+    with open(path, 'rb') as f:
+        if start == 0:
+            # Ignore headings
+            f.readline()
+        else:
+            # Skip to the first line beginning at or after start
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf8')
+
+
+def _range_statistics(task):
+    """
+    Calculate statistics for one byte range of a file
+    (for use with Pool.map)
+
+    :param task: tuple of (path, start, end, extractor, text_col)
+
+    :return: Statistics
+    """
+    path, start, end, extractor, text_col = task
+    reader = csv.reader(read_range(path, start, end))
+    return count_bags(extractor(row[text_col]) for row in reader)
+
+
+def cache_key(path, extractor, text_col):
+    """
+    Identify the statistics of a file, so that they can be reused as long
+    as the file and the extractor are unchanged
+
+    :param path: path to file
+    :param extractor: function mapping strings to bags of features
+    :param text_col: index of column containing text
+
+    :return: tuple of file modification time, file size, and a hash of the
+    extractor and text column
+    """
+    info = os.stat(path)
+    config = hashlib.sha1(pickle.dumps((extractor, text_col))).hexdigest()
+    return info.st_mtime_ns, info.st_size, config
+
+
+@timed('corpus.corpus_statistics')
+def corpus_statistics(input_files, extractor, directory='../data', text_col=0,
+                      processes=1, chunk_bytes=None, cache_dir=None):
+    """
+    Calculate document frequencies, term frequencies and message counts for
+    many csv files, in parallel
+
+    :param input_files: single filename, or list of filenames (without .csv
+    file extension)
+    :param extractor: function mapping strings to bags of features
+    (if processes is not 1, this must be picklable, e.g. an Extractor object
+    or a module-level function, not a lambda or closure)
+    :param directory: directory of data files (default ../data)
+    :param text_col: index of column containing text (default 0)
+    :param processes: number of worker processes (default 1, meaning no
+    worker processes are started; None means the number of CPUs)
+    :param chunk_bytes: if given, split files larger than this into byte
+    ranges, processed separately
+    - this requires each message to be on one line (no newlines inside
+    quoted fields)
+    :param cache_dir: if given, save the statistics of each file here, and
+    reuse them if the file and extractor have not changed
+
+    :return: combined Statistics, dict mapping filenames to Statistics
+    """
+    # If only one file is given, convert to a list
+    if isinstance(input_files, str):
+        input_files = [input_files]
+
+    # Load cached statistics where possible
+    per_file = {}
+    keys = {}
+    for filename in input_files:
+        path = os.path.join(directory, filename + '.csv')
+        if cache_dir is None:
+            continue
+        keys[filename] = cache_key(path, extractor, text_col)
+        cache_file = os.path.join(cache_dir, filename + '_stats.pkl')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                key, stats = pickle.load(f)
+            if key == keys[filename]:
+                per_file[filename] = stats
+
+    # Split the remaining files into tasks
+    tasks = []
+    owners = []
+    for filename in input_files:
+        if filename in per_file:
+            continue
+        path = os.path.join(directory, filename + '.csv')
+        for start, end in byte_ranges(path, chunk_bytes):
+            tasks.append((path, start, end, extractor, text_col))
+            owners.append(filename)
+
+    # Process tasks, and merge the results for each file
+    pool = Pool(processes) if processes != 1 and len(tasks) > 1 else None
+    try:
+        if pool is not None:
+            results = pool.map(_range_statistics, tasks)
+        else:
+            results = [_range_statistics(t) for t in tasks]
+        for filename in input_files:
+            if filename in per_file:
+                continue
+            parts = [r for r, o in zip(results, owners) if o == filename]
+            per_file[filename] = tree_reduce(parts, pool)
+            # Save to the cache
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                cache_file = os.path.join(cache_dir, filename + '_stats.pkl')
+                with open(cache_file, 'wb') as f:
+                    pickle.dump((keys[filename], per_file[filename]), f)
+
+        # Combine all files
+        total = tree_reduce([per_file[x] for x in input_files], pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return total, per_file
@@ -1,6 +1,8 @@
 import os
-from sklearn.metrics import precision_recall_fscore_support
-import pandas
+import numpy as np
+
+# pandas and sklearn are slow to import, so they are only imported by the
+# functions that need them
 
 
 def evaluate(pred, gold, code, filename, verbose=True):
@@ -13,6 +15,7 @@ def evaluate(pred, gold, code, filename, verbose=True):
     :return: accuracy, precision, recall, F1 (each as an array)
     """
 
+    from sklearn.metrics import precision_recall_fscore_support
     precision, recall, fscore, support = precision_recall_fscore_support(gold, pred, average='binary')
 
     if verbose:
@@ -26,6 +29,7 @@ def evaluate(pred, gold, code, filename, verbose=True):
 
 
 def get_prediction_and_gold_vector(prediction_filename, prediction_codename, gold_filename, gold_codename):
+    import pandas
     gold_df = pandas.read_csv(gold_filename)
     gold_df.fillna(value=0, inplace=True)
     gold_df = gold_df.drop_duplicates(subset='ID')
@@ -66,20 +70,176 @@ def get_prediction_and_gold_vector(prediction_filename, prediction_codename, gol
     return predictions_vector, golds_vector
 
 
+def read_code_names(filename, directory='../data'):
+    """
+    Read the names of codes from a text file, with one code per line
+    (optionally followed by a tab and further information, as in the
+    _codes.txt files saved by preprocess)
+    :param filename: name of file (without .txt file extension)
+    :param directory: directory of data files (default ../data)
+    :return: list of code names
+    """
+    with open(os.path.join(directory, filename + '.txt')) as f:
+        return [line.split('\t')[0].strip() for line in f if line.strip()]
+
+
+def load_aligned(prediction_filename, gold_filename, codes, gold_codes=None):
+    """
+    Read predictions and gold standard annotations once, and align them by ID
+    Only predicted messages (not training messages) are kept.
+    :param prediction_filename: csv file of predictions (with ID and source columns)
+    :param gold_filename: csv file of verified annotations (with ID column)
+    :param codes: names of code columns in the prediction file
+    :param gold_codes: names of code columns in the gold file (default same as codes)
+    :return: prediction matrix, gold matrix (boolean, shape [num_messages, num_codes])
+    """
+    if gold_codes is None:
+        gold_codes = codes
+    import pandas
+    gold_df = pandas.read_csv(gold_filename, usecols=['ID'] + list(gold_codes))
+    gold_df.fillna(value=0, inplace=True)
+    gold_df = gold_df.drop_duplicates(subset='ID')
+
+    prediction_df = pandas.read_csv(prediction_filename, usecols=['ID', 'source'] + list(codes))
+    prediction_df.fillna(value=0, inplace=True)
+    prediction_df = prediction_df.drop_duplicates(subset='ID')
+    # if training data was included in verification, exclude
+    prediction_df = prediction_df[prediction_df['source'] == 'prediction']
+
+    # align dataframes, keeping only messages in both
+    merged = prediction_df.merge(gold_df, on='ID', suffixes=('_pred', '_gold'))
+    print('labeled messages verified: ', len(merged), '\n')
+
+    def columns(names, suffix):
+        # Columns with the same name in both files are renamed by merge
+        return [x + suffix if x in prediction_df and x in gold_df and x != 'ID' else x
+                for x in names]
+
+    pred = merged[columns(codes, '_pred')].to_numpy().astype(bool)
+    gold = merged[columns(gold_codes, '_gold')].to_numpy().astype(bool)
+    return pred, gold
+
+
+def confusion_counts(pred, gold):
+    """
+    Count true positives, false positives and false negatives for all codes at once
+    :param pred: boolean prediction matrix, of shape [num_messages, num_codes]
+    :param gold: boolean gold matrix, of the same shape
+    :return: true positives, false positives, false negatives (each of shape [num_codes])
+    """
+    tp = (pred & gold).sum(0)
+    fp = (pred & ~gold).sum(0)
+    fn = (~pred & gold).sum(0)
+    return tp, fp, fn
+
+
+def scores_from_counts(tp, fp, fn):
+    """
+    Calculate precision, recall and F1 from confusion counts
+    (where a score is undefined, it is set to 0, as in sklearn)
+    :param tp: true positives (array, or array with a leading axis of resamples)
+    :param fp: false positives (same shape)
+    :param fn: false negatives (same shape)
+    :return: precision, recall, F1 (each of the same shape)
+    """
+    tp = np.asarray(tp, dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0)
+        f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0)
+    return precision, recall, f1
+
+
+def bootstrap_intervals(pred, gold, n_resamples=10000, alpha=0.05, max_cells=2**24, seed=None):
+    """
+    Estimate confidence intervals for precision, recall and F1 by bootstrap resampling.
+    Resamples are drawn as a matrix of row indices, converted to counts of each row,
+    so that the confusion counts for all resamples and all codes are found with
+    matrix products. Resamples are processed in chunks, to bound memory use.
+    :param pred: boolean prediction matrix, of shape [num_messages, num_codes]
+    :param gold: boolean gold matrix, of the same shape
+    :param n_resamples: number of bootstrap resamples (default 10000)
+    :param alpha: the intervals cover 1 - alpha of the resampled scores (default 0.05)
+    :param max_cells: maximum size of the index matrix for one chunk
+    :param seed: (optional) random seed
+    :return: dict mapping 'precision', 'recall', 'F1' to arrays of shape [2, num_codes + 2],
+    giving lower and upper bounds for each code, then the micro and macro averages
+    """
+    rng = np.random.default_rng(seed)
+    N, K = pred.shape
+    both = (pred & gold).astype('float64')
+    predicted = pred.astype('float64')
+    actual = gold.astype('float64')
+    chunk = max(1, min(n_resamples, max_cells // max(N, 1)))
+    samples = {'precision': [], 'recall': [], 'F1': []}
+    for start in range(0, n_resamples, chunk):
+        B = min(chunk, n_resamples - start)
+        # Draw row indices, and count how often each row was drawn in each resample
+        indices = rng.integers(0, N, size=(B, N))
+        counts = np.bincount((indices + N * np.arange(B)[:, None]).ravel(),
+                             minlength=B * N).reshape(B, N).astype('float64')
+        # Confusion counts for each resample and code, of shape [B, K]
+        tp = counts @ both
+        fp = counts @ predicted - tp
+        fn = counts @ actual - tp
+        per_code = scores_from_counts(tp, fp, fn)
+        micro = scores_from_counts(tp.sum(1), fp.sum(1), fn.sum(1))
+        for name, code_scores, micro_scores in zip(samples, per_code, micro):
+            samples[name].append(np.column_stack([code_scores, micro_scores,
+                                                  code_scores.mean(1)]))
+    q = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    return {name: np.percentile(np.concatenate(x), q, axis=0) for name, x in samples.items()}
+
+
+def evaluate_all(pred, gold, codes, report_file=None, verbose=True, n_resamples=0, alpha=0.05):
+    """
+    Calculate precision, recall, F1 and support for all codes at once,
+    as well as micro and macro averages
+    :param pred: boolean prediction matrix, of shape [num_messages, num_codes]
+    :param gold: boolean gold matrix, of the same shape
+    :param codes: names of codes
+    :param report_file: (optional) name of csv file to save the report to
+    (without .csv file extension, saved in ../data)
+    :param verbose: whether to print results (default True)
+    :param n_resamples: if positive, add bootstrap confidence intervals, using this many resamples
+    :param alpha: confidence intervals cover 1 - alpha (default 0.05)
+    :return: report as a DataFrame, with one row per code and two rows of averages
+    """
+    import pandas
+    tp, fp, fn = confusion_counts(pred, gold)
+    precision, recall, f1 = scores_from_counts(tp, fp, fn)
+    report = pandas.DataFrame({'precision': precision, 'recall': recall, 'F1': f1,
+                               'support': tp + fn, 'predicted': tp + fp}, index=list(codes))
+    # Micro average pools the counts over codes, macro average takes the mean of scores
+    micro = [float(x) for x in scores_from_counts(tp.sum(), fp.sum(), fn.sum())]
+    report.loc['micro avg'] = [*micro, (tp + fn).sum(), (tp + fp).sum()]
+    report.loc['macro avg'] = [precision.mean(), recall.mean(), f1.mean(),
+                               (tp + fn).sum(), (tp + fp).sum()]
+    report = report.astype({'support': int, 'predicted': int})
+    report.index.name = 'label'
+
+    if n_resamples > 0:
+        intervals = bootstrap_intervals(pred, gold, n_resamples, alpha)
+        for name, (low, high) in intervals.items():
+            report[name + ' low'] = low
+            report[name + ' high'] = high
+
+    if verbose:
+        print(report.to_string())
+
+    if report_file is not None:
+        report.to_csv(os.path.join('../data', report_file + '.csv'))
+    return report
+
+
 if __name__ == "__main__":
 
     # Read code file
-    with open(os.path.join('../data', 'malaria' + '_codes.txt')) as f:
-        full_list = []
-        for line in f:
-            # Get the codes
-            parts = line.split('\t')
-            code = parts[0]
-
-
-            predictions, golds = get_prediction_and_gold_vector('../data/wash_predictions_1505.csv',
-                                                                code,
-                                                                '../data/malaria_verified_long.csv',
-                                                                code)
-            # get evaluation metrics
-            evaluate(predictions, golds, code ,'malaria_evaluation_1205')
+    codes = read_code_names('malaria_codes')
+
+    # Read both files once, and evaluate all codes together
+    predictions, golds = load_aligned('../data/wash_predictions_1505.csv',
+                                      '../data/malaria_verified_long.csv',
+                                      codes)
+    # get evaluation metrics
+    evaluate_all(predictions, golds, codes, 'malaria_evaluation_1205', n_resamples=10000)
@@ -0,0 +1,100 @@
+import numpy as np
+from scipy import sparse
+
+from features import feature_name
+from instrument import timed
+from postprocess import coefficient_matrix
+from weighting import row_indices, top_in_rows
+
+# Explaining predictions of linear classifiers
+# The log-odds of a code is the intercept plus the sum over features of
+# (feature value * feature weight), so each term is the contribution of one
+# feature. Only the nonzero features of each message need to be considered,
+# so we work directly on the data arrays of a CSR matrix, for all messages
+# at once.
+
+
+def top_contributions(features, coef, N=3, rows=None):
+    """
+    Find the features contributing most to one code, for many messages
+
+    :param features: CSR matrix of feature vectors, of shape
+    [num_messages, num_features]
+    :param coef: weights of one classifier, of shape [num_features]
+    :param N: number of features to return for each message
+    :param rows: (optional) boolean array of which messages to explain
+
+    :return: indices of features (with -1 padding), and their contributions
+    (each of shape [num_messages, N]), highest first
+    """
+    # Contribution of each nonzero feature
+    values = features.data * coef[features.indices]
+    keep = values > 0
+    if rows is not None:
+        keep &= rows[row_indices(features)]
+    return top_in_rows(features, N, values, keep)
+
+
+def explain(features, classifiers, predictions=None, N=3):
+    """
+    Find the features contributing most to each code, for many messages
+
+    :param features: feature vectors (dense or sparse matrix), of shape
+    [num_messages, num_features]
+    :param classifiers: list of LogisticRegression models, or ModelBundle
+    :param predictions: (optional) boolean matrix of predictions, of shape
+    [num_messages, num_codes] - if given, only predicted codes are explained
+    :param N: number of features to return for each message and code
+
+    :return: list (one element per code) of pairs of matrices
+    (feature indices, contributions), as in top_contributions
+    """
+    features = sparse.csr_matrix(features)
+    coef, present = coefficient_matrix(classifiers)
+    res = []
+    for k in range(len(present)):
+        if sparse.issparse(coef):
+            coef_k = coef[k].toarray().ravel()
+        else:
+            coef_k = np.asarray(coef[k])
+        rows = None if predictions is None else predictions[:, k]
+        res.append(top_contributions(features, coef_k, N, rows))
+    return res
+
+
+@timed('explain.explanation_strings', items='features')
+def explanation_strings(features, classifiers, feature_list, predictions=None,
+                        N=3):
+    """
+    Describe the features contributing most to each code, for many messages
+    e.g. 'biyo (0.84); biyo nadiif (0.31)'
+
+    :param features: feature vectors (dense or sparse matrix)
+    :param classifiers: list of LogisticRegression models, or ModelBundle
+    :param feature_list: list of features (or bundle Vocabulary)
+    :param predictions: (optional) boolean matrix of predictions
+    :param N: number of features to describe for each message and code
+
+    :return: list (one element per message) of lists (one element per code)
+    of strings
+    """
+    # Look up each feature's name only once
+    names = {}
+
+    def name(i):
+        if i not in names:
+            if hasattr(feature_list, 'feature'):
+                names[i] = feature_name(feature_list.feature(i))
+            else:
+                names[i] = feature_name(feature_list[i])
+        return names[i]
+
+    explanations = explain(features, classifiers, predictions, N)
+    res = [[''] * len(explanations) for _ in range(features.shape[0])]
+    for k, (indices, values) in enumerate(explanations):
+        # Only messages with at least one contributing feature need a string
+        for m in np.flatnonzero(indices[:, 0] >= 0):
+            res[m][k] = '; '.join('{} ({:.2f})'.format(name(i), v)
+                                  for i, v in zip(indices[m], values[m])
+                                  if i >= 0)
+    return res
@@ -0,0 +1,266 @@
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+
+from bitmatrix import BitMatrix
+from features import filter_by_frequency, Vectoriser
+from preprocess import save_pkl_txt
+
+# Functions for scoring features against codes
+# All scores are calculated from a 2x2 contingency table for each feature
+# and each code, using only whether a feature is present in a message.
+# The tables are found with a single sparse matrix product, so the cost is
+# proportional to the number of nonzero features, not messages * features.
+
+
+def contingency_counts(features, codes):
+    """
+    Count how often each feature co-occurs with each code
+
+    :param features: input matrix (numpy array or scipy sparse matrix),
+    of shape [num_messages, num_features]
+    :param codes: boolean output matrix, of shape [num_messages, num_codes]
+    (numpy array, scipy sparse matrix, or BitMatrix)
+
+    :return: number of messages, feature document frequencies (shape [F]),
+    code frequencies (shape [K]), co-occurrence counts (shape [F, K])
+    """
+    # Only the presence of each feature matters
+    present = sparse.csr_matrix(features, dtype='float64')
+    present.data = (present.data != 0).astype('float64')
+    present.eliminate_zeros()
+    if isinstance(codes, BitMatrix):
+        codes = codes.tocsr()
+    codes = sparse.csr_matrix(codes, dtype='float64')
+    N = present.shape[0]
+    feat_freq = np.asarray(present.sum(0)).ravel()
+    code_freq = np.asarray(codes.sum(0)).ravel()
+    both = (present.T @ codes).toarray()
+    return N, feat_freq, code_freq, both
+
+
+def chi2(features, codes):
+    """
+    Calculate the chi-squared statistic for each feature and each code
+
+    :param features: input matrix, of shape [num_messages, num_features]
+    :param codes: boolean output matrix, of shape [num_messages, num_codes]
+
+    :return: matrix of scores, of shape [num_features, num_codes]
+    """
+    N, feat_freq, code_freq, both = contingency_counts(features, codes)
+    f = feat_freq[:, None]
+    c = code_freq[None, :]
+    # Observed minus expected count for messages with both feature and code
+    # (the other three cells of the table differ by the same amount)
+    diff = both - f * c / N
+    denom = f * (N - f) * c * (N - c)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = N ** 3 * diff ** 2 / denom
+    # If a feature or code is always or never present, there is no evidence
+    scores[denom == 0] = 0
+    return scores
+
+
+def mutual_information(features, codes):
+    """
+    Calculate the mutual information (in nats) between each feature and each
+    code, treating both as binary variables
+
+    :param features: input matrix, of shape [num_messages, num_features]
+    :param codes: boolean output matrix, of shape [num_messages, num_codes]
+
+    :return: matrix of scores, of shape [num_features, num_codes]
+    """
+    N, feat_freq, code_freq, both = contingency_counts(features, codes)
+    f = feat_freq[:, None]
+    c = code_freq[None, :]
+    scores = np.zeros(both.shape)
+    # Sum over the four cells of each contingency table
+    for joint, marg_f, marg_c in [(both, f, c),
+                                  (f - both, f, N - c),
+                                  (c - both, N - f, c),
+                                  (N - f - c + both, N - f, N - c)]:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cell = joint / N * np.log(N * joint / (marg_f * marg_c))
+        # Empty cells contribute nothing (0 log 0 = 0)
+        scores += np.where(joint > 0, cell, 0)
+    return scores
+
+
+SCORE_FUNCTIONS = {'chi2': chi2, 'mi': mutual_information}
+
+
+def select_by_score(features, codes, k, method='chi2', per_code=False):
+    """
+    Choose the features most associated with the codes
+
+    :param features: input matrix, of shape [num_messages, num_features]
+    :param codes: boolean output matrix, of shape [num_messages, num_codes]
+    :param k: number of features to keep
+    :param method: scoring function ('chi2' or 'mi')
+    :param per_code: if True, keep the top k features for each code (so the
+    union may contain up to k * num_codes features); otherwise, keep the top k
+    features according to their highest score across all codes
+
+    :return: sorted array of indices of features to keep
+    """
+    scores = SCORE_FUNCTIONS[method](features, codes)
+    F = scores.shape[0]
+    if k >= F:
+        return np.arange(F)
+    if per_code:
+        # Find the top k for all codes at once
+        top = np.argpartition(-scores, k - 1, axis=0)[:k]
+        return np.unique(top)
+    best = scores.max(1)
+    return np.sort(np.argpartition(-best, k - 1)[:k])
+
+
+# Functions for applying a selection to saved files
+
+
+def remap_keywords(keywords, keep, num_features):
+    """
+    Convert lists of feature indices to a reduced set of features,
+    dropping any features which were removed
+
+    :param keywords: list of lists of feature indices
+    :param keep: sorted array of indices of features which were kept
+    :param num_features: number of features before selection
+
+    :return: list of lists of new feature indices
+    """
+    new_index = np.full(num_features, -1, dtype='int64')
+    new_index[keep] = np.arange(len(keep))
+    return [[int(new_index[i]) for i in indices if new_index[i] >= 0]
+            for indices in keywords]
+
+
+def remap_vectoriser(vectoriser, keep):
+    """
+    Restrict a Vectoriser to a reduced set of features
+
+    :param vectoriser: Vectoriser object
+    :param keep: sorted array of indices of features to keep
+
+    :return: new Vectoriser
+    """
+    feat_list = sorted(vectoriser.feature_dict,
+                       key=vectoriser.feature_dict.get)
+    feat_dict = {feat_list[i]: j for j, i in enumerate(keep)}
+    weights = vectoriser.weights
+    if weights is not None:
+        weights = weights[keep]
+    weighting = vectoriser.weighting
+    if weighting is not None:
+        weighting = weighting.subset(keep)
+    return Vectoriser(vectoriser.extractor, feat_dict, weights, weighting,
+                      vectoriser.dtype)
+
+
+def select(dataset, output_name=None, min_df=None, max_df=None,
+           max_features=None, k=None, method='chi2', per_code=False,
+           keyword_files=(), vectoriser=None, directory='../data'):
+    """
+    Prune the features of a preprocessed dataset, first by document
+    frequency, and then (optionally) by a supervised score.
+    The following files are loaded:
+    - {dataset}.pkl (features and codes, as saved by preprocess.save)
+    - {dataset}_features.pkl (unless a vectoriser is given)
+    - {dataset}_codes.pkl
+    and saved again under output_name (which may be the same).
+    If the dataset was preprocessed with a Vectoriser, preprocess.save does
+    not save a list of features, so the Vectoriser is loaded instead, and
+    restricted to the kept features (see remap_vectoriser), so that new
+    messages can be vectorised to match. It is saved as
+    {output_name}_vectoriser.pkl, together with {output_name}_features.pkl
+    (with document frequencies in this dataset).
+    Keyword index files (as saved by preprocess.preprocess_keywords) are
+    converted to use the new feature indices.
+
+    :param dataset: name of the preprocessed dataset
+    :param output_name: name of output dataset (default: overwrite the input)
+    :param min_df: minimum document frequency to keep a feature
+    :param max_df: maximum document frequency to keep a feature
+    (int for a count, float for a proportion of messages)
+    :param max_features: maximum number of features to keep, by frequency
+    :param k: number of features to keep, by supervised score
+    :param method: scoring function ('chi2' or 'mi')
+    :param per_code: whether to keep the top k features for each code
+    :param keyword_files: keyword index files to convert, either as names
+    (which are overwritten) or as (input name, output name) pairs
+    :param vectoriser: name of the Vectoriser file the dataset was
+    preprocessed with (as saved by preprocess.extract_features_and_idf)
+    :param directory: directory of data files (default ../data)
+
+    :return: array of indices of features kept
+    """
+    if output_name is None:
+        output_name = dataset
+
+    # Load features and codes
+    with open(os.path.join(directory, dataset + '.pkl'), 'rb') as f:
+        feat_vecs, code_vecs = pickle.load(f)
+    with open(os.path.join(directory, dataset + '_codes.pkl'), 'rb') as f:
+        codes = pickle.load(f)
+    N, F = feat_vecs.shape
+    doc_freq = np.asarray((feat_vecs != 0).sum(0)).ravel()
+    if vectoriser is None:
+        with open(os.path.join(directory, dataset + '_features.pkl'), 'rb') as f:
+            feats = pickle.load(f)
+    else:
+        with open(os.path.join(directory, vectoriser + '.pkl'), 'rb') as f:
+            vectoriser = pickle.load(f)
+        if len(vectoriser.feature_dict) != F:
+            raise ValueError('Vectoriser has {} features, but the dataset has {}'
+                             .format(len(vectoriser.feature_dict), F))
+        feat_list = sorted(vectoriser.feature_dict,
+                           key=vectoriser.feature_dict.get)
+        feats = [(feat, int(n)) for feat, n in zip(feat_list, doc_freq)]
+
+    # Prune by document frequency (within this dataset)
+    freq = filter_by_frequency(dict(enumerate(doc_freq)), min_df, max_df,
+                               max_features, n_docs=N)
+    keep = np.array(sorted(freq), dtype='int64')
+
+    # Prune by supervised score
+    if k is not None:
+        chosen = select_by_score(feat_vecs[:, keep], code_vecs, k, method,
+                                 per_code)
+        keep = keep[chosen]
+
+    # Save the reduced dataset
+    with open(os.path.join(directory, output_name + '.pkl'), 'wb') as f:
+        pickle.dump((feat_vecs[:, keep], code_vecs), f)
+    save_pkl_txt([feats[i] for i in keep], output_name + '_features',
+                 directory)
+    if output_name != dataset:
+        save_pkl_txt(codes, output_name + '_codes', directory)
+    if vectoriser is not None:
+        with open(os.path.join(directory, output_name + '_vectoriser.pkl'), 'wb') as f:
+            pickle.dump(remap_vectoriser(vectoriser, keep), f)
+
+    # Convert keyword indices
+    for names in keyword_files:
+        if isinstance(names, str):
+            input_file = output_file = names
+        else:
+            input_file, output_file = names
+        with open(os.path.join(directory, input_file + '.pkl'), 'rb') as f:
+            keywords = pickle.load(f)
+        keywords = remap_keywords(keywords, keep, F)
+        with open(os.path.join(directory, output_file + '.pkl'), 'wb') as f:
+            pickle.dump(keywords, f)
+
+    print('Kept {} of {} features'.format(len(keep), F))
+    return keep
+
+
+if __name__ == "__main__":
+    # Remove very rare and very common features, then keep the features most
+    # strongly associated with each code
+    select('wash_s04', 'wash_s04_selected', min_df=2, max_df=0.5, k=2000,
+           per_code=True, keyword_files=[('wash_s04_keywords',
+                                          'wash_s04_selected_keywords')])
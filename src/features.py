@@ -1,7 +1,13 @@
-import numpy as np
+import functools
+import re
 from collections import Counter
 from abc import ABC, abstractmethod
 
+from instrument import stage, timed
+
+# numpy and scipy are only imported by the functions producing vectors,
+# so that importing this module just to extract features is fast
+
 # Functions mapping messages to bags of features
 
 
@@ -161,6 +167,116 @@ class apply_to_parts(Extractor):
         return bag
 
 
+# Normalising text
+# SMS messages vary a lot in case, punctuation and spelling, which would
+# otherwise give many features for the same word (e.g. 'biyaha', 'Biyaha,' and
+# 'biyaaha!!'). Normalising words before extracting features makes the
+# vocabulary smaller, and so everything after feature extraction faster.
+
+# Somali orthographic rules, as pairs of strings (old, new) replaced in each
+# word, in order: 'c' is often written as an apostrophe, and 'x' as 'h'
+ORTHOGRAPHIC_RULES = (("'", 'c'), ('x', 'h'))
+
+# Characters which are not part of words (the apostrophe is used as a letter)
+NON_WORD = re.compile(r"[^\w']+")
+
+
+def normalise_word(word, rules=ORTHOGRAPHIC_RULES, max_repeat=1, lower=True):
+    """
+    Normalise the spelling of a word
+    e.g. 'Xaaladda' -> 'halada' (or 'haaladda' with max_repeat=2)
+
+    :param word: string
+    :param rules: pairs of strings (old, new) to replace, in order
+    :param max_repeat: maximum number of times a character can be repeated
+    (longer runs are shortened), or None to keep all repeats
+    - with 1, long vowels and doubled consonants are written as one letter
+    :param lower: whether to convert to lower case
+
+    :return: string
+    """
+    if lower:
+        word = word.lower()
+    for old, new in rules:
+        word = word.replace(old, new)
+    if max_repeat:
+        word = re.sub(r'(.)\1{%d,}' % max_repeat, r'\g<1>' * max_repeat, word)
+    return word
+
+
+class normalise(Extractor):
+    """
+    Wrap a feature extractor, so it applies to normalised text
+    Most words in a corpus are repeats, so the normalised form of each word is
+    remembered (for the cache_size most recently used words).
+    To keep separators of concatenated messages (which are punctuation), use
+    e.g. apply_to_parts(normalise(bag_of_words), '&&&')
+    """
+    def __init__(self, function, rules=ORTHOGRAPHIC_RULES, max_repeat=1,
+                 lower=True, strip_punctuation=True, cache_size=2**16):
+        """
+        Wrap a feature extractor, so it applies to normalised text
+
+        :param function: function mapping from a string to a Counter
+        :param rules: see normalise_word
+        :param max_repeat: see normalise_word
+        :param lower: whether to convert to lower case
+        :param strip_punctuation: whether to remove punctuation (so that
+        words joined by punctuation are separated)
+        :param cache_size: number of words whose normalised form is remembered
+
+        :return: new feature extractor
+        """
+        self.function = function
+        self.rules = tuple(rules)
+        self.max_repeat = max_repeat
+        self.lower = lower
+        self.strip_punctuation = strip_punctuation
+        self.cache_size = cache_size
+        self.cached_token = functools.lru_cache(cache_size)(self.token)
+
+    def token(self, token):
+        """
+        :param token: string without whitespace
+        :return: normalised words, separated by spaces (empty if there are none)
+        """
+        words = NON_WORD.sub(' ', token).split() if self.strip_punctuation else [token]
+        return ' '.join(normalise_word(w, self.rules, self.max_repeat, self.lower)
+                        for w in words)
+
+    def text(self, msg):
+        """
+        :param msg: input string
+        :return: normalised string, with words separated by single spaces
+        """
+        return ' '.join(filter(None, map(self.cached_token, msg.split())))
+
+    def __call__(self, msg):
+        """
+        Convert a message to a bag of features
+        :param msg: input string
+        :return: dict-like bag of features
+        """
+        return self.function(self.text(msg))
+
+    def cache_info(self):
+        """
+        :return: hits, misses, maxsize and currsize of the cache
+        """
+        return self.cached_token.cache_info()
+
+    # The cache is not pickled (it is rebuilt when needed)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['cached_token']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cached_token = functools.lru_cache(self.cache_size)(self.token)
+
+
 # Functions for producing vectors of features
 
 def get_global_set(bags_of_features):
@@ -177,6 +293,7 @@ def get_global_set(bags_of_features):
     return features
 
 
+@timed('features.document_frequency', items='bags_of_features')
 def document_frequency(bags_of_features):
     """
     Find all the distinct features in many bags of features,
@@ -192,6 +309,38 @@ def document_frequency(bags_of_features):
     return freq
 
 
+def filter_by_frequency(freq, min_df=None, max_df=None, max_features=None,
+                        n_docs=None):
+    """
+    Prune features according to their document frequencies
+
+    :param freq: dict mapping features to their document frequencies
+    :param min_df: minimum document frequency to keep a feature
+    :param max_df: maximum document frequency to keep a feature
+    - an int is an absolute count
+    - a float is a proportion of n_docs
+    :param max_features: keep only this many of the most frequent features
+    (ties are broken by the feature names, so the result is deterministic)
+    :param n_docs: total number of documents (needed if max_df is a float)
+
+    :return: dict mapping the remaining features to their frequencies
+    """
+    if isinstance(max_df, float):
+        if n_docs is None:
+            raise ValueError('n_docs must be given if max_df is a proportion')
+        max_df = max_df * n_docs
+    # Filter out rare and common features
+    if min_df is not None or max_df is not None:
+        freq = {feat: n for feat, n in freq.items()
+                if (min_df is None or n >= min_df)
+                and (max_df is None or n <= max_df)}
+    # Keep only the most frequent features
+    if max_features is not None and len(freq) > max_features:
+        top = sorted(freq.items(), key=lambda x: (-x[1], x[0]))[:max_features]
+        freq = dict(top)
+    return freq
+
+
 def feature_list_and_dict(features):
     """
     Assign numerical indices to a global list of features
@@ -205,15 +354,35 @@ def feature_list_and_dict(features):
     return feature_list, feature_dict
 
 
-def vectorise_one(bag, feature_dict):
+def check_counts(bags, dtype):
+    """
+    Check that the values in bags of features can be stored with a data type
+    (only integer types need checking, since numpy may silently wrap them)
+
+    :param bags: Counters of features
+    :param dtype: numpy data type
+    """
+    import numpy as np
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui':
+        info = np.iinfo(dtype)
+        values = [v for b in bags for v in b.values()]
+        if values and (max(values) > info.max or min(values) < info.min):
+            raise ValueError('Feature values do not fit in {}'.format(dtype))
+
+
+def vectorise_one(bag, feature_dict, dtype='float64'):
     """
     Convert a bag of features to a numpy array
     :param bag: Counter of features
     :param feature_dict: dict mapping feature names to indices
+    :param dtype: numpy data type of the vector (default float64)
     :return: feature vector
     """
+    import numpy as np
+    check_counts([bag], dtype)
     N = len(feature_dict)
-    vec = np.zeros(N)
+    vec = np.zeros(N, dtype=dtype)
     for feat, value in bag.items():
         # Ignore features that are not in the dictionary
         if feat in feature_dict:
@@ -221,17 +390,23 @@ def vectorise_one(bag, feature_dict):
     return vec
 
 
-def vectorise(bags, feature_dict):
+@timed('features.vectorise', items='bags')
+def vectorise(bags, feature_dict, dtype='float64'):
     """
     Convert bags of features to numpy arrays
 
     :param bags: Counters of features
     :param feature_dict: dict mapping feature names to indices
+    :param dtype: numpy data type of the matrix (default float64)
+    - e.g. 'float32' halves the memory used, and 'uint16' stores counts in
+    a quarter of it (values which do not fit raise a ValueError)
 
     :return: feature vectors as a matrix
     """
+    import numpy as np
+    check_counts(bags, dtype)
     N = len(feature_dict)
-    vecs = np.zeros((len(bags), N))
+    vecs = np.zeros((len(bags), N), dtype=dtype)
     for i, b in enumerate(bags):
         for feat, value in b.items():
             # Ignore features that are not in the dictionary
@@ -240,7 +415,44 @@ def vectorise(bags, feature_dict):
     return vecs
 
 
-def get_vectors(msgs, extractor, feature_dict, weights=None):
+@timed('features.vectorise_sparse', items='bags')
+def vectorise_sparse(bags, feature_dict, dtype='float32'):
+    """
+    Convert bags of features to a sparse matrix,
+    storing only the features present in each bag
+
+    :param bags: Counters of features
+    :param feature_dict: dict (or dict-like object with a get method)
+    mapping feature names to indices
+    :param dtype: numpy data type of the matrix (default float32)
+
+    :return: feature vectors as a scipy CSR matrix
+    """
+    import numpy as np
+    from scipy import sparse
+    indices = []
+    data = []
+    indptr = [0]
+    for b in bags:
+        for feat, value in b.items():
+            # Ignore features that are not in the dictionary
+            i = feature_dict.get(feat)
+            if i is not None:
+                indices.append(i)
+                data.append(value)
+        indptr.append(len(indices))
+    vecs = sparse.csr_matrix((np.array(data, dtype=dtype),
+                              np.array(indices, dtype='int32'),
+                              np.array(indptr, dtype='int64')),
+                             shape=(len(indptr) - 1, len(feature_dict)))
+    # Features may have been given in any order
+    vecs.sort_indices()
+    return vecs
+
+
+@timed('features.get_vectors', items='msgs')
+def get_vectors(msgs, extractor, feature_dict, weights=None, weighting=None,
+                dtype='float64'):
     """
     Get feature vectors for many messages
 
@@ -249,11 +461,19 @@ def get_vectors(msgs, extractor, feature_dict, weights=None):
     features
     :param feature_dict: dict mapping from features names to indices
     :param weights: array of weights, to be multiplied with extracted vectors
+    :param weighting: Weighting object (see weighting.py) - if given,
+    vectors are returned as a sparse matrix, and weights are ignored
+    :param dtype: numpy data type of dense vectors (default float64)
+    - this must be a floating point type if weights are given
 
     :return: feature vectors as a matrix
     """
-    bags = [extractor(m) for m in msgs]
-    vectors = vectorise(bags, feature_dict)
+    with stage('features.extract', items=len(msgs)):
+        bags = [extractor(m) for m in msgs]
+    if weighting is not None:
+        return weighting(vectorise_sparse(bags, feature_dict,
+                                          weighting.dtype))
+    vectors = vectorise(bags, feature_dict, dtype)
     if weights is not None:
         vectors *= weights
     return vectors
@@ -263,17 +483,27 @@ class Vectoriser:
     """
     Class for converting messages to feature vectors
     """
-    def __init__(self, extractor, feature_dict, weights=None):
+    # Defaults for Vectorisers pickled before weighting and dtype were added
+    weighting = None
+    dtype = 'float64'
+
+    def __init__(self, extractor, feature_dict, weights=None, weighting=None,
+                 dtype='float64'):
         """
         :param extractor: feature extractor, mapping from a string to a bag
         of features
         :param feature_dict: dict mapping from features names to indices
         :param weights: array of weights, to be multiplied with extracted
         vectors
+        :param weighting: Weighting object (see weighting.py), to produce
+        sparse weighted vectors instead
+        :param dtype: numpy data type of dense vectors (default float64)
         """
         self.extractor = extractor
         self.feature_dict = feature_dict
         self.weights = weights
+        self.weighting = weighting
+        self.dtype = dtype
 
     def __call__(self, msgs):
         """
@@ -285,32 +515,116 @@ class Vectoriser:
         if isinstance(msgs, str):
             msgs = [msgs]
         return get_vectors(msgs, self.extractor, self.feature_dict,
-                           self.weights)
+                           self.weights, self.weighting, self.dtype)
 
 
 # For human readability
+def feature_name(feat):
+    """
+    Write a feature as a short string
+    e.g. ('word', 'biyo') -> 'biyo', ('ngram', ('biyo', 'nadiif')) -> 'biyo nadiif',
+    ('char', 'iyo') -> 'char:iyo'
+
+    :param feat: feature, as a pair (kind, value)
+
+    :return: string
+    """
+    kind, value = feat
+    if isinstance(value, tuple):
+        return ' '.join(value)
+    if kind == 'word':
+        return value
+    return '{}:{}'.format(kind, value)
+
+
+def feature_lookup(feature_list):
+    """
+    :param feature_list: global list of features, or bundle Vocabulary
+    :return: function mapping a feature index to a feature
+    """
+    if hasattr(feature_list, 'feature'):
+        return feature_list.feature
+    return feature_list.__getitem__
+
+
+def as_csr(vectors):
+    """
+    :param vectors: feature vector or matrix (numpy array, scipy sparse
+    matrix, or BitMatrix)
+    :return: CSR matrix in canonical form (sorted indices, without duplicate
+    entries or explicit zeros), with one row for a vector
+    """
+    import numpy as np
+    from scipy import sparse
+    if hasattr(vectors, 'tocsr'):
+        vectors = vectors.tocsr()
+    else:
+        vectors = sparse.csr_matrix(np.atleast_2d(vectors))
+    if not vectors.has_canonical_format or not vectors.data.all():
+        # Copy, rather than changing the caller's matrix
+        # (duplicates are summed first, in case they add up to zero)
+        vectors = vectors.copy()
+        vectors.sum_duplicates()
+        vectors.eliminate_zeros()
+    return vectors
+
+
 def bagify_one(vector, feature_list):
     """
     Convert a feature vector to a bag of features
 
-    :param vector: numpy array
-    :param feature_list: global list of feature names
+    :param vector: numpy array, or sparse matrix with one row
+    :param feature_list: global list of feature names (or bundle Vocabulary)
 
     :return: bag of features
     """
-    bag = Counter()
-    for i in vector.nonzero():
-        bag[feature_list[i]] = vector[i]
-    return bag
+    return bagify(vector, feature_list)[0]
 
 
 def bagify(vectors, feature_list):
     """
     Convert feature vectors to bags of features
+    The nonzero entries of all vectors are found at once, and each distinct
+    feature is only looked up once, so this is fast for large sparse batches.
 
-    :param vectors: numpy array (matrix)
-    :param feature_list: global list of feature names
+    :param vectors: numpy array (matrix), scipy sparse matrix, or BitMatrix
+    :param feature_list: global list of feature names (or bundle Vocabulary)
 
     :return: list of bags of features
     """
-    return [bagify_one(v, feature_list) for v in vectors]
+    import numpy as np
+    vectors = as_csr(vectors)
+    lookup = feature_lookup(feature_list)
+    unique, inverse = np.unique(vectors.indices, return_inverse=True)
+    names = [lookup(i) for i in unique.tolist()]
+    feats = list(map(names.__getitem__, inverse.tolist()))
+    data = vectors.data.tolist()
+    indptr = vectors.indptr.tolist()
+    return [Counter(dict(zip(feats[start:end], data[start:end])))
+            for start, end in zip(indptr[:-1], indptr[1:])]
+
+
+def top_features(vectors, feature_list, N=5):
+    """
+    Find the features with the highest values in each vector
+    e.g. to see what a misclassified message looks like to the classifier
+
+    :param vectors: numpy array (matrix), scipy sparse matrix, or BitMatrix
+    :param feature_list: global list of feature names (or bundle Vocabulary)
+    :param N: number of features for each vector
+
+    :return: list (one element per vector) of lists of (feature, value)
+    pairs, highest first (fewer than N if the vector has fewer nonzero values)
+    """
+    from weighting import top_in_rows
+    vectors = as_csr(vectors)
+    # (ranked as floats, since boolean matrices cannot be negated)
+    indices, values = top_in_rows(vectors, N, vectors.data.astype('float64'))
+    # Look up each feature only once
+    lookup = feature_lookup(feature_list)
+    names = {}
+    for i in indices[indices >= 0].tolist():
+        if i not in names:
+            names[i] = lookup(i)
+    return [[(names[i], v) for i, v in zip(row_indices, row_values) if i >= 0]
+            for row_indices, row_values in zip(indices.tolist(), values.tolist())]
@@ -0,0 +1,107 @@
+import csv
+import os
+
+from instrument import stage
+
+# Reading csv files in large chunks, keeping only the columns we need
+# Columns are referred to by index (as with csv.reader rows), and all values
+# are read as strings unless other types are asked for. Filters are applied
+# to whole chunks at once, rather than row by row.
+
+CHUNKSIZE = 2**16
+
+
+def read_header(filename):
+    """
+    Read the headings of a csv file
+
+    :param filename: path to csv file
+
+    :return: list of headings
+    """
+    with open(filename, newline='') as f:
+        return next(csv.reader(f))
+
+
+def read_columns(filename, columns=None, filters=None, exclude=None,
+                 dtype=None, chunksize=CHUNKSIZE):
+    """
+    Read a csv file in chunks, keeping only some columns and rows
+
+    :param filename: path to csv file (the first row is treated as headings)
+    :param columns: indices of columns to return (default all)
+    :param filters: dict mapping column indices to collections of values -
+    only rows with one of these values are kept
+    - e.g. {4: {'1', '2'}} is the vectorised version of row[4] in ('1', '2')
+    :param exclude: dict mapping column indices to collections of values -
+    rows with one of these values are removed
+    :param dtype: dict mapping column indices to types (default: all str)
+    :param chunksize: number of rows to read at once
+
+    :return: iterator yielding pandas DataFrames, with columns labelled by
+    their indices
+    """
+    # pandas is only needed when reading
+    import pandas
+
+    filters = filters or {}
+    exclude = exclude or {}
+    if columns is None:
+        columns = list(range(len(read_header(filename))))
+    columns = list(columns)
+    needed = sorted(set(columns) | set(filters) | set(exclude))
+    types = {i: str for i in needed}
+    if dtype:
+        types.update(dtype)
+
+    chunks = pandas.read_csv(filename, header=None, skiprows=1,
+                             usecols=needed, dtype=types,
+                             keep_default_na=False, na_filter=False,
+                             chunksize=chunksize)
+    while True:
+        # Time parsing and filtering, but not whatever is done with each chunk
+        with stage('ingest.read_csv', file=os.path.basename(filename)) as s:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            s.set(rows=len(chunk))
+            mask = None
+            for col, values in filters.items():
+                m = chunk[col].isin(list(values))
+                mask = m if mask is None else mask & m
+            for col, values in exclude.items():
+                m = ~chunk[col].isin(list(values))
+                mask = m if mask is None else mask & m
+            if mask is not None:
+                chunk = chunk[mask]
+            chunk = chunk[columns]
+            s.set(items=len(chunk))
+        yield chunk
+
+
+def iter_column(filename, column, **kwargs):
+    """
+    Read one column of a csv file
+
+    :param filename: path to csv file
+    :param column: index of column
+    :param kwargs: additional arguments for read_columns
+
+    :return: iterator yielding values
+    """
+    for chunk in read_columns(filename, [column], **kwargs):
+        yield from chunk[column].tolist()
+
+
+def read_rows(filename, **kwargs):
+    """
+    Read rows of a csv file as lists of strings (like csv.reader, but without
+    headings, and with chunked parsing and filtering)
+
+    :param filename: path to csv file
+    :param kwargs: additional arguments for read_columns
+
+    :return: iterator yielding lists of values
+    """
+    for chunk in read_columns(filename, **kwargs):
+        yield from chunk.values.tolist()
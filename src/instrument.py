@@ -0,0 +1,278 @@
+import atexit
+import cProfile
+import functools
+import inspect
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+# Timing and counting stages of a run, e.g. to find out why a weekly run is slow
+# Instrumentation is off by default, and then each stage only costs a check of
+# a global flag. When it is on, each stage records its wall time, CPU time,
+# any counts it reports (e.g. items processed, nnz, vocabulary size) and the
+# peak resident memory of the process so far. The records are written as a
+# JSON run log, and each top-level stage can also be profiled with cProfile.
+#
+# Usage:
+#     instrument.enable('../data/run_log.json')
+#     with instrument.stage('vectorise', items=len(msgs)) as s:
+#         vecs = ...
+#         s.set(nnz=vecs.nnz)
+# or set the environment variable SMS_RUN_LOG to a file name (and optionally
+# SMS_PROFILE_DIR to a directory) to enable instrumentation for any script.
+
+_enabled = False
+_log_file = None
+_profile_dir = None
+_started = None
+_perf_started = None
+_records = []
+_counters = {}
+_stack = []
+_profiling = False
+
+
+class Stage:
+    """
+    A running stage, which code inside the stage can report counts to
+    """
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    def set(self, **info):
+        """
+        Record values, e.g. s.set(vocab_size=len(feature_dict))
+        """
+        self.info.update(info)
+
+    def add(self, **counts):
+        """
+        Add to counts, e.g. s.add(items=len(chunk))
+        """
+        for key, value in counts.items():
+            self.info[key] = self.info.get(key, 0) + value
+
+
+class NullStage:
+    """
+    Stage used when instrumentation is disabled, which ignores everything
+    """
+    name = None
+    info = {}
+
+    def set(self, **info):
+        pass
+
+    def add(self, **counts):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def max_rss():
+    """
+    :return: peak resident memory of this process in bytes, or None if the
+    resource module is not available (e.g. on Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def enable(log_file=None, profile_dir=None):
+    """
+    Start recording stages (any earlier records are discarded)
+
+    :param log_file: (optional) file to write the JSON run log to, when
+    disable is called or the program exits
+    :param profile_dir: (optional) directory to save a cProfile dump of each
+    top-level stage to
+    """
+    global _enabled, _log_file, _profile_dir, _started, _perf_started
+    _enabled = True
+    _log_file = log_file
+    _profile_dir = profile_dir
+    _started = time.time()
+    _perf_started = time.perf_counter()
+    _records.clear()
+    _counters.clear()
+    _stack.clear()
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def disable():
+    """
+    Stop recording stages, and write the run log if a file was given
+    """
+    global _enabled
+    if _enabled and _log_file:
+        write_log(_log_file)
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def count(name, n=1):
+    """
+    Add to a global counter
+
+    :param name: name of counter
+    :param n: amount to add (default 1)
+    """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+@contextmanager
+def stage(name, **info):
+    """
+    Context manager recording one stage of a run
+
+    :param name: name of the stage
+    :param info: initial values to record (e.g. items=len(msgs))
+
+    :return: Stage object, to report further counts to
+    """
+    if not _enabled:
+        yield NULL_STAGE
+        return
+    global _profiling
+    current = Stage(name, dict(info))
+    parent = _stack[-1].name if _stack else None
+    _stack.append(current)
+    # Only one profiler can run at once, so nested stages are not profiled separately
+    profiler = None
+    if _profile_dir and not _profiling:
+        profiler = cProfile.Profile()
+        _profiling = True
+        profiler.enable()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield current
+    finally:
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+        if profiler is not None:
+            profiler.disable()
+            _profiling = False
+            filename = '{:03d}_{}.prof'.format(len(_records), re.sub(r'\W+', '_', name))
+            profiler.dump_stats(os.path.join(_profile_dir, filename))
+        _stack.pop()
+        record = {'stage': name, 'parent': parent, 'depth': len(_stack),
+                  'start': start - _perf_started, 'seconds': seconds,
+                  'cpu_seconds': cpu_seconds, 'peak_rss_bytes': max_rss()}
+        record.update(current.info)
+        if 'items' in record and seconds > 0:
+            record['items_per_second'] = record['items'] / seconds
+        _records.append(record)
+
+
+def size(x):
+    """
+    :param x: list, array or matrix
+    :return: number of items (rows, for arrays and matrices), or None if it
+    cannot be found without consuming x (e.g. for a generator)
+    """
+    shape = getattr(x, 'shape', None)
+    if shape:
+        return shape[0]
+    try:
+        return len(x)
+    except TypeError:
+        return None
+
+
+def timed(name=None, items=None):
+    """
+    Decorator recording each call of a function as a stage
+    The shape of the result is also recorded (and nnz, for sparse matrices)
+
+    :param name: name of the stage (default: module.function)
+    :param items: (optional) name of an argument whose size is recorded as
+    the number of items processed (if it has a size - recording never
+    changes whether the function succeeds)
+    """
+    def decorator(function):
+        stage_name = name or '{}.{}'.format(function.__module__, function.__qualname__)
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with stage(stage_name) as s:
+                if items is not None:
+                    try:
+                        n = size(signature.bind(*args, **kwargs).arguments.get(items))
+                    except TypeError:
+                        # Invalid arguments: let the function raise its own error
+                        n = None
+                    if n is not None:
+                        s.set(items=n)
+                result = function(*args, **kwargs)
+                if hasattr(result, 'shape'):
+                    s.set(shape=list(result.shape))
+                if hasattr(result, 'nnz'):
+                    s.set(nnz=result.nnz)
+                return result
+        return wrapper
+    return decorator
+
+
+def run_log():
+    """
+    :return: dict of everything recorded so far
+    """
+    return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(_started))
+            if _started else None,
+            'argv': sys.argv,
+            'peak_rss_bytes': max_rss(),
+            'counters': dict(_counters),
+            'stages': list(_records)}
+
+
+def _to_json(obj):
+    # numpy numbers and other objects
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return str(obj)
+
+
+def write_log(filename):
+    """
+    Write the run log as JSON
+
+    :param filename: path of output file
+    """
+    with open(filename, 'w') as f:
+        json.dump(run_log(), f, indent=2, default=_to_json)
+
+
+def summary():
+    """
+    Print the total time of each stage, with the slowest first
+    """
+    totals = {}
+    for r in _records:
+        calls, seconds = totals.get(r['stage'], (0, 0))
+        totals[r['stage']] = (calls + 1, seconds + r['seconds'])
+    for name, (calls, seconds) in sorted(totals.items(), key=lambda x: -x[1][1]):
+        print('{:<40}{:>6} calls{:>10.3f} s'.format(name, calls, seconds))
+
+
+atexit.register(disable)
+
+if os.environ.get('SMS_RUN_LOG'):
+    enable(os.environ['SMS_RUN_LOG'], os.environ.get('SMS_PROFILE_DIR'))
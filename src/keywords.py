@@ -0,0 +1,254 @@
+import hashlib
+import os
+import pickle
+from collections import deque
+
+from features import ORTHOGRAPHIC_RULES, NON_WORD, normalise_word
+
+# Keywords for codes, which can be phrases of any number of words
+# Somali is written with a lot of spelling variation, especially in SMS
+# (e.g. long vowels written with one letter, 'x' written as 'h'), so keywords
+# are compared using a normalised key for each word, so that one keyword can
+# match several spellings.
+# - KeywordIndex maps keywords to the indices of matching features, for
+#   training (it is built once for each feature file, and saved)
+# - KeywordMatcher finds keywords in raw messages, for all keywords at once,
+#   using an Aho-Corasick automaton (one pass over each message)
+# Words are normalised with features.normalise_word, so keywords also match
+# features extracted with the features.normalise wrapper.
+
+# Replacements applied to each word before comparing spellings
+# (after these, any repeated letter is reduced to one, e.g. 'aa' to 'a')
+VARIANT_RULES = ORTHOGRAPHIC_RULES
+
+
+def variant_key(word, rules=VARIANT_RULES):
+    """
+    Normalise the spelling of a word, so that variants have the same key
+    e.g. 'Xaaladda' -> 'halada'
+
+    :param word: string
+    :param rules: pairs of strings (old, new) to replace, in order
+
+    :return: string
+    """
+    return normalise_word(word, rules, max_repeat=1)
+
+
+def phrase_key(phrase, rules=VARIANT_RULES):
+    """
+    :param phrase: string, or sequence of words (e.g. the value of an ngram
+    feature) - punctuation is removed in either case
+    :param rules: see variant_key
+    :return: tuple of normalised words
+    """
+    if isinstance(phrase, str):
+        phrase = [phrase]
+    return tuple(variant_key(w, rules)
+                 for part in phrase for w in NON_WORD.sub(' ', part).split())
+
+
+def read_keyword_file(filename):
+    """
+    Read keywords, with one line per code, and keywords separated by commas
+    For readability, the line can begin with the name of the code, separated
+    by a tab, e.g. "Emotional Causes	walwal, isla hadal"
+
+    :param filename: path to file
+
+    :return: list of code names (None where not given), and list (one element
+    per code) of lists of keywords
+    """
+    names = []
+    keywords = []
+    with open(filename) as f:
+        for line in f:
+            parts = line.rstrip('\r\n').split('\t')
+            names.append(parts[0].strip() if len(parts) > 1 else None)
+            keywords.append([k.strip() for k in parts[-1].split(',') if k.strip()])
+    return names, keywords
+
+
+class KeywordIndex:
+    """
+    Index of the word and ngram features of a vocabulary, by normalised
+    spelling, to find the features matching a keyword
+    """
+    def __init__(self, feature_list, rules=VARIANT_RULES):
+        """
+        :param feature_list: list of features, in order of their indices
+        :param rules: see variant_key
+        """
+        self.rules = rules
+        self.index = {}
+        for i, (kind, value) in enumerate(feature_list):
+            if kind == 'word':
+                key = phrase_key([value], rules)
+            elif kind == 'ngram':
+                key = phrase_key(value, rules)
+            else:
+                continue
+            self.index.setdefault(key, []).append(i)
+
+    def lookup(self, keyword):
+        """
+        :param keyword: phrase (string, or sequence of words)
+        :return: indices of all features matching the keyword
+        (as a single word if it has one word, or as an ngram otherwise)
+        """
+        return list(self.index.get(phrase_key(keyword, self.rules), ()))
+
+
+def file_digest(filename):
+    """
+    :param filename: path to file
+    :return: hex digest of the file's contents
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_keyword_index(feature_file, directory='../data', rules=VARIANT_RULES):
+    """
+    Load the keyword index of a feature file, building it if it does not
+    exist, or if the feature file has changed since it was built
+
+    :param feature_file: file containing the global list of features
+    (without .pkl file extension), as saved by preprocess.save
+    :param directory: directory of data files (default ../data)
+    :param rules: see variant_key
+
+    :return: KeywordIndex
+    """
+    feature_path = os.path.join(directory, feature_file + '.pkl')
+    index_path = os.path.join(directory, feature_file + '_keyword_index.pkl')
+    digest = file_digest(feature_path)
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            saved_digest, index = pickle.load(f)
+        if saved_digest == digest and index.rules == rules:
+            return index
+    with open(feature_path, 'rb') as f:
+        feats = pickle.load(f)
+    # Ignore frequency information
+    index = KeywordIndex([x for x, _ in feats], rules)
+    with open(index_path, 'wb') as f:
+        pickle.dump((digest, index), f)
+    return index
+
+
+class KeywordMatcher:
+    """
+    Find keywords of many codes in messages
+    Messages and keywords are normalised in the same way, and each keyword is
+    matched as whole words, using an Aho-Corasick automaton over characters.
+    """
+    def __init__(self, keywords, rules=VARIANT_RULES):
+        """
+        :param keywords: list (one element per code) of lists of keywords
+        :param rules: see variant_key
+        """
+        self.rules = rules
+        self.keywords = keywords
+        self.n_codes = len(keywords)
+        # Patterns are surrounded by spaces, so only whole words match
+        patterns = {}
+        for k, code_keywords in enumerate(keywords):
+            for keyword in code_keywords:
+                key = phrase_key(keyword, rules)
+                if key:
+                    patterns.setdefault(' {} '.format(' '.join(key)), []).append((k, keyword))
+        self.build(patterns)
+
+    def build(self, patterns):
+        """
+        Build the automaton
+
+        :param patterns: dict mapping strings to lists of outputs
+        """
+        # Trie of patterns: goto[state] maps characters to states
+        self.goto = [{}]
+        self.output = [[]]
+        for pattern, outputs in patterns.items():
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].extend(outputs)
+        # Failure links, found breadth first: the longest proper suffix of
+        # each state's string which is also in the trie
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                f = self.fail[state]
+                while f and char not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(char, 0)
+                # A state also outputs everything its failure state outputs
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def normalise(self, msg):
+        """
+        :param msg: message
+        :return: normalised message, with spaces around each word
+        """
+        return ' {} '.format(' '.join(phrase_key(msg, self.rules)))
+
+    def find(self, msg):
+        """
+        :param msg: message
+        :return: list of (code index, keyword) pairs for each match, in order
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        matches = []
+        for char in self.normalise(msg):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                matches.extend(output[state])
+        return matches
+
+    def code_hits(self, msgs):
+        """
+        :param msgs: list of messages
+        :return: boolean numpy array of shape [num_messages, num_codes],
+        True where a message contains a keyword of a code
+        """
+        import numpy as np
+        hits = np.zeros((len(msgs), self.n_codes), dtype='bool')
+        for i, msg in enumerate(msgs):
+            for k, _ in self.find(msg):
+                hits[i, k] = True
+        return hits
+
+    def describe(self, msg, code_names=None):
+        """
+        :param msg: message
+        :param code_names: (optional) names of codes
+        :return: string listing the keywords found, e.g. 'Water: biyo; Germs: jeermis'
+        """
+        found = dict.fromkeys(self.find(msg))
+        return '; '.join('{}: {}'.format(code_names[k] if code_names else k, keyword)
+                         for k, keyword in found)
+
+
+def load_keyword_matcher(keyword_file, directory='../data', rules=VARIANT_RULES):
+    """
+    :param keyword_file: keyword file name (without .txt file extension)
+    :param directory: directory of data files (default ../data)
+    :param rules: see variant_key
+    :return: KeywordMatcher
+    """
+    _, keywords = read_keyword_file(os.path.join(directory, keyword_file + '.txt'))
+    return KeywordMatcher(keywords, rules)
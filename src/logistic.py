@@ -1,14 +1,19 @@
 import pickle, os, numpy as np
-from sklearn import linear_model
-from sklearn.metrics import precision_recall_fscore_support
-import pandas
+from scipy import sparse
 
-def train(features, codes, penalty='l1', C=1, keywords=None, keyword_strength=1, keyword_weight=1, weight_option='balanced', smoothing=0):
+from bitmatrix import BitMatrix
+from instrument import stage, timed
+from bundle import ModelBundle
+
+@timed('logistic.train', items='features')
+def train(features, codes, penalty='l1', C=1, keywords=None, keyword_strength=1, keyword_weight=1, weight_option='balanced', smoothing=0, dtype=None, initial=None, tol=1e-4, max_iter=100):
     """
     Train logistic regression classifiers,
     independently for each code
     :param features: input matrix, of shape [num_messages, num_features]
+        (numpy array or scipy sparse matrix)
     :param codes: output matrix, of shape [num_messages, num_codes]
+        (numpy array, scipy sparse matrix, or BitMatrix)
     :param penalty: type of regularisation ('l1' or 'l2')
     :param C: inverse of regularisation strength
     :param keywords: (optional) list of length num_codes, with each element being
@@ -20,12 +25,35 @@ def train(features, codes, penalty='l1', C=1, keywords=None, keyword_strength=1,
         - 'smoothed': total weight is the observed number, plus smoothing
     :param smoothing: (default 0, i.e. no smoothing) constant to add,
         to reweight frequencies of each code
+    :param dtype: (optional) numpy data type to train in, e.g. 'float32' to halve
+        the memory used (default: that of features, or float64 for integer features)
+        - the classifiers' coefficients have the same type, except with penalty='l1'
+    :param initial: (optional) list of classifiers to start training from, e.g. from
+        the previous round of active learning, which is faster when the data has
+        changed little
+    :param tol: (default 1e-4) tolerance for stopping the optimiser
+    :param max_iter: (default 100) maximum number of iterations of the optimiser
+        - to compare models trained in different ways (e.g. dtypes), give both
+        a smaller tol and a larger max_iter, so that both converge
     :return: list of classifiers
     """
+    if dtype is None and features.dtype.kind not in 'f':
+        dtype = 'float64'
+    if dtype is not None:
+        # Convert once, rather than letting sklearn convert for every code
+        features = features.astype(dtype, copy=False)
     N, F = features.shape
     classifiers = []
     # Iterate through each code (i.e. each column of codes matrix)
-    for i, code_i in enumerate(codes.transpose()):
+    if isinstance(codes, BitMatrix):
+        columns = (codes.column(i) for i in range(codes.shape[1]))
+    elif sparse.issparse(codes):
+        # Only convert one column at a time to a dense vector
+        codes = sparse.csc_matrix(codes)
+        columns = (codes[:, i].toarray().ravel() for i in range(codes.shape[1]))
+    else:
+        columns = codes.transpose()
+    for i, code_i in enumerate(columns):
         # If there are no training examples, return None for this code
         N_pos = code_i.sum()
         if N_pos == 0:
@@ -43,13 +71,17 @@ def train(features, codes, penalty='l1', C=1, keywords=None, keyword_strength=1,
             indices = keywords[i]
             N_key = len(indices)
             # Treat each keyword feature as a separate message
-            key_features = np.zeros((N_key, F))
+            key_features = np.zeros((N_key, F), dtype=features.dtype)
             for j, j_ind in enumerate(indices):
                 # Set the strength of the feature as asked for
                 key_features[j, j_ind] = keyword_strength
             key_codes = np.ones(N_key, dtype='bool')
             # Extend the feature and code arrays
-            feat_mat = np.concatenate((features, key_features))
+            if sparse.issparse(features):
+                feat_mat = sparse.vstack((features, sparse.csr_matrix(key_features)),
+                                         format='csr')
+            else:
+                feat_mat = np.concatenate((features, key_features))
             code_vec = np.concatenate((code_i, key_codes))
         
         # Weight classes as asked for
@@ -70,10 +102,19 @@ def train(features, codes, penalty='l1', C=1, keywords=None, keyword_strength=1,
             sample_weight[N:] = keyword_weight
         
         # Initialise a logistic regression model
-        model = linear_model.LogisticRegression(penalty=penalty, C=C, class_weight=class_weight)
+        # (sklearn is only imported when training, as it is slow to import)
+        from sklearn import linear_model
+        model = linear_model.LogisticRegression(penalty=penalty, C=C, class_weight=class_weight,
+                                                tol=tol, max_iter=max_iter)
+        # Start from the given coefficients, if possible
+        if initial is not None and initial[i] is not None and initial[i].coef_.shape[1] == F:
+            model.set_params(warm_start=True)
+            model.coef_ = initial[i].coef_.copy()
+            model.intercept_ = initial[i].intercept_.copy()
         
         # Train the model
-        model.fit(feat_mat, code_vec, sample_weight=sample_weight)
+        with stage('logistic.fit', code=i, items=N + N_key):
+            model.fit(feat_mat, code_vec, sample_weight=sample_weight)
         
         classifiers.append(model)
     
@@ -109,42 +150,66 @@ def train_on_file(input_name, output_suffix=None, directory='../data', keyword_f
     return features, codes, classifiers
 
 
-def predict(classifiers, messages):
+@timed('logistic.predict', items='messages')
+def predict(classifiers, messages, thresholds=None):
     """
     Apply a number of classifiers to a number of messages,
     returning the most likely result for each classfier ond message
-    :param classifiers: classifier or list of classifiers
+    :param classifiers: classifier, list of classifiers, or ModelBundle
     :param messages: feature vectors (as a matrix)
+    :param thresholds: (optional) probability threshold for each classifier
+        (by default, a bundle's stored thresholds are used if it has them, and 0.5 otherwise)
     :return: array of predictions
     """
+    # Apply thresholds to probabilities
+    if thresholds is not None:
+        pred = predict_prob(classifiers, messages) >= thresholds
+        # Never predict codes without a classifier (whatever their threshold)
+        if isinstance(classifiers, ModelBundle):
+            pred[:, ~classifiers.present] = False
+        elif isinstance(classifiers, list):
+            pred[:, [c is None for c in classifiers]] = False
+        return pred
+    # A bundle applies all of its classifiers at once
+    if isinstance(classifiers, ModelBundle):
+        return classifiers.predict(messages)
     # If more than one classifier is given, apply each
     if isinstance(classifiers, list):
         # Get the predictions from each classifier, giving zeros when a classifier is None
-        predictions = [c.predict(messages) if c is not None else np.zeros(len(messages)) for c in classifiers]
+        predictions = [c.predict(messages) if c is not None else np.zeros(messages.shape[0]) for c in classifiers]
         # Transpose so that the shape is (n_datapoints, n_classifiers)
 
         return np.array(predictions, dtype='bool').transpose()
     else:
         return classifiers.predict(messages)
 
-def predict_prob(classifiers, messages):
+@timed('logistic.predict_prob', items='messages')
+def predict_prob(classifiers, messages, dtype=None):
     """
     Apply a number of classifiers to a number of messages,
     returning the probability of predicting each code for each message
-    :param classifiers: classifier or list of classifiers
+    :param classifiers: classifier, list of classifiers, or ModelBundle
     :param messages: feature vectors (as a matrix)
+    :param dtype: (optional) numpy data type of the probabilities
+        (by default, this depends on the types of the messages and coefficients)
     :return: array of probabilities
     """
+    # A bundle applies all of its classifiers at once
+    if isinstance(classifiers, ModelBundle):
+        prob = classifiers.predict_prob(messages)
     # If more than one classifier is given, apply each
-    if isinstance(classifiers, list):
+    elif isinstance(classifiers, list):
         # Get the prediction probabilities from each classifier
         # c.predict_proba returns probabilities for [False, True]
         # taking [:,1] will just give us probability of True
-        prob = [c.predict_proba(messages)[:,1] if c is not None else np.zeros(len(messages)) for c in classifiers]
+        prob = [c.predict_proba(messages)[:,1] if c is not None else np.zeros(messages.shape[0]) for c in classifiers]
         # Transpose so that the shape is (n_datapoints, n_classifiers)
-        return np.array(prob).transpose()
+        prob = np.array(prob).transpose()
     else:
-        return classifiers.predict_proba(messages)[:,1]
+        prob = classifiers.predict_proba(messages)[:,1]
+    if dtype is not None:
+        prob = prob.astype(dtype, copy=False)
+    return prob
 
 
 
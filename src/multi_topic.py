@@ -0,0 +1,235 @@
+import csv
+import pickle
+from collections import namedtuple
+import numpy as np
+from scipy import sparse
+
+from bundle import load_model
+from features import bag_of_words, apply_to_parts, vectorise_sparse
+from ingest import read_header, read_columns, read_rows
+from instrument import stage
+from predict_multiple import add_training_messages
+
+# Predicting codes for several topics at once
+# The same messages are often classified for several topics, each with its own
+# vocabulary and classifiers. Rather than reading and extracting features for
+# each topic, we extract features once, and vectorise them with a superset
+# vocabulary (the union of all topics' vocabularies). For each topic, we keep
+# the superset index of each of its features, so its coefficients can be
+# placed in the superset feature space. The coefficients of all topics are
+# then stacked into one sparse matrix, and all topics are scored with a single
+# matrix product. Topics using a Weighting (which normalises vectors over the
+# topic's own vocabulary) are instead scored by projecting the superset
+# vectors onto the topic's vocabulary.
+# As in predict_multiple, each topic's output file has its predicted messages,
+# followed by its training messages with their codes from the training file
+# (with 'training' in the source column). Training messages are only added if
+# the topic gives the code columns of its training file.
+
+# Feature extractor for bundles saved without one (as used in predict_multiple)
+DEFAULT_EXTRACTOR = apply_to_parts(bag_of_words, '&&&')
+
+# A topic to predict: name of its dataset, weeks of messages to predict, and
+# (optionally) a training file, whose messages are excluded from prediction,
+# and the indices of the code columns in it, to write the training messages
+Topic = namedtuple('Topic', ['name', 'weeks', 'training_file', 'classifier_suffix',
+                             'code_columns'])
+Topic.__new__.__defaults__ = (None, 'C1', None)
+
+
+class MultiTopicModel:
+    """
+    Classifiers for several topics, sharing one feature space
+    """
+    def __init__(self, bundles, extractor=None):
+        """
+        :param bundles: dict mapping topic names to ModelBundles
+        :param extractor: feature extractor for all topics (default: the
+        extractor saved with the first bundle, or DEFAULT_EXTRACTOR)
+        - all bundles must have been trained with the same extractor
+        """
+        self.names = list(bundles)
+        self.bundles = bundles
+        if extractor is None:
+            saved = [b.extractor for b in bundles.values() if b.extractor is not None]
+            extractor = saved[0] if saved else DEFAULT_EXTRACTOR
+        self.extractor = extractor
+        key = pickle.dumps(extractor)
+        for name, b in bundles.items():
+            if b.extractor is not None and pickle.dumps(b.extractor) != key:
+                raise ValueError('Topic {} uses a different feature extractor'.format(name))
+
+        # Superset vocabulary, and each topic's map from its own indices to superset indices
+        self.feature_dict = {}
+        self.columns = {}
+        for name, b in bundles.items():
+            self.columns[name] = np.array([self.feature_dict.setdefault(f, len(self.feature_dict))
+                                           for f in b.vocabulary.feature_list()], dtype='int64')
+        F = len(self.feature_dict)
+
+        # Stack coefficients of topics without a Weighting, in the superset space
+        # (weights applied to feature values can be folded into the coefficients)
+        self.slices = {}
+        rows, cols, data, intercepts = [], [], [], []
+        K = 0
+        for name, b in bundles.items():
+            if b.weighting is not None:
+                continue
+            coef = np.asarray(b.coef, dtype='float64')
+            if b.weights is not None:
+                coef = coef * b.weights
+            r, c = np.nonzero(coef)
+            rows.append(r + K)
+            cols.append(self.columns[name][c])
+            data.append(coef[r, c])
+            intercepts.append(np.asarray(b.intercept, dtype='float64'))
+            self.slices[name] = slice(K, K + len(b.code_names))
+            K += len(b.code_names)
+        if K:
+            self.coef = sparse.csr_matrix((np.concatenate(data),
+                                           (np.concatenate(rows), np.concatenate(cols))),
+                                          shape=(K, F))
+            self.intercept = np.concatenate(intercepts)
+
+    def vectorise(self, msgs):
+        """
+        :param msgs: list of strings
+        :return: feature vectors in the superset vocabulary (CSR matrix)
+        """
+        with stage('features.extract', items=len(msgs)):
+            bags = [self.extractor(m) for m in msgs]
+        return vectorise_sparse(bags, self.feature_dict, 'float64')
+
+    def project(self, vectors, name):
+        """
+        :param vectors: feature vectors in the superset vocabulary
+        :param name: name of topic
+        :return: feature vectors in the topic's vocabulary
+        """
+        return vectors[:, self.columns[name]]
+
+    def predict_prob(self, vectors):
+        """
+        :param vectors: feature vectors in the superset vocabulary
+        :return: dict mapping topic names to probabilities,
+        of shape [num_messages, num_codes] (zero for codes without a classifier)
+        """
+        res = {}
+        if self.slices:
+            with stage('multi_topic.score', items=vectors.shape[0], topics=len(self.slices)):
+                z = (vectors @ self.coef.T).toarray() + self.intercept
+                prob = 1 / (1 + np.exp(-z))
+        for name, b in self.bundles.items():
+            if name in self.slices:
+                res[name] = prob[:, self.slices[name]]
+                res[name][:, ~b.present] = 0
+            else:
+                res[name] = b.predict_prob(b.weighting(self.project(vectors, name)))
+        return res
+
+    def predict(self, vectors):
+        """
+        :param vectors: feature vectors in the superset vocabulary
+        :return: dict mapping topic names to boolean predictions
+        (using each bundle's thresholds, if it has them)
+        """
+        res = {}
+        for name, prob in self.predict_prob(vectors).items():
+            b = self.bundles[name]
+            if b.thresholds is None:
+                res[name] = prob > 0.5
+            else:
+                res[name] = prob >= b.thresholds
+            res[name][:, ~b.present] = False
+        return res
+
+
+def predict_topics(input_file, topics, output_pattern='../data/{}_predictions.csv',
+                   text_col=5, week_col=4, id_col=0, directory='../data',
+                   extractor=None):
+    """
+    Predict codes for several topics, reading the input file and extracting
+    features only once, and write one output file per topic
+    (with the input columns, then one column per code, then 'source') - for
+    topics with code_columns, the training messages are written after the
+    predictions, as in predict_multiple
+
+    :param input_file: path to input csv file
+    :param topics: list of Topics
+    :param output_pattern: path of output files, with {} for the topic name
+    :param text_col: index of column containing text
+    :param week_col: index of column containing the week
+    :param id_col: index of column containing the message ID
+    :param directory: directory of data files (default ../data)
+    :param extractor: feature extractor (see MultiTopicModel)
+
+    :return: MultiTopicModel
+    """
+    bundles = {t.name: load_model(t.name, t.classifier_suffix, directory=directory)
+               for t in topics}
+    model = MultiTopicModel(bundles, extractor)
+
+    # Training messages of each topic, as dicts mapping IDs to rows of the
+    # training file (which is small, so keep the first row for each ID)
+    training_rows = {}
+    for t in topics:
+        if t.training_file is not None:
+            training_rows[t.name] = {}
+            for trow in read_rows(t.training_file):
+                training_rows[t.name].setdefault(trow[id_col], trow)
+    # Only topics with code columns need their training messages from the input file
+    training_ids = set()
+    for t in topics:
+        if t.training_file is not None and t.code_columns is not None:
+            training_ids.update(training_rows[t.name])
+
+    # Read the messages needed by any topic (training messages can be from any week)
+    all_weeks = sorted({w for t in topics for w in t.weeks})
+    headings = read_header(input_file)
+    rows = []
+    training = []
+    filters = None if training_ids else {week_col: all_weeks}
+    for chunk in read_columns(input_file, filters=filters):
+        rows.extend(chunk[chunk[week_col].isin(all_weeks)].values.tolist())
+        if training_ids:
+            training.extend(chunk[chunk[id_col].isin(training_ids)].values.tolist())
+    ids = np.array([r[id_col] for r in rows], dtype=object)
+    weeks = np.array([r[week_col] for r in rows], dtype=object)
+
+    # Score all topics at once
+    vectors = model.vectorise([r[text_col] for r in rows])
+    predictions = model.predict(vectors)
+
+    # Write each topic's messages
+    for t in topics:
+        keep = np.isin(weeks, list(t.weeks))
+        training_messages = []
+        if t.training_file is not None:
+            keep &= ~np.isin(ids, list(training_rows[t.name]))
+            if t.code_columns is not None:
+                # Copy the rows, since they are extended with each topic's codes
+                training_messages = add_training_messages(
+                    [list(r) for r in training if r[id_col] in training_rows[t.name]],
+                    training_rows[t.name], t.code_columns)
+        pred = predictions[t.name]
+        with stage('write', topic=t.name, items=int(keep.sum()) + len(training_messages)), \
+                open(output_pattern.format(t.name), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(headings + list(bundles[t.name].code_names) + ['source'])
+            for i in np.flatnonzero(keep):
+                writer.writerow(rows[i] + [1 if x else '' for x in pred[i]] + ['prediction'])
+            writer.writerows(training_messages)
+        print('{}: {} messages, {} predicted codes, {} training messages'.format(
+            t.name, int(keep.sum()), int(pred[keep].sum()), len(training_messages)))
+    return model
+
+
+if __name__ == "__main__":
+    predict_topics('../data/mediaink_s04_1804_yesnos.csv',
+                   [Topic('wash', '12', '../data/wash_training_long_1005.csv',
+                          code_columns=range(3, 17)),
+                    Topic('delivery', '34'),
+                    Topic('nutrition', '5'),
+                    Topic('malaria', '67', '../data/malaria_training_long_1105.csv',
+                          code_columns=range(3, 14)),
+                    Topic('hiv_aids', '8')])
@@ -0,0 +1,223 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+from preprocess import preprocess_long
+from logistic import train_on_file
+
+# A content-addressed cache for the files produced by each stage of the
+# pipeline. Each stage is identified by a fingerprint of everything it
+# depends on (input file contents, extractor, keyword arguments, and the
+# fingerprints of earlier stages). If a stage has already been run with the
+# same fingerprint, its output files are copied from the cache instead.
+
+
+def hash_file(path, block_size=2**20):
+    """
+    Calculate the SHA-256 hash of a file's contents
+
+    :param path: path to file
+    :param block_size: number of bytes to read at once
+
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def fingerprint(*parts):
+    """
+    Combine the inputs of a stage into a single key
+
+    :param parts: picklable objects (e.g. file hashes, extractors, dicts of
+    keyword arguments)
+
+    :return: hex digest
+    """
+    # Sort dicts, so that the order of keyword arguments does not matter
+    parts = [sorted(p.items()) if isinstance(p, dict) else p for p in parts]
+    return hashlib.sha256(pickle.dumps(parts)).hexdigest()
+
+
+class ArtifactCache:
+    """
+    Directory of cached stage outputs, with a bounded total size.
+    Each entry is a subdirectory named by its key. When the cache is too
+    large, the least recently used entries are removed.
+    """
+    def __init__(self, directory='../data/cache', max_bytes=2**30):
+        """
+        :param directory: directory to store cached files
+        :param max_bytes: maximum total size of cached files (default 1GB)
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry(self, key):
+        """
+        :param key: fingerprint of a stage
+        :return: path to the cache entry
+        """
+        return os.path.join(self.directory, key)
+
+    def restore(self, key, filenames, directory):
+        """
+        Copy cached files to an output directory, if they exist
+
+        :param key: fingerprint of a stage
+        :param filenames: names of output files of the stage
+        :param directory: directory to copy files to
+
+        :return: True if the files were restored, False otherwise
+        """
+        entry = self.entry(key)
+        if not all(os.path.exists(os.path.join(entry, x)) for x in filenames):
+            return False
+        for x in filenames:
+            shutil.copyfile(os.path.join(entry, x), os.path.join(directory, x))
+        # Mark as recently used
+        os.utime(entry)
+        return True
+
+    def store(self, key, filenames, directory):
+        """
+        Copy output files of a stage into the cache
+
+        :param key: fingerprint of a stage
+        :param filenames: names of output files of the stage
+        :param directory: directory containing the files
+        """
+        # Copy to a temporary directory first, so that an interrupted copy
+        # never looks like a complete entry
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        for x in filenames:
+            shutil.copyfile(os.path.join(directory, x), os.path.join(tmp, x))
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+        self.evict(keep=key)
+
+    def entries(self):
+        """
+        :return: list of (last use time, size in bytes, key) for each entry
+        """
+        res = []
+        for key in os.listdir(self.directory):
+            entry = self.entry(key)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, x))
+                       for x in os.listdir(entry))
+            res.append((os.path.getmtime(entry), size, key))
+        return res
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache is small enough
+
+        :param keep: key of an entry which should not be removed
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry(key))
+            total -= size
+
+
+def run_stage(cache, key, filenames, function, directory='../data',
+              verbose=True):
+    """
+    Run a stage of the pipeline, unless its outputs are cached
+
+    :param cache: ArtifactCache
+    :param key: fingerprint of the stage
+    :param filenames: names of the output files of the stage
+    :param function: function with no arguments, which runs the stage
+    :param directory: directory of data files (default ../data)
+    :param verbose: whether to print whether the stage was skipped
+
+    :return: True if the stage was run, False if it was skipped
+    """
+    if cache.restore(key, filenames, directory):
+        if verbose:
+            print('Restored from cache:', *filenames)
+        return False
+    function()
+    cache.store(key, filenames, directory)
+    return True
+
+
+def preprocess_and_train(input_file, name, extractor=None, vectoriser=None,
+                         preprocess=preprocess_long, preprocess_kwargs=None,
+                         suffix='C1', train_kwargs=None, keyword_file=None,
+                         directory='../data', cache=None):
+    """
+    Preprocess a csv file and train classifiers, skipping any stage whose
+    inputs have not changed since it was last run
+
+    :param input_file: input file name (without .csv file extension)
+    :param name: name of the preprocessed dataset
+    :param extractor: function mapping strings to bags of features
+    :param vectoriser: function mapping lists of strings to numpy arrays
+    :param preprocess: preprocessing function (e.g. preprocess_long or
+    preprocess_pairs)
+    :param preprocess_kwargs: additional keyword arguments for preprocess
+    :param suffix: suffix of the classifier file
+    :param train_kwargs: keyword arguments for logistic.train
+    :param keyword_file: name of keyword file (without .pkl file extension)
+    :param directory: directory of data files (default ../data)
+    :param cache: ArtifactCache (default: a cache in directory/cache)
+    """
+    if preprocess_kwargs is None:
+        preprocess_kwargs = {}
+    if train_kwargs is None:
+        train_kwargs = {}
+    if cache is None:
+        cache = ArtifactCache(os.path.join(directory, 'cache'))
+
+    # Preprocessing depends on the csv file and the feature configuration
+    source = hash_file(os.path.join(directory, input_file + '.csv'))
+    pre_key = fingerprint('preprocess', preprocess.__name__, source,
+                          extractor, vectoriser, preprocess_kwargs)
+    pre_files = [name + '.pkl', name + '_codes.pkl', name + '_codes.txt']
+    if extractor is not None:
+        pre_files += [name + '_features.pkl', name + '_features.txt']
+    run_stage(cache, pre_key, pre_files,
+              lambda: preprocess(input_file, name, extractor, vectoriser,
+                                 directory, **preprocess_kwargs),
+              directory)
+
+    # Training depends on the preprocessed data, keywords and parameters
+    if keyword_file is not None:
+        keywords = hash_file(os.path.join(directory, keyword_file + '.pkl'))
+    else:
+        keywords = None
+    train_key = fingerprint('train', pre_key, keywords, train_kwargs)
+    run_stage(cache, train_key, ['{}_{}.pkl'.format(name, suffix)],
+              lambda: train_on_file(name, suffix, directory, keyword_file,
+                                    **train_kwargs),
+              directory)
+
+
+if __name__ == "__main__":
+    from features import bag_of_words, bag_of_ngrams, combine
+
+    feature_extractor = combine([bag_of_words, bag_of_ngrams],
+                                kwarg_params=[{}, {'n': 2}])
+    # Rerunning with a different value of C only repeats training
+    preprocess_and_train('wash_s04_training_long_1705', 'wash_s04',
+                         feature_extractor,
+                         preprocess_kwargs={'ignore_cols': [0, 1],
+                                            'text_col': 2},
+                         suffix='C1', train_kwargs={'C': 1})
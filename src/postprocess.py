@@ -1,27 +1,103 @@
-import os, pickle, numpy as np
+import csv, os, numpy as np
+from scipy import sparse
 
-def highest(classifiers, N=10):
+from bundle import ModelBundle, load_model
+from features import feature_name
+
+def coefficient_matrix(classifiers):
+    """
+    Stack the weights of many classifiers into one matrix
+    :param classifiers: list of LogisticRegression models, or ModelBundle
+    - models may store coefficients sparsely (after calling sparsify)
+    :return: matrix of shape (n_classifiers, n_features) (sparse if any model is sparse),
+        boolean array of which classifiers are present
+    """
+    if isinstance(classifiers, ModelBundle):
+        return classifiers.coef, np.asarray(classifiers.present)
+    present = np.array([c is not None for c in classifiers])
+    rows = [c.coef_ for c in classifiers if c is not None]
+    if not rows:
+        return np.zeros((len(classifiers), 0)), present
+    F = rows[0].shape[1]
+    # Missing classifiers have no weights
+    rows = [c.coef_ if c is not None else sparse.csr_matrix((1, F)) for c in classifiers]
+    if any(sparse.issparse(r) for r in rows):
+        return sparse.vstack(rows, format='csr'), present
+    return np.vstack(rows), present
+
+
+def top_of_rows(values, N):
+    """
+    Find the indices of the N highest values in each row of a matrix, in descending order
+    :param values: dense matrix
+    :param N: number of indices to return
+    :return: matrix of indices, with -1 where a value is not positive
+    """
+    K, F = values.shape
+    res = np.full((K, N), -1, dtype='int64')
+    n = min(N, F)
+    if n == 0:
+        return res
+    # Partition all rows at once, then sort just the top N of each
+    top = np.argpartition(-values, n - 1, axis=1)[:, :n]
+    top_values = np.take_along_axis(values, top, 1)
+    order = np.argsort(-top_values, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, 1)
+    top[np.take_along_axis(top_values, order, 1) <= 0] = -1
+    res[:, :n] = top
+    return res
+
+
+def highest(classifiers, N=10, negative=False):
     """
     Find the features most associated with each class
-    :param classifiers: list of LogisticRegression models
+    :param classifiers: list of LogisticRegression models, or ModelBundle
     :param N: number of features to return
-    :return: top features for each classifier (as a matrix)
-    """
-    res = np.zeros((len(classifiers), N), dtype='int64')
-    for i, c in enumerate(classifiers):
-        if c is not None:
-            # Get weights for each feature (squeeze to change shape from (1,K) to (K))
-            coef = c.coef_.squeeze()
-            # Get the indices of the highest N weights, in descending order
-            top = coef.argsort()[:-N-1:-1]
-            # If a weight is not positive, set the index to -1
-            top[coef[top] <= 0] = -1
-            # Keep this result 
-            res[i] = top
-        else:
-            res[i] = -1
+    :param negative: if True, find the features most associated with not having each class
+    :return: top features for each classifier (as a matrix), with -1 padding if there are
+        fewer than N features with positive weights (or negative weights, if negative is True)
+    """
+    coef, present = coefficient_matrix(classifiers)
+    sign = -1 if negative else 1
+    if sparse.issparse(coef):
+        # Only consider the nonzero weights (a zero weight is never returned)
+        res = np.full((coef.shape[0], N), -1, dtype='int64')
+        for i in range(coef.shape[0]):
+            start, end = coef.indptr[i], coef.indptr[i + 1]
+            top = top_of_rows(sign * coef.data[None, start:end], N)[0]
+            res[i, top >= 0] = coef.indices[start:end][top[top >= 0]]
+    else:
+        res = top_of_rows(sign * np.asarray(coef), N)
+    res[~present] = -1
     return res
 
+
+def feature_table(classifiers, feature_list, code_names, output_file, N=20, directory='../data'):
+    """
+    Save the top positive and negative features for each code, as a csv file
+    with one row per code, direction and rank
+    :param classifiers: list of LogisticRegression models, or ModelBundle
+    :param feature_list: list of features (or bundle Vocabulary)
+    :param code_names: list of names of codes
+    :param output_file: name of output file (without .csv file extension)
+    :param N: number of features in each direction (default 20)
+    :param directory: directory of data files (default ../data)
+    """
+    coef, _ = coefficient_matrix(classifiers)
+    if hasattr(feature_list, 'feature'):
+        name = lambda x: feature_name(feature_list.feature(x))
+    else:
+        name = lambda x: feature_name(feature_list[x])
+    with open(os.path.join(directory, output_file + '.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['code', 'direction', 'rank', 'feature', 'weight'])
+        for direction, negative in [('positive', False), ('negative', True)]:
+            top = highest(classifiers, N, negative)
+            for code, feats, i in zip(code_names, top, range(len(code_names))):
+                for rank, x in enumerate(feats[feats >= 0], 1):
+                    writer.writerow([code, direction, rank, name(x), float(coef[i, x])])
+
+
 def display(dataset, classifier_suffix, code_suffix='codes', feature_suffix='features', directory='../data'):
     """
     Display the top features for each code
@@ -33,22 +109,28 @@ def display(dataset, classifier_suffix, code_suffix='codes', feature_suffix='fea
     - {dataset}_{classifier_suffix}.pkl
     - {dataset}_{code_suffix}.pkl
     - {dataset}_{feature_suffix}.pkl
+    These are converted to a model bundle the first time (see bundle.load_model)
     :param directory: directory of data files (default ../data)
     """
-    with open(os.path.join(directory, '{}_{}.pkl'.format(dataset, classifier_suffix)), 'rb') as f:
-        classifiers = pickle.load(f)
-    top = highest(classifiers)
-    with open(os.path.join(directory, '{}_{}.pkl'.format(dataset, code_suffix)), 'rb') as f:
-        codes = pickle.load(f)
-    code_list = [x for x, _ in codes]
-    with open(os.path.join(directory, '{}_{}.pkl'.format(dataset, feature_suffix)), 'rb') as f:
-        feats = pickle.load(f)
-    feat_list = [x for x, _ in feats]
-    for name, best_feats in zip(code_list, top):
+    print_top_features(load_model(dataset, classifier_suffix, code_suffix, feature_suffix, directory))
+
+
+def print_top_features(bundle, N=10):
+    """
+    Print the top features for each code of a model bundle
+    :param bundle: ModelBundle (e.g. from bundle.load_model)
+    :param N: number of features to print for each code (default 10)
+    """
+    top = highest(bundle, N)
+    vocabulary = bundle.vocabulary
+    for name, best_feats in zip(bundle.code_names, top):
         print(name)
-        print([feat_list[x] for x in best_feats if x >= 0])
+        # Only decode the features we need
+        print([vocabulary.feature(x) for x in best_feats if x >= 0])
         print()
-    
+
 
 if __name__ == "__main__":
-    display('nutrition', 'C1')
+    classifiers = load_model('nutrition', 'C1')
+    print_top_features(classifiers)
+    feature_table(classifiers, classifiers.vocabulary, classifiers.code_names, 'nutrition_C1_top_features')
@@ -1,100 +1,167 @@
-import csv, pickle, numpy as np
-#from collections import Counter
+import csv
 
-from logistic import predict
-from features import bag_of_words, vectorise, apply_to_parts
+from logistic import predict, predict_prob
+from features import bag_of_words, vectorise_sparse, apply_to_parts
+from bundle import load_model
+from explain import explanation_strings
+from ingest import read_header, read_columns
+from instrument import stage
+from keywords import load_keyword_matcher
+
+# Predict codes for all messages from some weeks, and save them together with
+# the training messages
+# To record how long each stage takes, set the environment variable SMS_RUN_LOG
+# to the name of a JSON file (see instrument.py)
 
 #name, weeks, code_columns = 'wash', '12', range(3, 17)
 #name, weeks, code_columns = 'delivery', '34', range(2, 19)
 #name, weeks, code_columns = 'nutrition', '5', range(3, 13)
 #name, weeks, code_columns = 'malaria', '67', range(3, 14)
 #name, weeks, code_columns = 'hiv_aids', '8', range(3, 18)
-name, weeks, code_columns = 'wash_s04', '3', range(3, 17)
-
-
-# Get the unlabelled data, excluding training set
-
-msgs = []
-training = []
-
-#with open('../data/messages_beliefs_s02_full_1804.csv', newline='') as f, open('../data/wash_training_long_1005.csv', newline='') as trainingf:
-with open('../data/mediaink_s04_1804_yesnos.csv', newline='') as f, open('../data/wash_s04_training_long_1705.csv', newline='') as trainingf:
-#with open('../data/malaria_full.csv', newline='') as f, open('../data/malaria_training_long_1105.csv', newline='') as trainingf:
-
-    reader = list(csv.reader(f)) #, delimiter='\t'))
-    training_reader = list(csv.reader(trainingf))
-    mids = [row[0] for row in training_reader]
-    headings = reader[0]
-
-    for row in reader:
-        if row[4] in weeks and row[0] not in mids:
-                msgs.append(row)
-
-
-# Vectorise the data
-
-with open('../data/{}_features.pkl'.format(name), 'rb') as f:
-    feats = pickle.load(f)
-feat_list = [x for x,_ in feats]
-feat_dict = {x:i for i,x in enumerate(feat_list)}
-
-featurise = apply_to_parts(bag_of_words, '&&&')
-feat_vecs = vectorise([featurise(x[5]) for x in msgs], feat_dict)
-
-# Load the classifiers and codes
-
-with open('../data/{}_C1.pkl'.format(name), 'rb') as f:
-    classifiers = pickle.load(f)
-
-with open('../data/{}_codes.pkl'.format(name), 'rb') as f:
-    codes = pickle.load(f)
-code_names = [x for x,_ in codes]
-print(code_names)
-headings.extend(code_names)
-headings.extend(['source'])
-
-# Make predictions
-
-predictions = predict(classifiers, feat_vecs)
-for i, m in enumerate(msgs):
-    m.extend([1 if x else '' for x in predictions[i]])
-    m.extend(['prediction'])
-
-
-seen_messages = set()
-training_messages = []
-
-def add_training_messages(code_columns):
-    for row in reader[1:]:
-        if row[0] in mids:
-            for trow in training_reader:
-                if row[0] == trow[0]:
-                    if row[0] in seen_messages:
-                        continue
-                    seen_messages.add(row[0])
-                    row.extend([trow[c] for c in code_columns])
-                    row.extend(['training'])
-                    training_messages.append(row)
-
-add_training_messages(code_columns)
-
-# Print overall counts for each code
-
-all_messages = msgs + training_messages
-
-#print([sum(message[column] for message in all_messages for column in code_columns)])
-
-
-for i, column in enumerate(code_columns):
-    print(column)
-    print(code_names[i])
-
-    #print(code_names[i] + ': ' + str(sum(message[column] for message in all_messages)))
-
-# Save the data with the predictions
-
-with open('../data/{}_predictions_s02_1805.csv'.format(name), 'w', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(headings)
-    writer.writerows(msgs)
-    writer.writerows(training_messages)
+NAME, WEEKS, CODE_COLUMNS = 'wash_s04', '3', range(3, 17)
+
+#input_file, training_file = '../data/messages_beliefs_s02_full_1804.csv', '../data/wash_training_long_1005.csv'
+INPUT_FILE, TRAINING_FILE = '../data/mediaink_s04_1804_yesnos.csv', '../data/wash_s04_training_long_1705.csv'
+#input_file, training_file = '../data/malaria_full.csv', '../data/malaria_training_long_1105.csv'
+
+
+def read_messages(input_file, training_file, weeks):
+    """
+    Get the unlabelled data from some weeks, and the training messages
+
+    :param input_file: path to csv file of all messages
+    :param training_file: path to csv file of training messages
+    :param weeks: weeks to predict (e.g. '12' for weeks 1 and 2)
+
+    :return: headings, unlabelled rows, training rows from the input file,
+    and dict mapping IDs to rows of the training file
+    """
+    # The training file is small, so keep the first row for each ID
+    training_rows = {}
+    with open(training_file, newline='') as trainingf:
+        for trow in csv.reader(trainingf):
+            training_rows.setdefault(trow[0], trow)
+    mids = set(training_rows)
+
+    headings = read_header(input_file)
+
+    msgs = []
+    training = []
+
+    # Read the full file in chunks, splitting off training messages
+    for chunk in read_columns(input_file):
+        is_training = chunk[0].isin(mids)
+        msgs.extend(chunk[~is_training & chunk[4].isin(list(weeks))].values.tolist())
+        training.extend(chunk[is_training].values.tolist())
+    return headings, msgs, training, training_rows
+
+
+def add_training_messages(training, training_rows, code_columns):
+    """
+    Add the codes of training messages (each message is only kept once)
+
+    :param training: rows of the input file for training messages
+    :param training_rows: dict mapping IDs to rows of the training file
+    :param code_columns: indices of code columns in the training file
+
+    :return: list of rows, with codes and source added
+    """
+    seen_messages = set()
+    training_messages = []
+    for row in training:
+        if row[0] in seen_messages:
+            continue
+        seen_messages.add(row[0])
+        trow = training_rows[row[0]]
+        row.extend([trow[c] for c in code_columns])
+        row.extend(['training'])
+        training_messages.append(row)
+    return training_messages
+
+
+def main(name=NAME, weeks=WEEKS, code_columns=CODE_COLUMNS, input_file=INPUT_FILE,
+         training_file=TRAINING_FILE, output_file='../data/{}_predictions_s02_1805.csv',
+         explain_predictions=True, keyword_file=None, probabilities=False):
+    """
+    Predict codes and save them, with the training messages
+
+    :param name: name of the dataset the classifiers were trained on
+    :param weeks: weeks to predict
+    :param code_columns: indices of code columns in the training file
+    :param input_file: path to csv file of all messages
+    :param training_file: path to csv file of training messages
+    :param output_file: path of output file, with {} for the name
+    :param explain_predictions: whether to add columns listing the features
+    behind each predicted code
+    :param keyword_file: (optional) name of keyword file (without .txt file
+    extension) - if given, add a column listing the keywords in each message
+    :param probabilities: whether to add a column with the probability of
+    each code (e.g. to weight verification samples, see select_random)
+    """
+    headings, msgs, training, training_rows = read_messages(input_file, training_file, weeks)
+
+    # Load the classifiers, codes and features
+
+    classifiers = load_model(name, 'C1')
+    code_names = classifiers.code_names
+
+    # Vectorise the data
+
+    featurise = apply_to_parts(bag_of_words, '&&&')
+    with stage('features.extract', items=len(msgs)):
+        bags = [featurise(x[5]) for x in msgs]
+    feat_vecs = vectorise_sparse(bags, classifiers.vocabulary, 'float64')
+
+    print(code_names)
+    headings.extend(code_names)
+    headings.extend(['source'])
+    if explain_predictions:
+        headings.extend([x + ' (features)' for x in code_names])
+    if keyword_file is not None:
+        matcher = load_keyword_matcher(keyword_file)
+        headings.append('keywords')
+    if probabilities:
+        headings.extend([x + ' (probability)' for x in code_names])
+
+    # Make predictions
+
+    predictions = predict(classifiers, feat_vecs)
+    if explain_predictions:
+        explanations = explanation_strings(feat_vecs, classifiers, classifiers.vocabulary, predictions)
+    if probabilities:
+        prob = predict_prob(classifiers, feat_vecs).round(4)
+    for i, (m, pred) in enumerate(zip(msgs, predictions.tolist())):
+        m.extend([1 if x else '' for x in pred])
+        m.extend(['prediction'])
+        if explain_predictions:
+            m.extend(explanations[i])
+        if keyword_file is not None:
+            m.append(matcher.describe(m[5], code_names))
+        if probabilities:
+            m.extend(prob[i].tolist())
+
+    training_messages = add_training_messages(training, training_rows, code_columns)
+
+    # Print overall counts for each code
+
+    all_messages = msgs + training_messages
+
+    for code, count in zip(code_names, predictions.sum(axis=0).tolist()):
+        print('{}: {} predicted'.format(code, count))
+
+    for i, column in enumerate(code_columns):
+        print(column)
+        print(code_names[i])
+
+    # Save the data with the predictions
+
+    with stage('write', items=len(all_messages)), \
+            open(output_file.format(name), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headings)
+        writer.writerows(msgs)
+        writer.writerows(training_messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
-import csv
 import pickle
 import os
+from array import array
 import numpy as np
+from scipy import sparse
 from warnings import warn
 
-from features import (get_global_set, feature_list_and_dict, vectorise,
-                      document_frequency, Vectoriser)
+from bitmatrix import BitMatrix
+from features import (feature_list_and_dict, vectorise, document_frequency,
+                      filter_by_frequency, Vectoriser)
+from corpus import corpus_statistics
+from instrument import stage, timed
+from ingest import read_header, read_columns, iter_column, read_rows
+from keywords import load_keyword_index, read_keyword_file
 
 
 def save_pkl_txt(name_freq, filename, directory='../data'):
@@ -23,13 +29,17 @@ def save_pkl_txt(name_freq, filename, directory='../data'):
             f.write('{}\t{}\n'.format(name, freq))
 
 
+@timed('preprocess.save', items='msgs')
 def save(msgs, code_vecs, code_names, output_file, extractor=None,
-         vectoriser=None, directory='../data'):
+         vectoriser=None, directory='../data', min_df=None, max_df=None,
+         max_features=None, dtype='float64'):
     """
     Save features and codes to file
 
     :param msgs: list of strings (supervised learning input)
-    :param code_vecs: boolean numpy matrix of codes (supervised learning output)
+    :param code_vecs: boolean matrix of codes (supervised learning output),
+    as a numpy array, scipy sparse matrix, or BitMatrix
+    (codes are saved as a BitMatrix)
     - rows correspond to elements in feat_bags
     - columns correspond to elements in code_names
     :param code_names: list of names of codes
@@ -43,6 +53,13 @@ def save(msgs, code_vecs, code_names, output_file, extractor=None,
     :param extractor: function mapping strings to bags of features
     :param vectoriser: function mapping lists of strings to numpy arrays
     :param directory: directory of data files (default ../data)
+    :param min_df: minimum document frequency to keep a feature
+    :param max_df: maximum document frequency to keep a feature
+    (int for a count, float for a proportion of messages)
+    :param max_features: maximum number of features to keep (most frequent)
+    :param dtype: numpy data type of feature vectors (default float64)
+    - e.g. 'float32', or 'uint16' to store counts (see features.vectorise)
+    (the last four options only apply when an extractor is given)
     """
     # Check that input dimensions match
     N = len(msgs)
@@ -56,46 +73,28 @@ def save(msgs, code_vecs, code_names, output_file, extractor=None,
     else:
         # If we just have a feature extractor, we must define indices of features
         # Extract features
-        feat_bags = [extractor(m) for m in msgs]
-        # Get the global set of features
-        feat_set = get_global_set(feat_bags)
-        feat_list, feat_dict = feature_list_and_dict(feat_set)
+        with stage('features.extract', items=N):
+            feat_bags = [extractor(m) for m in msgs]
+        # Find the document frequency of each feature, and prune the vocabulary
+        feat_freq = document_frequency(feat_bags)
+        feat_freq = filter_by_frequency(feat_freq, min_df, max_df,
+                                        max_features, n_docs=N)
+        feat_list, feat_dict = feature_list_and_dict(feat_freq)
         # Convert messages to vectors
-        feat_vecs = vectorise(feat_bags, feat_dict)
-        # Find the document frequency of each feature and save features to file
-        feat_freq = (feat_vecs != 0).sum(0)
-        # Convert from Numpy to Python data types
-        feats = list(zip(feat_list, [int(x) for x in feat_freq]))
+        feat_vecs = vectorise(feat_bags, feat_dict, dtype)
+        # Save features to file
+        feats = [(feat, feat_freq[feat]) for feat in feat_list]
         save_pkl_txt(feats, output_file + '_features', directory)
 
-    # Find the frequency of each code
-    code_freq = code_vecs.sum(0)
-
-    # Get the global set of features
-    feat_set = get_global_set(feat_bags)
-    feat_list, feat_dict = feature_list_and_dict(feat_set)
-    # Convert messages to vectors
-    feat_vecs = vectorise(feat_bags, feat_dict)
-    # Find the document frequency of each feature
-    feat_freq = (feat_vecs != 0).sum(0)
-
-    # Save the features and codes to file,
-    # as a list of names and frequencies
-
-    feats = list(zip(feat_list, feat_freq))
-    with open(os.path.join(directory, output_file + '_features.pkl'), 'wb') as f:
-        pickle.dump(feats, f)
-
-    codes = list(zip(code_names, code_freq))
-    with open(os.path.join(directory, output_file + '_codes.pkl'), 'wb') as f:
-        pickle.dump(codes, f)
+    # Store codes with one bit per message and code, and find their frequencies
+    code_vecs = BitMatrix(code_vecs)
+    code_freq = code_vecs.counts()
 
     # Save the codes to file
     # Convert from Numpy to Python data types
     codes = list(zip(code_names, [int(x) for x in code_freq]))
     save_pkl_txt(codes, output_file + '_codes', directory)
 
-
     print('Codes:')
     print(*codes, sep='\n')
 
@@ -104,9 +103,10 @@ def save(msgs, code_vecs, code_names, output_file, extractor=None,
         pickle.dump((feat_vecs, code_vecs), f)
 
 
+@timed('preprocess.preprocess_long')
 def preprocess_long(input_file, output_file, extractor=None, vectoriser=None,
                     directory='../data', text_col=2, ignore_cols=(),
-                    convert=bool):
+                    convert=bool, dtype='float64'):
     """
     Preprocess a csv file to feature vectors and binary codes,
     where the input data has a 0 or 1 for each code and message
@@ -119,6 +119,7 @@ def preprocess_long(input_file, output_file, extractor=None, vectoriser=None,
     :param text_col: index of column containing text
     :param ignore_cols: indices of columns to ignore
     :param convert: function to convert code strings (e.g. bool or int)
+    :param dtype: numpy data type of feature vectors (see save)
     """
     if extractor is None and vectoriser is None:
         raise TypeError('Either extractor or vectoriser must be given')
@@ -131,36 +132,41 @@ def preprocess_long(input_file, output_file, extractor=None, vectoriser=None,
     msgs = []
     code_vecs = []
 
-    with open(os.path.join(directory, input_file + '.csv'), newline='') as f:
-        # Process the file as a CSV file
-        reader = csv.reader(f)
-        # Find the headings (the first row of the file)
-        headings = next(reader)
-        # Restrict ourselves to a subset of columns (not containing text, and not ignored) 
-        code_cols = sorted(set(range(len(headings))) - {text_col} - set(ignore_cols))
-        code_names = [headings[i] for i in code_cols]
-        # Iterate through data
-        for row in reader:
-            # Get the bag of features, and the vector of codes
-            msgs.append(row[text_col])
-            code_vecs.append(np.array([convert(row[i]) for i in code_cols], dtype='bool'))
+    filename = os.path.join(directory, input_file + '.csv')
+    # Find the headings (the first row of the file)
+    headings = read_header(filename)
+    # Restrict ourselves to a subset of columns (not containing text, and not ignored) 
+    code_cols = sorted(set(range(len(headings))) - {text_col} - set(ignore_cols))
+    code_names = [headings[i] for i in code_cols]
+    # Iterate through data, reading only the columns we need, in chunks
+    for chunk in read_columns(filename, [text_col] + code_cols):
+        # Get the messages, and the vectors of codes
+        msgs.extend(chunk[text_col].tolist())
+        # Only convert each distinct value once
+        values, inverse = np.unique(chunk[code_cols].to_numpy(), return_inverse=True)
+        converted = np.array([convert(x) for x in values], dtype='bool')
+        code_vecs.append(converted[inverse].reshape(len(chunk), len(code_cols)))
 
     # Convert the list of code vectors to a matrix
-    code_vecs = np.array(code_vecs)
+    code_vecs = np.concatenate(code_vecs) if code_vecs else np.zeros((0, len(code_cols)), dtype='bool')
 
     # Save the information
-    save(msgs, code_vecs, code_names, output_file, extractor, vectoriser, directory)
+    save(msgs, code_vecs, code_names, output_file, extractor, vectoriser, directory,
+         dtype=dtype)
 
 
+@timed('preprocess.preprocess_pairs')
 def preprocess_pairs(input_file, output_file, extractor=None, vectoriser=None,
                      directory='../data', text_col=0, ignore_cols=(),
-                     uncoded=('', 'NM'), triples=False):
+                     uncoded=('', 'NM'), triples=False, group_size=2,
+                     groups=None, dtype='float64'):
 
     """
     Preprocess a csv file to feature vectors and binary codes,
     where the input data has groups of codes,
-    and each message has up to two codes from each group.
-    Each group must take up exactly two columns.
+    and each message has up to one code from each column in a group.
+    By default, each group takes up exactly two consecutive columns.
+    Codes are saved as a sparse boolean matrix.
 
     :param input_file: input file name (without .csv file extension)
     :param output_file: output file name (without .pkl file extension)
@@ -169,72 +175,66 @@ def preprocess_pairs(input_file, output_file, extractor=None, vectoriser=None,
     :param text_col: index of column containing text
     :param ignore_cols: indices of columns to ignore
     :param uncoded: strings to be interpreted as lacking a code
+    :param triples: group columns in threes (the same as group_size=3)
+    :param group_size: number of consecutive columns in each group (default 2)
+    :param groups: (optional) list of tuples of column indices, one per group
+    (if given, ignore_cols, triples and group_size are not used)
+    :param dtype: numpy data type of feature vectors (see save)
     """
     if extractor is None and vectoriser is None:
         raise TypeError('Either extractor or vectoriser must be given')
     if extractor and vectoriser:
         raise TypeError('Only one of extractor and vectoriser should be given')
 
-    # Extract features and codes
-    # We cannot vectorise these until we have a global list
-
-    msgs = []
-    code_sets = []
-
-    with open(os.path.join(directory, input_file + '.csv'), newline='') as f:
-        # Process the file as a CSV file
-        reader = csv.reader(f)
-
-        # Find the headings (the first row of the file)
-        headings = next(reader)
-        # Restrict ourselves to a subset of columns (not containing text, and not ignored) 
-        code_cols = sorted(set(range(len(headings))) - {text_col} - set(ignore_cols))
-        # Group columns in pairs
-        pair_indices = list(zip(code_cols[::2], code_cols[1::2]))
-        pair_names = [headings[i][:-1].strip() for i in code_cols[::2]]
-
+    filename = os.path.join(directory, input_file + '.csv')
+    # Find the headings (the first row of the file)
+    headings = read_header(filename)
+    if groups is None:
         if triples:
-            # 3 reasons in HIV/AIDS data
-            pair_indices = [(4, 5, 6), (7, 8, 9)]
-            pair_names = [headings[i][:-1].strip() for i in code_cols[::3]]
-
-        print('names: ', pair_names)
-
-        # Find features and codes
-        for row in reader:
-            # Find words in message
-            msgs.append(row[text_col])
-            # Find codes
-            row_code_set = set()
-            for name, inds in zip(pair_names, pair_indices):
-                # The code is recorded as a tuple (pair_name, value)
-                # If a code is repeated, it is only counted once
-                row_code_set |= {(name, row[i])
-                                 for i in inds if row[i] not in uncoded}
-            code_sets.append(row_code_set)
-
-    # Get the global set of codes, and convert to vectors
-
-    codes = get_global_set(code_sets)
-    K = len(codes)
-    code_list, code_dict = feature_list_and_dict(codes)
-
-    def vectorise_codes(set_of_codes):
-        """
-        Convert names of codes to a vector
-        :param set_of_codes: set of code names
-        :return: numpy array
-        """
-        vec = np.zeros(K, dtype='bool')
-        for c in set_of_codes:
-            vec[code_dict[c]] = True
-        return vec
-
-    code_vecs = np.array([vectorise_codes(x) for x in code_sets])
+            group_size = 3
+        # Restrict ourselves to a subset of columns (not containing text, and not ignored)
+        code_cols = sorted(set(range(len(headings))) - {text_col} - set(ignore_cols))
+        # Group consecutive columns (any incomplete group at the end is dropped)
+        groups = [tuple(code_cols[i:i + group_size])
+                  for i in range(0, len(code_cols) - group_size + 1, group_size)]
+    # Each group is named after its first column, without the final number
+    group_names = [headings[g[0]][:-1].strip() for g in groups]
+
+    print('names: ', group_names)
+
+    # Find messages and codes
+    # Each code is a pair (group_name, value), which is given an integer id
+    # the first time it is seen, so that for each message we only need to
+    # store the ids of its codes (as in a CSR matrix)
+    columns = [text_col] + [i for g in groups for i in g]
+    column_names = [name for name, g in zip(group_names, groups) for _ in g]
+    uncoded = set(uncoded)
+    code_ids = {}
+    msgs = []
+    indices = array('q')
+    indptr = array('q', [0])
+    for row in read_rows(filename, columns=columns):
+        msgs.append(row[0])
+        # If a code is repeated, it is only counted once
+        row_ids = {code_ids.setdefault((name, value), len(code_ids))
+                   for name, value in zip(column_names, row[1:])
+                   if value not in uncoded}
+        indices.extend(row_ids)
+        indptr.append(len(indices))
+
+    # Sort the codes, and renumber them to match
+    code_list = sorted(code_ids)
+    new_ids = np.empty(len(code_list), dtype='int64')
+    new_ids[[code_ids[c] for c in code_list]] = np.arange(len(code_list))
+    indices = new_ids[np.frombuffer(indices, dtype='int64')]
+    code_vecs = sparse.csr_matrix((np.ones(len(indices), dtype='bool'),
+                                   indices, np.frombuffer(indptr, dtype='int64')),
+                                  shape=(len(msgs), len(code_list)))
+    code_vecs.sort_indices()
 
     # Save the information
     save(msgs, code_vecs, code_list, output_file, extractor, vectoriser,
-         directory)
+         directory, dtype=dtype)
 
 
 def preprocess_keywords(keyword_file, feature_file, output_file=None,
@@ -243,7 +243,9 @@ def preprocess_keywords(keyword_file, feature_file, output_file=None,
     Preprocess the keywords, converting words to feature indices
     The input file should have one line per code, with keywords separated
     by commas.
-    Each keyword should be either a single word or a bigram.
+    Each keyword can be a single word or a phrase, and is matched against
+    word and ngram features, allowing for variant spellings
+    (see keywords.py - a keyword can match several features).
     For readability, the line can begin with the name of the code, separated
     by a tab.
     e.g.: (note the tab character)
@@ -263,39 +265,21 @@ def preprocess_keywords(keyword_file, feature_file, output_file=None,
     if output_file is None:
         output_file = keyword_file
 
-    # Load features
-    with open(os.path.join(directory, feature_file + '.pkl'), 'rb') as f:
-        feats = pickle.load(f)
-    # Ignore frequency information
-    feat_list = [x for x, _ in feats]
-    # Convert to a dict
-    feat_dict = {x: i for i, x in enumerate(feat_list)}
+    # Load the index of features (built the first time, and saved)
+    index = load_keyword_index(feature_file, directory)
 
     # Read keyword file
-    with open(os.path.join(directory, keyword_file + '.txt')) as f:
-        full_list = []
-        for line in f:
-            # Get the keywords
-            parts = line.split('\t')
-            keywords = [x.split() for x in parts[-1].split(',')]
-            indices = []
-            for k in keywords:
-                # Lookup each keyword either as a single word, or as a bigram
-                try:
-                    if len(k) == 1:
-                        indices.append(feat_dict['word', k[0]])
-                    elif len(k) == 2:
-                        indices.append(feat_dict['ngram', tuple(k)])
-                    else:
-                        print(line, k)
-                        raise ValueError('Keywords must be one or two words'
-                                         'long')
-
-                except KeyError:
-                    warn("Keyword '{}' could not be found as a feature"
-                         .format(' '.join(k)))
-            # Add to the full list
-            full_list.append(indices)
+    _, keywords = read_keyword_file(os.path.join(directory, keyword_file + '.txt'))
+    full_list = []
+    for code_keywords in keywords:
+        indices = []
+        for k in code_keywords:
+            found = index.lookup(k)
+            if not found:
+                warn("Keyword '{}' could not be found as a feature".format(k))
+            indices.extend(found)
+        # Add to the full list (each feature only once)
+        full_list.append(list(dict.fromkeys(indices)))
 
     # Save the keyword indices to file
     with open(os.path.join(directory, output_file + '.pkl'), 'wb') as f:
@@ -320,18 +304,17 @@ def iter_bags_of_features(input_files, extractor, directory='../data',
         input_files = [input_files]
     # Iterate through files
     for filename in input_files:
-        with open(os.path.join(directory, filename + '.csv'), newline='') as f:
-            # Process the file as a CSV file
-            reader = csv.reader(f)
-            # Ignore headings
-            next(reader)
-            # Iterate through messages
-            for row in reader:
-                yield extractor(row[text_col])
+        # Iterate through messages, reading only the text column
+        for msg in iter_column(os.path.join(directory, filename + '.csv'), text_col):
+            yield extractor(msg)
 
 
+@timed('preprocess.extract_features_and_idf')
 def extract_features_and_idf(input_files, output_file, extractor,
-                             threshold=None, directory='../data', text_col=0):
+                             threshold=None, directory='../data', text_col=0,
+                             max_df=None, max_features=None, weighting=None,
+                             processes=1, chunk_bytes=None, cache_dir=None,
+                             dtype='float64'):
     """
     Extract features from all messages, and filter by document frequency
     Creates a Vectoriser that can convert messages to feature vectors weighted
@@ -347,22 +330,41 @@ def extract_features_and_idf(input_files, output_file, extractor,
     :param threshold: minimum document frequency to keep a feature
     :param directory: directory of data files (default ../data)
     :param text_col: index of column containing text (default 0)
+    :param max_df: maximum document frequency to keep a feature
+    (int for a count, float for a proportion of messages)
+    :param max_features: maximum number of features to keep (most frequent)
+    :param weighting: Weighting object (see weighting.py), which will be fit
+    to the document frequencies and used by the Vectoriser to produce sparse
+    vectors (if not given, dense vectors are weighted by 1/frequency)
+    :param processes: number of worker processes for counting features
+    (default 1, i.e. none; None means the number of CPUs) - with more than
+    one, the extractor must be picklable (e.g. an Extractor object or a
+    module-level function, not a lambda or closure)
+    :param chunk_bytes: if given, split large files into byte ranges of this
+    size, to be processed in parallel (see corpus.corpus_statistics)
+    :param cache_dir: if given, cache the statistics of each input file here,
+    so that unchanged files are not processed again
+    :param dtype: numpy data type of the idf weights and dense vectors
+    (default float64)
     """
-    # Get iterator over bags of features
-    bags = iter_bags_of_features(input_files, extractor, directory, text_col)
-    # Get document frequency
-    freq = document_frequency(bags)
-    # Filter out rare features
-    if threshold is not None:
-        freq = {feat: n for feat, n in freq.items() if n >= threshold}
+    # Get document frequency, and the number of messages
+    stats, _ = corpus_statistics(input_files, extractor, directory, text_col,
+                                 processes, chunk_bytes, cache_dir)
+    # Filter out rare and common features
+    freq = filter_by_frequency(stats.doc_freq, threshold, max_df,
+                               max_features, stats.n_messages)
     # Assign indices to features
     feat_list, feat_dict = feature_list_and_dict(freq.keys())
-    # Get idf array
-    idf = np.empty(len(feat_list))
-    for feat, n in freq.items():
-        idf[feat_dict[feat]] = 1 / n
     # Create and save Vectoriser
-    vectoriser = Vectoriser(extractor, feat_dict, idf)
+    if weighting is not None:
+        weighting.fit_frequencies(freq, stats.n_messages, feat_dict)
+        vectoriser = Vectoriser(extractor, feat_dict, weighting=weighting)
+    else:
+        # Get idf array
+        idf = np.empty(len(feat_list), dtype=dtype)
+        for feat, n in freq.items():
+            idf[feat_dict[feat]] = 1 / n
+        vectoriser = Vectoriser(extractor, feat_dict, idf, dtype=dtype)
     with open(os.path.join(directory, output_file + '.pkl'), 'wb') as f:
         pickle.dump(vectoriser, f)
     # Save list of features
@@ -1,57 +1,67 @@
-import csv, pickle, numpy as np
-from collections import Counter
+import csv
 
-from features import bag_of_words, vectorise, apply_to_parts
+from features import bag_of_words, vectorise_sparse, apply_to_parts
 from active import score_by_uncertainty, top_N
+from bundle import load_model
+from ingest import read_header, read_rows, iter_column
+from instrument import stage
 
-name, weeks = 'wash', '12'
+# Choose which unlabelled messages to annotate next
+# To record how long each stage takes, set the environment variable SMS_RUN_LOG
+# to the name of a JSON file (see instrument.py)
+
+NAME, WEEKS = 'wash', '12'
 #name, weeks = 'delivery', '34'
 #name, weeks = 'nutrition', '5'
 #name, weeks = 'malaria', '67'
 
+INPUT_FILE, TRAINING_FILE = '../data/mediaink_s04_1804_yesnos.csv', '../data/wash_s04_training_long_1705.csv'
+
+
+def main(name=NAME, weeks=WEEKS, input_file=INPUT_FILE, training_file=TRAINING_FILE,
+         N=10000, output_file='../data/{}_s04_top10000.csv'):
+    """
+    Save the messages the classifiers are most uncertain about
 
-# Get the unlabelled data
+    :param name: name of the dataset the classifiers were trained on
+    :param weeks: weeks to choose messages from
+    :param input_file: path to csv file of all messages
+    :param training_file: path to csv file of training messages (excluded)
+    :param N: number of messages to choose
+    :param output_file: path of output file, with {} for the name
+    """
+    # Get the unlabelled data
 
-msgs = []
-with open('../data/mediaink_s04_1804_yesnos.csv', newline='') as f, open('../data/wash_s04_training_long_1705.csv', newline='') as trainingf:
-    reader = list(csv.reader(f))
-    headings = reader[0]
+    mids = set(iter_column(training_file, 0))
+    headings = read_header(input_file)
 
-    training_reader = list(csv.reader(trainingf))
-    mids = [row[0] for row in training_reader]
-    
-    for row in reader:
-        if row[4] in weeks and row[0] not in mids:
-            msgs.append(row)
+    # Read in chunks, filtering by week and excluding the training set
+    msgs = list(read_rows(input_file, filters={4: list(weeks)}, exclude={0: mids}))
 
-# Vectorise the data
+    # Load the classifiers, codes and features
 
-with open('../data/{}_features.pkl'.format(name), 'rb') as f:
-    feats = pickle.load(f)
-feat_list = [x for x,_ in feats]
-feat_dict = {x:i for i,x in enumerate(feat_list)}
+    classifiers = load_model(name, 'C1')
 
-featurise = apply_to_parts(bag_of_words, '&&&')
-feat_vecs = vectorise([featurise(x[4]) for x in msgs], feat_dict)
+    # Vectorise the data
 
-# Load the classifiers and codes
+    featurise = apply_to_parts(bag_of_words, '&&&')
+    with stage('features.extract', items=len(msgs)):
+        bags = [featurise(x[4]) for x in msgs]
+    feat_vecs = vectorise_sparse(bags, classifiers.vocabulary, 'float64')
 
-with open('../data/{}_C1.pkl'.format(name), 'rb') as f:
-    classifiers = pickle.load(f)
+    # Choose which datapoints to annotate next
 
-with open('../data/{}_codes.pkl'.format(name), 'rb') as f:
-    codes = pickle.load(f)
-code_names = [x for x,_ in codes]
-#headings.extend(code_names)
+    scores = score_by_uncertainty(feat_vecs, classifiers)
+    top = top_N(scores, N)
 
-# Choose which datapoints to annotate next
+    # Save the data with the predictions
 
-scores = score_by_uncertainty(feat_vecs, classifiers)
-top = top_N(scores, 10000)
+    with stage('write', items=len(top)), \
+            open(output_file.format(name), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headings)
+        writer.writerows([msgs[i] for i in top])
 
-# Save the data with the predictions
 
-with open('../data/{}_s04_top10000.csv'.format(name), 'w', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(headings)
-    writer.writerows([msgs[i] for i in top])
+if __name__ == "__main__":
+    main()
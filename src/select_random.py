@@ -1,23 +1,191 @@
-import pandas
+import csv
 import sys
+import numpy as np
+
+from ingest import read_header, read_columns
+
+# Choose a random sample of predicted messages, to verify by hand
+# The predictions file is read once, in chunks, and only the sampled rows are
+# kept, so memory use does not depend on the size of the file.
+# Rows are sampled with reservoir sampling (Efraimidis and Spirakis' A-Res):
+# each row gets a random key u ** (1 / weight), with u uniform in (0, 1), and
+# the rows with the largest keys are kept. With equal weights, this is a
+# uniform sample, and rows can be weighted e.g. by predicted probability.
+# Rare codes would get few rows in a uniform sample, so a minimum number of
+# rows can also be sampled for each predicted code, using the same keys.
 
 # exclude Non-Relevant as code
-name, code_colums = 'wash', list(range(14, 26))
+NAME, CODE_COLUMNS = 'wash', list(range(14, 26))
+
+# Columns written for each message (ID, week and text), before code columns
+MESSAGE_COLUMNS = [0, 1, 5]
+
+
+class Reservoir:
+    """
+    The items with the largest keys seen so far, up to a fixed number
+    """
+    def __init__(self, size):
+        """
+        :param size: maximum number of items to keep
+        """
+        self.size = size
+        self.keys = np.empty(0)
+        self.items = []
+
+    def threshold(self):
+        """
+        :return: key that a new item must exceed to be kept
+        """
+        if self.size == 0:
+            return np.inf
+        if len(self.keys) < self.size:
+            return -np.inf
+        return self.keys.min()
+
+    def add(self, keys, items):
+        """
+        Add a batch of items
+
+        :param keys: array of keys (items with key -inf are never kept)
+        :param items: list of items, aligned with keys
+        """
+        if self.size == 0 or len(keys) == 0:
+            return
+        keys = np.concatenate([self.keys, keys])
+        if len(keys) > self.size:
+            top = np.argpartition(-keys, self.size - 1)[:self.size]
+        else:
+            top = np.arange(len(keys))
+        n_old = len(self.keys)
+        self.items = [self.items[i] if i < n_old else items[i - n_old] for i in top.tolist()]
+        self.keys = keys[top]
+
+    def sorted_items(self):
+        """
+        :return: items, with the largest keys first
+        """
+        return [self.items[i] for i in np.argsort(-self.keys, kind='stable')]
+
+
+def sample_predictions(prediction_file, code_columns, N=1000, min_per_code=0,
+                       weight_columns=None, columns=None, seed=None,
+                       source='prediction'):
+    """
+    Sample predicted messages, reading the file only once
+
+    :param prediction_file: path to csv file of predictions (from predict_multiple)
+    :param code_columns: indices of code columns (a code is predicted if its
+    column is not empty)
+    :param N: number of messages to sample
+    :param min_per_code: number of messages to sample for each code, from the
+    messages predicted to have it (or all of them, if there are fewer) - if
+    these add up to more than N, more than N messages are sampled
+    :param weight_columns: (optional) indices of columns of probabilities -
+    messages are sampled with probability proportional to the highest of these
+    (e.g. the probability of each code, from predict_multiple)
+    :param columns: indices of columns to return (default: MESSAGE_COLUMNS and
+    code_columns)
+    :param seed: random seed
+    :param source: value of the 'source' column of messages to sample from
+
+    :return: headings of the returned columns, list of sampled rows (in random
+    order), and dict of counts of messages read and sampled for each code
+    """
+    # pandas (used by read_columns) is slow to import, so only import it when needed
+    import pandas
+
+    headings = read_header(prediction_file)
+    code_columns = list(code_columns)
+    weight_columns = list(weight_columns or [])
+    if columns is None:
+        columns = MESSAGE_COLUMNS + [c for c in code_columns if c not in MESSAGE_COLUMNS]
+    needed = sorted(set(columns) | set(code_columns) | set(weight_columns))
+    positions = [needed.index(c) for c in columns]
+
+    rng = np.random.default_rng(seed)
+    overall = Reservoir(N)
+    by_code = [Reservoir(min_per_code) for _ in code_columns]
+    read = 0
+    predicted = np.zeros(len(code_columns), dtype='int64')
+    for chunk in read_columns(prediction_file, needed,
+                              filters={headings.index('source'): [source]}):
+        codes = (chunk[code_columns].values != '')
+        predicted += codes.sum(axis=0)
+        if weight_columns:
+            probs = np.column_stack([pandas.to_numeric(chunk[c], errors='coerce').values
+                                     for c in weight_columns])
+            weights = np.nan_to_num(probs).max(axis=1)
+        else:
+            weights = np.ones(len(chunk))
+        # log(u) / weight is an increasing function of u ** (1 / weight),
+        # and is -inf for messages of zero weight
+        with np.errstate(divide='ignore'):
+            keys = np.log(rng.random(len(chunk))) / weights
+        keys[weights <= 0] = -np.inf
+
+        # Only convert the rows that might be kept, and each row only once
+        candidates = keys > overall.threshold()
+        for k, reservoir in enumerate(by_code):
+            candidates |= codes[:, k] & (keys > reservoir.threshold())
+        candidates &= keys > -np.inf
+        index = np.flatnonzero(candidates)
+        # Items are (position in file, row), so rows sampled twice can be found
+        items = [(read + i, row) for i, row in zip(index.tolist(), chunk.values[index].tolist())]
+        by_index = dict(zip(index.tolist(), items))
+        overall.add(keys[index], items)
+        for k, reservoir in enumerate(by_code):
+            index_k = index[codes[index, k]]
+            reservoir.add(keys[index_k], [by_index[i] for i in index_k.tolist()])
+        read += len(chunk)
+
+    # Rows sampled for each code, then the rest of the uniform (or weighted) sample
+    sample = {}
+    for reservoir in by_code:
+        for position, row in reservoir.items:
+            sample[position] = row
+    for position, row in overall.sorted_items():
+        if len(sample) >= N:
+            break
+        sample.setdefault(position, row)
+    # Shuffle, so that rows sampled for particular codes are not all at the start
+    sample = list(sample.values())
+    sample = [sample[i] for i in rng.permutation(len(sample)).tolist()]
 
-predictions_df = pandas.read_csv(sys.argv[1])
+    sampled = [sum(row[needed.index(c)] != '' for row in sample) for c in code_columns]
+    counts = {'read': read, 'sampled': len(sample),
+              'codes': {headings[c]: {'predicted': int(p), 'sampled': s}
+                        for c, p, s in zip(code_columns, predicted, sampled)}}
+    rows = [[row[p] for p in positions] for row in sample]
+    return [headings[c] for c in columns], rows, counts
 
-# random sample of full size
-predictions_df = predictions_df.sample(frac=1)
 
+def main(prediction_file, name=NAME, code_colums=CODE_COLUMNS, N=1000,
+         min_per_code=0, weight_columns=None, seed=None):
+    """
+    Save a random sample of predicted messages
 
-# select rows where any of codes is not empty
-#rows_with_code = predictions_df[(predictions_df[code_colums].notnull().any(axis=1)) & (predictions_df['source'] == 'prediction')]
-rows_with_code = predictions_df[predictions_df['source'] == 'prediction']
+    :param prediction_file: path to csv file of predictions (from predict_multiple)
+    :param name: name of the topic, used for the output file
+    :param code_colums: indices of code columns
+    :param N: number of messages to sample
+    :param min_per_code: number of messages to sample for each code, where possible
+    :param weight_columns: (optional) indices of columns of probabilities, to
+    weight messages by (see sample_predictions)
+    :param seed: random seed
+    """
+    headings, rows, counts = sample_predictions(prediction_file, code_colums, N,
+                                                min_per_code, weight_columns, seed=seed)
 
-print(len(rows_with_code))
+    print(counts['read'])
+    for code, c in counts['codes'].items():
+        print('{}: {} predicted, {} sampled'.format(code, c['predicted'], c['sampled']))
 
-verification_set = rows_with_code[:1000]
+    with open('../data/' + name + '_s04_verification_random.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headings)
+        writer.writerows(rows)
 
-columns = [0,1,5].extend(code_colums)
 
-verification_set.to_csv('../data/' + name + '_s04_verification_random.csv', index=False, columns=columns)
+if __name__ == "__main__":
+    main(sys.argv[1])
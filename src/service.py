@@ -0,0 +1,375 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from bundle import load_bundle
+from features import bag_of_words, apply_to_parts, vectorise_sparse
+from instrument import stage
+
+# A long-running local service, which loads a model bundle once and classifies
+# messages sent over HTTP
+# Requests arriving at about the same time are combined into one batch, so
+# that messages are vectorised and scored with one matrix product.
+# A new bundle can be loaded while the service is running: requests already
+# in a batch are scored with the old model, and later batches with the new one.
+#
+# Endpoints (all JSON):
+#     POST /predict   {"message": "..."} or {"messages": ["...", ...]}
+#     POST /reload    {} (reload the same path) or {"path": "..."}
+#     GET  /stats     request counts, batch sizes, and p50/p99 latency
+#     GET  /health
+
+# Feature extractor for bundles saved without one (as used in predict_multiple)
+DEFAULT_EXTRACTOR = apply_to_parts(bag_of_words, '&&&')
+
+
+class Model:
+    """
+    A model bundle, with everything needed to score raw messages
+    """
+    def __init__(self, path, extractor=None):
+        """
+        :param path: directory of the model bundle
+        :param extractor: feature extractor to use if the bundle has none
+        """
+        self.path = path
+        # Read the arrays into memory, rather than memory mapping them,
+        # so that the files can safely be overwritten by a new bundle
+        self.bundle = load_bundle(path, mmap=False)
+        self.extractor = self.bundle.extractor or extractor or DEFAULT_EXTRACTOR
+        self.loaded_at = time.time()
+
+    def score(self, msgs):
+        """
+        :param msgs: list of strings
+        :return: probabilities and boolean predictions,
+        each of shape [num_messages, num_codes]
+        """
+        bundle = self.bundle
+        bags = [self.extractor(m) for m in msgs]
+        if bundle.weighting is not None:
+            vecs = bundle.weighting(vectorise_sparse(bags, bundle.vocabulary,
+                                                     bundle.weighting.dtype))
+        else:
+            vecs = vectorise_sparse(bags, bundle.vocabulary, 'float64')
+            if bundle.weights is not None:
+                vecs = vecs.multiply(bundle.weights).tocsr()
+        prob = bundle.predict_prob(vecs)
+        if bundle.thresholds is None:
+            pred = prob > 0.5
+        else:
+            pred = prob >= bundle.thresholds
+        pred[:, ~bundle.present] = False
+        return prob, pred
+
+
+class LatencyStats:
+    """
+    Recent request latencies, and overall counts
+    """
+    def __init__(self, window=10000):
+        """
+        :param window: number of recent requests to find percentiles over
+        """
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.messages = 0
+        self.batches = 0
+        self.batched_messages = 0
+        self.lock = threading.Lock()
+
+    def add_request(self, seconds, n_messages):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.messages += n_messages
+
+    def add_batch(self, n_messages):
+        with self.lock:
+            self.batches += 1
+            self.batched_messages += n_messages
+
+    def report(self):
+        """
+        :return: dict of counts, and latency percentiles in milliseconds
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            res = {'requests': self.requests, 'messages': self.messages,
+                   'batches': self.batches,
+                   'mean_batch_size': self.batched_messages / self.batches
+                   if self.batches else None}
+        for p in (50, 90, 99):
+            res['p{}_ms'.format(p)] = float(np.percentile(latencies, p) * 1000) if len(latencies) else None
+        return res
+
+
+class Service:
+    """
+    Classifies messages in micro-batches, using a model that can be replaced
+    while running
+    """
+    def __init__(self, path, extractor=None, max_batch=256, max_wait=0.005):
+        """
+        :param path: directory of the model bundle
+        :param extractor: feature extractor to use if the bundle has none
+        :param max_batch: maximum number of messages to score at once
+        :param max_wait: maximum time (in seconds) to wait for more requests
+        before scoring a batch
+        """
+        self.extractor = extractor
+        self.model = Model(path, extractor)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = LatencyStats()
+        self.requests = queue.Queue()
+        self.reload_lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run_batches, daemon=True)
+        self.worker.start()
+
+    def submit(self, msgs):
+        """
+        Queue messages to be scored
+
+        :param msgs: list of strings
+        :return: Future, whose result is (code names, probabilities, predictions)
+        """
+        future = Future()
+        self.requests.put((msgs, future))
+        return future
+
+    def classify(self, msgs):
+        """
+        Score messages, waiting for the result
+
+        :param msgs: list of strings
+        :return: list (one element per message) of dicts with 'codes'
+        (names of predicted codes) and 'probabilities' (for every code)
+        """
+        start = time.perf_counter()
+        # The code names come with the result, in case the model was replaced
+        names, prob, pred = self.submit(msgs).result()
+        res = [{'codes': [names[k] for k in np.flatnonzero(p)],
+                'probabilities': dict(zip(names, pr.round(6).tolist()))}
+               for pr, p in zip(prob, pred)]
+        self.stats.add_request(time.perf_counter() - start, len(msgs))
+        return res
+
+    def next_batch(self):
+        """
+        Wait for a request, then collect any others arriving within max_wait,
+        up to max_batch messages
+
+        :return: list of (messages, future) pairs
+        """
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def run_batches(self):
+        """
+        Score batches of requests, forever (run by the worker thread)
+        """
+        while True:
+            batch = self.next_batch()
+            msgs = [m for request, _ in batch for m in request]
+            # Use the same model for the whole batch, even if it is replaced
+            model = self.model
+            try:
+                with stage('service.batch', items=len(msgs), requests=len(batch)):
+                    prob, pred = model.score(msgs)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats.add_batch(len(msgs))
+            start = 0
+            for request, future in batch:
+                end = start + len(request)
+                future.set_result((model.bundle.code_names, prob[start:end], pred[start:end]))
+                start = end
+
+    def reload(self, path=None):
+        """
+        Load a model bundle, and use it for all later batches
+        (the old model keeps serving requests until the new one is ready)
+
+        :param path: directory of the new bundle (default: reload the current path)
+        :return: path of the loaded bundle
+        """
+        with self.reload_lock:
+            model = Model(path or self.model.path, self.extractor)
+            self.model = model
+        return model.path
+
+    def report(self):
+        """
+        :return: dict of statistics, and details of the current model
+        """
+        res = self.stats.report()
+        res.update(model=self.model.path, codes=len(self.model.bundle.code_names),
+                   loaded_at=time.strftime('%Y-%m-%dT%H:%M:%S',
+                                           time.localtime(self.model.loaded_at)))
+        return res
+
+    def watch(self, interval=10):
+        """
+        Reload the bundle whenever its metadata file changes
+        (save_bundle writes meta.json last, so the new bundle is complete)
+
+        :param interval: seconds between checks
+        """
+        def check():
+            # The path can change (with /reload), so find it again each time
+            path = self.model.path
+            last = os.path.getmtime(os.path.join(path, 'meta.json'))
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.model.path != path:
+                        path = self.model.path
+                        last = os.path.getmtime(os.path.join(path, 'meta.json'))
+                        continue
+                    mtime = os.path.getmtime(os.path.join(path, 'meta.json'))
+                    if mtime != last:
+                        last = mtime
+                        self.reload()
+                except (OSError, ValueError) as e:
+                    print('Could not reload model:', e)
+        threading.Thread(target=check, daemon=True).start()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    HTTP interface to a Service (set as the server's service attribute)
+    """
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(self.server.service.report())
+        elif self.path == '/health':
+            self.send_json({'status': 'ok'})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        try:
+            request = self.read_json()
+        except ValueError:
+            self.send_json({'error': 'invalid JSON'}, 400)
+            return
+        if not isinstance(request, dict):
+            self.send_json({'error': 'expected a JSON object'}, 400)
+            return
+        service = self.server.service
+        if self.path == '/predict':
+            msgs = request.get('messages')
+            if msgs is None and 'message' in request:
+                msgs = [request['message']]
+            if not isinstance(msgs, list) or not all(isinstance(m, str) for m in msgs):
+                self.send_json({'error': 'expected "message" or a list of "messages"'}, 400)
+                return
+            try:
+                results = service.classify(msgs) if msgs else []
+            except Exception as e:
+                # Scoring errors are passed back from the worker thread
+                self.send_json({'error': 'could not classify messages: {}'.format(e)}, 500)
+                return
+            self.send_json({'results': results})
+        elif self.path == '/reload':
+            try:
+                path = service.reload(request.get('path'))
+            except (OSError, ValueError) as e:
+                self.send_json({'error': str(e)}, 500)
+                return
+            self.send_json({'model': path})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def log_message(self, format, *args):
+        # Latency is reported by /stats instead of logging every request
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    """
+    Threaded HTTP server, with room for many clients connecting at once
+    """
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(path, host='127.0.0.1', port=8000, watch_interval=None, **kwargs):
+    """
+    Run the service until interrupted
+
+    :param path: directory of the model bundle
+    :param host: address to listen on (default: local connections only)
+    :param port: port to listen on
+    :param watch_interval: (optional) seconds between checks for a new bundle
+    :param kwargs: additional arguments for Service
+    """
+    service = Service(path, **kwargs)
+    if watch_interval:
+        service.watch(watch_interval)
+    server = Server((host, port), Handler)
+    server.service = service
+    print('Serving {} on http://{}:{}'.format(path, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(service.report()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Classify messages over HTTP')
+    parser.add_argument('bundle', help='directory of the model bundle (e.g. ../data/wash_s04_C1.bundle)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=256,
+                        help='maximum number of messages to score at once')
+    parser.add_argument('--max-wait', type=float, default=0.005,
+                        help='seconds to wait for more requests before scoring a batch')
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='reload the bundle when it changes, checking this often')
+    args = parser.parse_args()
+    serve(args.bundle, args.host, args.port, args.watch,
+          max_batch=args.max_batch, max_wait=args.max_wait)
+
+
+if __name__ == "__main__":
+    # e.g. python service.py ../data/wash_s04_C1.bundle
+    # (use bundle.load_model to convert pickled classifiers to a bundle first)
+    main()
@@ -1,24 +1,122 @@
+import argparse
 import csv
+import numpy as np
 
-malaria_codes = ['Avoidance of water', 'Mosquito net', 'Mosquito spray', 'Cleanliness/hygiene/sanitation', 'Nutrition', 'Medical  wrong', 'Medication', 'Other', 'Food/Drink', 'Health Services', 'Water']
-wash_codes_s02 = ['Unclean food and water', 'Lack of hygeine', 'Lack of sanitation/open defecation', 'Infection', 'Water/Weather', 'Types of Food', 'Other', 'Life-threatening', 'Dangerous (not life threatning)', 'Some type/durations are life-threatening', 'Some people/areas are at greater risk ', 'No harm/good', 'ORS', 'Health services']
-wash_codes_s04 = ['Lack of Hygiene', 'Contaminated/Dirty Water', 'Contaminated/Dirty Water (slight misconception about cause of cholera)', 'Poor food preparation/eating practice', 'Type of Food', 'Germs', 'Poor Sanitation/Stool', 'Dirty Environment/Community', 'Poisoned/contaminated weather', 'Weather impacting on water', 'Other Misconceptions', 'Other (Enabler Rather than Cause)', 'Other (Hunger/Malnutrition)', 'Non-Relevant']
+from preprocess import save
 
-#with open('../data/WASH [NEW] - Training data 27.02.2017 ID.csv', 'r') as infile, open('../data/wash_training_long_1005.csv', 'w') as outfile:
-#with open('../data/Malaria.xlsx - Rukaya - Training Data_1105.csv', 'r') as infile, open('../data/malaria_training_long_1105.csv', 'w') as outfile:
-with open('../data/WASH S04E03 - Manual Coding.csv', 'r') as infile, open('../data/wash_s04_training_long_1705.csv', 'w') as outfile:
+# Convert coding spreadsheets, where each message has its codes written in a few columns,
+# to a "long" table with one column per code (1 if the message has that code, empty otherwise)
 
-    reader = csv.DictReader(infile)
-    columns = reader.fieldnames
-    fieldnames = ['ID', 'phone', 'text'] + wash_codes_s04
-    print(fieldnames)
-    writer = csv.DictWriter(outfile, fieldnames=fieldnames, extrasaction='ignore')
-    writer.writeheader()
+# Code lists for topics coded so far (any other list can be read from a file)
+TOPIC_CODES = {
+    'malaria': ['Avoidance of water', 'Mosquito net', 'Mosquito spray', 'Cleanliness/hygiene/sanitation', 'Nutrition', 'Medical  wrong', 'Medication', 'Other', 'Food/Drink', 'Health Services', 'Water'],
+    'wash_s02': ['Unclean food and water', 'Lack of hygeine', 'Lack of sanitation/open defecation', 'Infection', 'Water/Weather', 'Types of Food', 'Other', 'Life-threatening', 'Dangerous (not life threatning)', 'Some type/durations are life-threatening', 'Some people/areas are at greater risk ', 'No harm/good', 'ORS', 'Health services'],
+    'wash_s04': ['Lack of Hygiene', 'Contaminated/Dirty Water', 'Contaminated/Dirty Water (slight misconception about cause of cholera)', 'Poor food preparation/eating practice', 'Type of Food', 'Germs', 'Poor Sanitation/Stool', 'Dirty Environment/Community', 'Poisoned/contaminated weather', 'Weather impacting on water', 'Other Misconceptions', 'Other (Enabler Rather than Cause)', 'Other (Hunger/Malnutrition)', 'Non-Relevant'],
+}
 
-    for row in reader:
-        for column in columns:
-            if row[column] in wash_codes_s04:
-                row[row[column]] = 1
-        writer.writerow(row)
+ID_COLUMNS = ('ID', 'phone', 'text')
 
 
+def read_code_list(filename):
+    """
+    Read a list of codes from a text file, with one code per line
+    (anything after a tab is ignored, so _codes.txt files saved by preprocess can be used)
+    :param filename: path to file
+    :return: list of codes
+    """
+    with open(filename) as f:
+        return [line.rstrip('\r\n').split('\t')[0] for line in f if line.strip()]
+
+
+def iter_codes(input_file, codes, id_columns=ID_COLUMNS):
+    """
+    Stream through a coding spreadsheet, finding the codes of each message
+    :param input_file: path to input csv file
+    :param codes: list of codes
+    :param id_columns: names of columns to keep for each message
+    :return: iterator yielding (dict of id columns, set of codes) for each message
+    """
+    code_set = set(codes)
+    with open(input_file, 'r', newline='') as infile:
+        reader = csv.DictReader(infile)
+        for row in reader:
+            # Any column may contain a code
+            found = {value for value in row.values() if isinstance(value, str) and value in code_set}
+            yield {c: row.get(c, '') for c in id_columns}, found
+
+
+def convert(input_file, output_file, codes, id_columns=ID_COLUMNS):
+    """
+    Convert a coding spreadsheet to a long csv file, with one column per code
+    :param input_file: path to input csv file
+    :param output_file: path to output csv file
+    :param codes: list of codes
+    :param id_columns: names of columns to keep for each message
+    """
+    with open(output_file, 'w', newline='') as outfile:
+        fieldnames = list(id_columns) + list(codes)
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for row, found in iter_codes(input_file, codes, id_columns):
+            row.update((c, 1) for c in found)
+            writer.writerow(row)
+
+
+def to_code_matrix(input_file, codes, text_column='text'):
+    """
+    Convert a coding spreadsheet directly to messages and a binary code matrix,
+    as used by preprocess.save (without writing and re-reading a long csv file)
+    :param input_file: path to input csv file
+    :param codes: list of codes
+    :param text_column: name of column containing text
+    :return: list of messages, boolean matrix of shape [num_messages, num_codes], list of codes
+    """
+    code_dict = {c: i for i, c in enumerate(codes)}
+    msgs = []
+    rows = []
+    cols = []
+    for row, found in iter_codes(input_file, codes, (text_column,)):
+        rows.extend(len(msgs) for _ in found)
+        cols.extend(code_dict[c] for c in found)
+        msgs.append(row[text_column])
+    code_vecs = np.zeros((len(msgs), len(codes)), dtype='bool')
+    code_vecs[rows, cols] = True
+    return msgs, code_vecs, list(codes)
+
+
+def preprocess_wide(input_file, output_file, codes, extractor=None, vectoriser=None,
+                    directory='../data', text_column='text', **kwargs):
+    """
+    Preprocess a coding spreadsheet to feature vectors and binary codes,
+    saving the same files as preprocess.preprocess_long
+    :param input_file: path to input csv file
+    :param output_file: output file name (without .pkl file extension)
+    :param codes: list of codes
+    :param extractor: function mapping strings to bags of features
+    :param vectoriser: function mapping lists of strings to numpy arrays
+    :param directory: directory of data files (default ../data)
+    :param text_column: name of column containing text
+    :param kwargs: additional keyword arguments for preprocess.save
+    """
+    msgs, code_vecs, code_names = to_code_matrix(input_file, codes, text_column)
+    save(msgs, code_vecs, code_names, output_file, extractor, vectoriser, directory, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a coding spreadsheet to one column per code')
+    parser.add_argument('input_file', help='input csv file')
+    parser.add_argument('output_file', help='output csv file')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--codes', help='text file listing the codes, one per line')
+    group.add_argument('--topic', choices=sorted(TOPIC_CODES), help='use a built-in code list')
+    parser.add_argument('--id-columns', nargs='+', default=list(ID_COLUMNS),
+                        help='columns to keep for each message (default: ID phone text)')
+    args = parser.parse_args()
+
+    codes = read_code_list(args.codes) if args.codes else TOPIC_CODES[args.topic]
+    convert(args.input_file, args.output_file, codes, args.id_columns)
+
+
+if __name__ == "__main__":
+    # e.g. python short_to_long.py '../data/WASH S04E03 - Manual Coding.csv' ../data/wash_s04_training_long_1705.csv --topic wash_s04
+    main()
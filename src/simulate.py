@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import pickle
+import time
+from collections import namedtuple
+from multiprocessing import Pool
+import numpy as np
+from scipy import sparse
+
+from active import score_by_uncertainty, score_by_relative_uncertainty, top_N
+from evaluate import confusion_counts, scores_from_counts
+from logistic import train, predict
+
+# Simulating active learning on data that has already been labelled
+# Rather than waiting for real annotation rounds, we hide the codes of most of
+# a labelled dataset, and reveal them only for the messages a strategy chooses.
+# Starting from a random seed set, each round:
+#     - trains classifiers on the messages labelled so far (starting from the
+#       previous round's coefficients, which needs far fewer iterations)
+#     - evaluates them on a held-out test set
+#     - scores the remaining pool, and labels the top batch
+# All strategies use the same seed set and test set, so their learning curves
+# can be compared, and each strategy runs in its own process.
+
+# A way of choosing messages to label:
+# - score: 'random', 'uncertainty' (score_by_uncertainty) or 'relative'
+#   (score_by_relative_uncertainty, comparing classifiers trained with C_over
+#   and C_under)
+# - R, normalise, weights: options for top_N
+Strategy = namedtuple('Strategy', ['name', 'score', 'R', 'normalise', 'weights',
+                                   'C_over', 'C_under'])
+Strategy.__new__.__defaults__ = (2, False, None, 10, 0.1)
+
+DEFAULT_STRATEGIES = [
+    Strategy('random', 'random'),
+    Strategy('uncertainty', 'uncertainty'),
+    Strategy('uncertainty (R=1)', 'uncertainty', R=1),
+    Strategy('uncertainty (normalised)', 'uncertainty', normalise=True),
+    Strategy('relative uncertainty', 'relative'),
+]
+
+
+def load_data(input_name, directory='../data'):
+    """
+    Load features and codes saved by preprocess.save
+
+    :param input_name: name of input file (without .pkl file extension)
+    :param directory: directory of data files (default ../data)
+
+    :return: features (CSR matrix), codes (boolean numpy array)
+    """
+    with open(os.path.join(directory, input_name + '.pkl'), 'rb') as f:
+        features, codes = pickle.load(f)
+    return prepare(features, codes)
+
+
+def prepare(features, codes):
+    """
+    Convert features and codes to the types used for simulation
+    (rows of a CSR matrix can be taken quickly, and codes are small)
+
+    :param features: dense or sparse matrix
+    :param codes: numpy array, scipy sparse matrix, or BitMatrix
+
+    :return: features (CSR matrix), codes (boolean numpy array)
+    """
+    if hasattr(codes, 'toarray'):
+        codes = codes.toarray()
+    return sparse.csr_matrix(features), np.asarray(codes, dtype='bool')
+
+
+def split(n_messages, seed_size=200, test_fraction=0.2, seed=0):
+    """
+    Choose a test set and a seed set, at random
+
+    :param n_messages: number of labelled messages
+    :param seed_size: number of messages labelled before the first round
+    :param test_fraction: proportion of messages held out for evaluation
+    :param seed: random seed
+
+    :return: indices of seed messages, indices of test messages
+    """
+    order = np.random.default_rng(seed).permutation(n_messages)
+    n_test = int(n_messages * test_fraction)
+    return np.sort(order[n_test:n_test + seed_size]), np.sort(order[:n_test])
+
+
+def evaluate_round(classifiers, features, codes):
+    """
+    :param classifiers: list of classifiers
+    :param features: feature vectors of test messages
+    :param codes: boolean matrix of codes of test messages
+
+    :return: dict of micro and macro averaged F1
+    """
+    tp, fp, fn = confusion_counts(predict(classifiers, features), codes)
+    f1 = scores_from_counts(tp, fp, fn)[2]
+    micro_f1 = scores_from_counts(tp.sum(), fp.sum(), fn.sum())[2]
+    return {'micro_f1': float(micro_f1), 'macro_f1': float(f1.mean())}
+
+
+def simulate(features, codes, strategy, seed_indices, test_indices, batch_size=100,
+             rounds=20, penalty='l2', C=1, incremental=True, seed=0, verbose=False):
+    """
+    Replay active learning with one strategy
+
+    :param features: feature vectors (CSR matrix) of all labelled messages
+    :param codes: boolean matrix of codes of all labelled messages
+    :param strategy: Strategy
+    :param seed_indices: indices of messages labelled before the first round
+    :param test_indices: indices of messages held out for evaluation
+    :param batch_size: number of messages to label in each round
+    :param rounds: number of rounds of labelling
+    :param penalty: type of regularisation (see logistic.train)
+    :param C: inverse of regularisation strength, for the evaluated classifiers
+    :param incremental: whether to start training from the previous round's
+    classifiers
+    :param seed: random seed (for the random strategy)
+    :param verbose: whether to print each round
+
+    :return: dict with the strategy's name and a list of results for each
+    round (number of messages labelled, scores, and seconds for each step)
+    """
+    rng = np.random.default_rng(seed)
+    labelled = np.zeros(len(codes), dtype='bool')
+    labelled[seed_indices] = True
+    available = ~labelled
+    available[test_indices] = False
+    test_features, test_codes = features[test_indices], codes[test_indices]
+
+    classifiers = over = under = None
+    results = []
+    for r in range(rounds + 1):
+        record = {'round': r, 'labelled': int(labelled.sum())}
+        rows = np.flatnonzero(labelled)
+
+        start = time.perf_counter()
+        previous = classifiers if incremental else None
+        classifiers = train(features[rows], codes[rows], penalty=penalty, C=C, initial=previous)
+        if strategy.score == 'relative' and r < rounds:
+            over = train(features[rows], codes[rows], penalty=penalty, C=strategy.C_over,
+                         initial=over if incremental else None)
+            under = train(features[rows], codes[rows], penalty=penalty, C=strategy.C_under,
+                          initial=under if incremental else None)
+        record['train_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        record.update(evaluate_round(classifiers, test_features, test_codes))
+        record['evaluate_seconds'] = time.perf_counter() - start
+
+        # Label the next batch (not needed after the last round)
+        pool = np.flatnonzero(available)
+        if r < rounds and len(pool):
+            start = time.perf_counter()
+            if strategy.score == 'random':
+                chosen = rng.choice(len(pool), min(batch_size, len(pool)), replace=False)
+            else:
+                if strategy.score == 'uncertainty':
+                    scores = score_by_uncertainty(features[pool], classifiers)
+                elif strategy.score == 'relative':
+                    # Only messages where the overfitting classifiers are
+                    # more confident count (and top_N needs nonnegative scores)
+                    scores = np.maximum(score_by_relative_uncertainty(features[pool], over, under), 0)
+                else:
+                    raise ValueError('score not recognised: {}'.format(strategy.score))
+                chosen = top_N(scores, batch_size, strategy.weights, strategy.R,
+                               strategy.normalise)
+            labelled[pool[chosen]] = True
+            available[pool[chosen]] = False
+            record['select_seconds'] = time.perf_counter() - start
+
+        results.append(record)
+        if verbose:
+            print('{:<30}{:>4}{:>8}{:>10.4f}{:>10.4f}{:>10.3f} s'.format(
+                strategy.name, r, record['labelled'], record['micro_f1'],
+                record['macro_f1'], record['train_seconds']))
+    return {'strategy': strategy.name, 'rounds': results}
+
+
+def _run_strategy(task):
+    """
+    Simulate one strategy (for use with Pool.map)
+
+    :param task: tuple of (features, codes, strategy, seed indices,
+    test indices, dict of keyword arguments for simulate)
+
+    :return: result of simulate
+    """
+    features, codes, strategy, seed_indices, test_indices, kwargs = task
+    return simulate(features, codes, strategy, seed_indices, test_indices, **kwargs)
+
+
+def simulate_all(features, codes, strategies=DEFAULT_STRATEGIES, seed_size=200,
+                 test_fraction=0.2, seed=0, processes=None, **kwargs):
+    """
+    Replay active learning with several strategies, from the same seed set
+
+    :param features: feature vectors of all labelled messages
+    :param codes: codes of all labelled messages
+    :param strategies: list of Strategies
+    :param seed_size: number of messages labelled before the first round
+    :param test_fraction: proportion of messages held out for evaluation
+    :param seed: random seed
+    :param processes: number of worker processes (default: number of CPUs;
+    1 means no worker processes are started)
+    :param kwargs: additional arguments for simulate (e.g. batch_size, rounds)
+
+    :return: list of results of simulate, one for each strategy
+    """
+    features, codes = prepare(features, codes)
+    seed_indices, test_indices = split(len(codes), seed_size, test_fraction, seed)
+    kwargs['seed'] = seed
+    tasks = [(features, codes, s, seed_indices, test_indices, kwargs) for s in strategies]
+    if processes != 1 and len(tasks) > 1:
+        with Pool(processes) as pool:
+            return pool.map(_run_strategy, tasks)
+    return [_run_strategy(t) for t in tasks]
+
+
+def learning_curves(results, score='micro_f1'):
+    """
+    Print one score for each strategy and round, and the mean time per round
+
+    :param results: list of results of simulate
+    :param score: name of score to print (e.g. 'micro_f1' or 'macro_f1')
+    """
+    names = [r['strategy'] for r in results]
+    width = max(12, max(len(n) for n in names) + 2)
+    print('{:>6}{:>9}'.format('round', 'labelled') + ''.join('{:>{}}'.format(n, width) for n in names))
+    for i, record in enumerate(results[0]['rounds']):
+        print('{:>6}{:>9}'.format(record['round'], record['labelled'])
+              + ''.join('{:>{}.4f}'.format(r['rounds'][i][score], width) for r in results))
+    for step in ('train', 'evaluate', 'select'):
+        key = step + '_seconds'
+        print('{:>15}'.format('mean ' + step) + ''.join(
+            '{:>{}.3f}'.format(np.mean([x[key] for x in r['rounds'] if key in x] or [0]), width)
+            for r in results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay active learning on labelled data')
+    parser.add_argument('input', nargs='?',
+                        help='name of features and codes file, from preprocess (e.g. wash)')
+    parser.add_argument('--directory', default='../data')
+    parser.add_argument('--synthetic', type=int, metavar='N',
+                        help='use N synthetic messages (see benchmark.py) instead')
+    parser.add_argument('--seed-size', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--test-fraction', type=float, default=0.2)
+    parser.add_argument('--C', type=float, default=1)
+    parser.add_argument('--not-incremental', action='store_true',
+                        help='train from scratch in every round')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to save results to')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        from benchmark import generate_corpus
+        from features import bag_of_words, document_frequency, feature_list_and_dict, vectorise_sparse
+        msgs, codes = generate_corpus(args.synthetic, seed=args.seed)
+        bags = [bag_of_words(m) for m in msgs]
+        _, feature_dict = feature_list_and_dict(document_frequency(bags))
+        features = vectorise_sparse(bags, feature_dict, 'float64')
+    elif args.input:
+        features, codes = load_data(args.input, args.directory)
+    else:
+        parser.error('give an input file, or --synthetic')
+
+    start = time.perf_counter()
+    results = simulate_all(features, codes, seed_size=args.seed_size,
+                           test_fraction=args.test_fraction, seed=args.seed,
+                           processes=args.processes, batch_size=args.batch_size,
+                           rounds=args.rounds, C=args.C,
+                           incremental=not args.not_incremental)
+    learning_curves(results)
+    print('Total: {:.1f} s'.format(time.perf_counter() - start))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    # e.g. python simulate.py --synthetic 50000 --rounds 30
+    main()
@@ -0,0 +1,119 @@
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+
+from bundle import load_model
+from logistic import predict_prob
+
+# Choosing a probability threshold for each code
+# Rather than trying many thresholds, we sort the messages by probability
+# once, so that cumulative sums give the number of true positives when
+# predicting the code for the top k messages, for every k at once.
+
+
+def best_threshold(prob, gold, target_precision=None, default=0.5):
+    """
+    Find the probability threshold for one code which maximises F1,
+    or which maximises recall subject to a minimum precision
+
+    :param prob: array of predicted probabilities
+    :param gold: boolean array of gold standard annotations
+    :param target_precision: (optional) minimum precision
+    :param default: threshold to use if no threshold gives any true positives,
+    if the target precision cannot be reached, or if the probabilities do not
+    separate any messages (e.g. all zero, for a code without a classifier)
+    (default 0.5)
+
+    :return: threshold (predict the code if prob >= threshold)
+    """
+    order = np.argsort(-prob, kind='stable')
+    prob = prob[order]
+    gold = np.asarray(gold, dtype='bool')[order]
+    # Predicting the top k messages gives tp[k-1] true positives
+    tp = np.cumsum(gold)
+    k = np.arange(1, len(prob) + 1)
+    # We can only cut between different probabilities
+    valid = np.ones(len(prob), dtype='bool')
+    valid[:-1] = prob[1:] < prob[:-1]
+    valid &= tp > 0
+    if target_precision is not None:
+        valid &= tp / k >= target_precision
+        score = tp
+    else:
+        score = 2 * tp / (k + gold.sum())
+    if not valid.any():
+        return default
+    best = np.flatnonzero(valid)[score[valid].argmax()]
+    # Probabilities that are all the same (e.g. all zero, for a code without a
+    # classifier) give no evidence, and a threshold of zero predicts every message
+    if prob[best] <= 0 or prob[0] == prob[-1]:
+        return default
+    return float(prob[best])
+
+
+def optimise_thresholds(prob, gold, target_precision=None, default=0.5):
+    """
+    Find the best probability threshold for each code
+
+    :param prob: matrix of probabilities, of shape [num_messages, num_codes]
+    (e.g. from logistic.predict_prob)
+    :param gold: boolean matrix of annotations, of the same shape
+    (numpy array or scipy sparse matrix)
+    :param target_precision: (optional) minimum precision, either one value
+    or one value per code
+    :param default: threshold to use where no good threshold is found
+
+    :return: array of thresholds, of shape [num_codes]
+    """
+    K = prob.shape[1]
+    if sparse.issparse(gold):
+        gold = gold.toarray()
+    if np.ndim(target_precision) == 0:
+        target_precision = [target_precision] * K
+    return np.array([best_threshold(prob[:, i], gold[:, i], target_precision[i], default)
+                     for i in range(K)])
+
+
+def save_thresholds(dataset, classifier_suffix, thresholds, directory='../data'):
+    """
+    Store thresholds in a model bundle, so that they are used by predict
+
+    :param dataset: name of the dataset
+    :param classifier_suffix: suffix of the classifier file
+    :param thresholds: array of thresholds, of shape [num_codes]
+    :param directory: directory of data files (default ../data)
+    """
+    bundle = load_model(dataset, classifier_suffix, directory=directory)
+    if len(thresholds) != len(bundle.code_names):
+        raise ValueError('Dimensions do not match')
+    path = os.path.join(directory, '{}_{}.bundle'.format(dataset, classifier_suffix))
+    np.save(os.path.join(path, 'thresholds.npy'), np.asarray(thresholds, dtype='float64'))
+
+
+def tune_on_file(dataset, classifier_suffix, input_name, target_precision=None,
+                 directory='../data'):
+    """
+    Choose thresholds on a held-out preprocessed file, and store them in the bundle
+
+    :param dataset: name of the dataset the classifiers were trained on
+    :param classifier_suffix: suffix of the classifier file
+    :param input_name: name of held-out file of features and codes
+    (without .pkl file extension, with features indexed as in the bundle)
+    :param target_precision: (optional) minimum precision
+    :param directory: directory of data files (default ../data)
+
+    :return: array of thresholds
+    """
+    with open(os.path.join(directory, input_name + '.pkl'), 'rb') as f:
+        features, codes = pickle.load(f)
+    bundle = load_model(dataset, classifier_suffix, directory=directory)
+    thresholds = optimise_thresholds(predict_prob(bundle, features), codes, target_precision)
+    save_thresholds(dataset, classifier_suffix, thresholds, directory)
+    for name, t in zip(bundle.code_names, thresholds):
+        print('{}\t{:.3f}'.format(name, t))
+    return thresholds
+
+
+if __name__ == "__main__":
+    tune_on_file('wash_s04', 'C1', 'wash_s04_verified')
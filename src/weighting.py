@@ -0,0 +1,181 @@
+import copy
+import numpy as np
+from scipy import sparse
+
+# Weighting schemes for sparse feature matrices
+# All operations act directly on the data array of a CSR matrix,
+# so the cost is proportional to the number of nonzero entries.
+
+
+def log_idf(doc_freq, n_docs, smooth=True, dtype='float32'):
+    """
+    Calculate inverse document frequencies, on a log scale
+
+    :param doc_freq: array of document frequencies
+    :param n_docs: total number of documents
+    :param smooth: whether to add one to every frequency (as if there were an
+    extra document containing every feature), to avoid division by zero
+    :param dtype: numpy data type of the output (default float32)
+
+    :return: array of idf weights (all at least 1)
+    """
+    doc_freq = np.asarray(doc_freq, dtype='float64')
+    if smooth:
+        doc_freq = doc_freq + 1
+        n_docs = n_docs + 1
+    return (np.log(n_docs / doc_freq) + 1).astype(dtype)
+
+
+def row_indices(matrix):
+    """
+    Find the row of each nonzero entry of a CSR matrix
+
+    :param matrix: scipy CSR matrix
+
+    :return: array of row indices, aligned with matrix.data
+    """
+    return np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+
+def top_in_rows(matrix, N, values=None, keep=None):
+    """
+    Find the N largest entries in each row of a CSR matrix, for all rows at once
+
+    :param matrix: scipy CSR matrix
+    :param N: number of entries to return for each row
+    :param values: (optional) values to rank entries by, aligned with
+    matrix.data (default: matrix.data)
+    :param keep: (optional) boolean array of which entries to consider,
+    aligned with matrix.data
+
+    :return: column indices (with -1 padding), and values
+    (each of shape [num_rows, N]), largest first
+    """
+    M = matrix.shape[0]
+    top_indices = np.full((M, N), -1, dtype='int64')
+    top_values = np.zeros((M, N))
+    rows = row_indices(matrix)
+    values = matrix.data if values is None else values
+    cols = matrix.indices
+    if keep is not None:
+        rows, values, cols = rows[keep], values[keep], cols[keep]
+    # Sort by row, then by value (descending)
+    order = np.lexsort((-values, rows))
+    rows, values, cols = rows[order], values[order], cols[order]
+    # Find the rank of each entry within its row
+    starts = np.searchsorted(rows, np.arange(M))
+    rank = np.arange(len(rows)) - starts[rows]
+    keep = rank < N
+    top_indices[rows[keep], rank[keep]] = cols[keep]
+    top_values[rows[keep], rank[keep]] = values[keep]
+    return top_indices, top_values
+
+
+def normalise_rows(matrix):
+    """
+    Scale each row of a CSR matrix to have unit l2 norm, in place
+    (rows of zeros are left unchanged)
+
+    :param matrix: scipy CSR matrix
+
+    :return: the same matrix
+    """
+    rows = row_indices(matrix)
+    norms = np.sqrt(np.bincount(rows, matrix.data.astype('float64') ** 2,
+                                minlength=matrix.shape[0]))
+    norms[norms == 0] = 1
+    matrix.data /= norms[rows].astype(matrix.dtype)
+    return matrix
+
+
+class Weighting:
+    """
+    Class for weighting sparse count matrices, using any combination of
+    sublinear tf, log idf, and l2 normalisation
+    """
+    def __init__(self, idf=True, sublinear_tf=False, norm='l2', smooth=True,
+                 dtype='float32'):
+        """
+        :param idf: whether to multiply by log idf (requires fitting)
+        :param sublinear_tf: whether to replace counts tf by 1 + log(tf)
+        :param norm: 'l2' to normalise each row, or None
+        :param smooth: whether to smooth the document frequencies
+        :param dtype: numpy data type of weighted matrices (default float32)
+        """
+        if norm not in ('l2', None):
+            raise ValueError('norm must be l2 or None')
+        self.use_idf = idf
+        self.sublinear_tf = sublinear_tf
+        self.norm = norm
+        self.smooth = smooth
+        self.dtype = np.dtype(dtype)
+        self.idf = None
+
+    def fit_frequencies(self, freq, n_docs, feature_dict):
+        """
+        Calculate idf weights from document frequencies
+
+        :param freq: dict mapping features to document frequencies
+        :param n_docs: total number of documents
+        :param feature_dict: dict mapping features to indices
+
+        :return: self
+        """
+        doc_freq = np.zeros(len(feature_dict))
+        for feat, i in feature_dict.items():
+            doc_freq[i] = freq.get(feat, 0)
+        self.idf = log_idf(doc_freq, n_docs, self.smooth, self.dtype)
+        return self
+
+    def fit(self, bags, feature_dict):
+        """
+        Calculate idf weights from a corpus, in a single pass
+
+        :param bags: iterable of bags of features
+        (e.g. from preprocess.iter_bags_of_features)
+        :param feature_dict: dict mapping features to indices
+
+        :return: self
+        """
+        doc_freq = np.zeros(len(feature_dict), dtype='int64')
+        n_docs = 0
+        for bag in bags:
+            indices = [feature_dict[f] for f in bag if f in feature_dict]
+            doc_freq[indices] += 1
+            n_docs += 1
+        self.idf = log_idf(doc_freq, n_docs, self.smooth, self.dtype)
+        return self
+
+    def subset(self, keep):
+        """
+        Restrict the weighting to a subset of features
+
+        :param keep: array of indices of features to keep
+
+        :return: new Weighting
+        """
+        new = copy.copy(self)
+        if self.idf is not None:
+            new.idf = self.idf[keep]
+        return new
+
+    def __call__(self, matrix):
+        """
+        Weight a matrix of counts
+
+        :param matrix: numpy array or scipy sparse matrix, of shape
+        [num_messages, num_features]
+
+        :return: weighted scipy CSR matrix
+        """
+        if self.use_idf and self.idf is None:
+            raise ValueError('idf weights have not been fit')
+        matrix = sparse.csr_matrix(matrix, dtype=self.dtype, copy=True)
+        if self.sublinear_tf:
+            np.log(matrix.data, out=matrix.data)
+            matrix.data += 1
+        if self.use_idf:
+            matrix.data *= self.idf[matrix.indices]
+        if self.norm == 'l2':
+            normalise_rows(matrix)
+        return matrix